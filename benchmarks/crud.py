@@ -0,0 +1,317 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of collection operations against a local PostgreSQL server
+
+Usage: python -m benchmarks.crud [--documents N] [--output FILE]
+                                 [--baseline FILE [--threshold RATIO]]
+
+Synthetic documents are loaded into a throwaway database, created and
+dropped by the benchmark unless --database names an existing one. The
+connection parameters come from the usual libpq environment variables
+(PGHOST, PGUSER...). Results can be written as JSON, and compared with
+those of a previous run: the exit status is 1 if an operation became
+slower than the baseline by more than the threshold.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import string
+from timeit import default_timer as timer
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from pymongres import MongresClient
+
+
+COLLECTION = 'benchmark'
+
+# Allowed slowdown before an operation is reported as a regression
+DEFAULT_THRESHOLD = 0.2
+
+PERCENTILES = (50, 95, 99)
+
+
+class Dataset(object):
+    """
+    Generator of reproducible synthetic documents
+
+    ``size`` is the approximate size of a document in bytes, ``depth`` the
+    nesting level of its subdocuments and ``cardinality`` the number of
+    distinct values of its ``group`` field.
+    """
+
+    def __init__(self, size=512, depth=2, cardinality=100, seed=0):
+        self.size = size
+        self.depth = depth
+        self.cardinality = cardinality
+        self.seed = seed
+
+    def document(self, rng, i):
+        document = {
+            'key': 'k{}'.format(i),
+            'group': 'g{}'.format(rng.randrange(self.cardinality)),
+            'value': rng.random(),
+            'tags': [rng.choice(string.ascii_lowercase) for _ in range(3)],
+        }
+        node = document
+        for level in range(self.depth):
+            node['child'] = {'level': level, 'value': rng.randrange(1000)}
+            node = node['child']
+        padding = self.size - len(json.dumps(document))
+        if padding > 0:
+            document['text'] = ''.join(rng.choice(string.ascii_letters) for _ in range(padding))
+        return document
+
+    def documents(self, count, start=0):
+        rng = random.Random(self.seed + start)
+        return [self.document(rng, i) for i in range(start, start + count)]
+
+
+class Benchmark(object):
+    """
+    Timings of the runs of one operation
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.documents = 0
+
+    def time(self, func, documents=1):
+        started = timer()
+        res = func()
+        self.latencies.append(timer() - started)
+        self.documents += documents
+        return res
+
+    def summary(self):
+        total = sum(self.latencies)
+        latencies = sorted(self.latencies)
+        summary = {
+            'operations': len(latencies),
+            'documents': self.documents,
+            'total_time': total,
+            'ops_per_second': len(latencies) / total if total else None,
+            'docs_per_second': self.documents / total if total else None,
+        }
+        for percentile in PERCENTILES:
+            summary['p{}'.format(percentile)] = _percentile(latencies, percentile)
+        return summary
+
+
+def _percentile(values, percentile):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return None
+    rank = max(int(-(-percentile * len(values) // 100)), 1)
+    return values[rank - 1]
+
+
+def run(collection, dataset, count, samples):
+    """
+    Run every benchmark on an empty collection, returning their summaries
+    """
+    rng = random.Random(dataset.seed)
+    benchmarks = []
+
+    def benchmark(name):
+        benchmarks.append(Benchmark(name))
+        return benchmarks[-1]
+
+    bench = benchmark('insert_one')
+    for document in dataset.documents(samples, start=count):
+        bench.time(lambda: collection.insert(document))
+    collection.remove(None)
+
+    bench = benchmark('insert_bulk')
+    documents = dataset.documents(count)
+    batch_size = max(count // 10, 1)
+    ids = []
+    for start in range(0, count, batch_size):
+        batch = documents[start:start + batch_size]
+        ids.extend(bench.time(lambda: collection.insert(batch), len(batch)))
+
+    collection.create_index('key')
+    collection.create_index('group')
+    with collection.database.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE {}'.format(collection.name))
+
+    bench = benchmark('find_one_by_id')
+    for _id in rng.sample(ids, min(samples, len(ids))):
+        bench.time(lambda: collection.find_one({'_id': _id}))
+
+    bench = benchmark('find_one_by_field')
+    for i in rng.sample(range(count), min(samples, count)):
+        bench.time(lambda: collection.find_one({'key': 'k{}'.format(i)}))
+
+    bench = benchmark('find_all')
+    for _ in range(3):
+        bench.time(lambda: sum(1 for _ in collection.find()), count)
+
+    bench = benchmark('find_projection')
+    for _ in range(3):
+        bench.time(lambda: sum(1 for _ in collection.find(None, ['key', 'child.level'])), count)
+
+    bench = benchmark('count')
+    for _ in range(samples):
+        group = 'g{}'.format(rng.randrange(dataset.cardinality))
+        bench.time(lambda: collection.find({'group': group}).count())
+
+    bench = benchmark('remove')
+    for i in rng.sample(range(count), min(samples, count)):
+        bench.time(lambda: collection.remove({'key': 'k{}'.format(i)}))
+
+    return dict((bench.name, bench.summary()) for bench in benchmarks)
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Return the regressions of results compared to a baseline
+
+    An operation regresses if its throughput dropped, or its p95 latency
+    rose, by more than ``threshold`` (a ratio). Each regression is a
+    ``(name, metric, baseline value, value)`` tuple.
+    """
+    regressions = []
+    for name, summary in sorted(results.items()):
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if reference['docs_per_second'] and summary['docs_per_second'] < reference['docs_per_second'] * (1 - threshold):
+            regressions.append((name, 'docs_per_second', reference['docs_per_second'], summary['docs_per_second']))
+        if reference['p95'] and summary['p95'] > reference['p95'] * (1 + threshold):
+            regressions.append((name, 'p95', reference['p95'], summary['p95']))
+    return regressions
+
+
+class ThrowawayDatabase(object):
+    """
+    Context manager creating a database, and dropping it on exit
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def _execute(self, sql):
+        connection = psycopg2.connect(database='postgres')
+        try:
+            connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with connection.cursor() as cursor:
+                cursor.execute(sql.format(self.name))
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self._execute('CREATE DATABASE {}')
+        return self.name
+
+    def __exit__(self, *exc_info):
+        self._execute('DROP DATABASE IF EXISTS {}')
+
+
+def benchmark_database(args, dataset, name):
+    client = MongresClient()
+    try:
+        database = client[name]
+        database.drop_collection(COLLECTION)
+        try:
+            results = run(database[COLLECTION], dataset, args.documents, args.samples)
+            with database.connection() as connection:
+                server_version = connection.server_version
+        finally:
+            database.drop_collection(COLLECTION)
+    finally:
+        client.close()
+    return results, server_version
+
+
+def print_results(results):
+    print('{:<20} {:>8} {:>14} {:>10} {:>10} {:>10}'.format(
+        'operation', 'ops', 'docs/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'
+    ))
+    for name in sorted(results):
+        summary = results[name]
+        print('{:<20} {:>8} {:>14,.0f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            name, summary['operations'], summary['docs_per_second'],
+            summary['p50'] * 1000, summary['p95'] * 1000, summary['p99'] * 1000,
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--documents', type=int, default=10000, help="documents per collection")
+    parser.add_argument('--samples', type=int, default=200, help="runs of each single-document operation")
+    parser.add_argument('--size', type=int, default=512, help="approximate document size in bytes")
+    parser.add_argument('--depth', type=int, default=2, help="nesting depth of documents")
+    parser.add_argument('--cardinality', type=int, default=100, help="distinct values of the group field")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help="existing database to use instead of a throwaway one")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare the results with this JSON file")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown ratio before reporting a regression")
+    args = parser.parse_args()
+
+    dataset = Dataset(args.size, args.depth, args.cardinality, args.seed)
+    if args.database:
+        results, server_version = benchmark_database(args, dataset, args.database)
+    else:
+        with ThrowawayDatabase('pymongres_benchmark_{}'.format(os.getpid())) as name:
+            results, server_version = benchmark_database(args, dataset, name)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'config': {
+                    'documents': args.documents,
+                    'samples': args.samples,
+                    'size': args.size,
+                    'depth': args.depth,
+                    'cardinality': args.cardinality,
+                    'seed': args.seed,
+                },
+                'environment': {
+                    'python': platform.python_version(),
+                    'postgresql': server_version,
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, reference, value in regressions:
+            print('REGRESSION {} {}: {:.6g} -> {:.6g}'.format(name, metric, reference, value))
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Microbenchmark of the JSON codecs used to encode and decode documents
+
+Usage: python -m benchmarks.json_codecs [--number N]
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+from datetime import datetime
+import timeit
+
+from pymongres.json_adapters import JsonCodec, OrjsonCodec
+
+
+DOCUMENT = {
+    "author": "Mike",
+    "text": "My first blog post!" * 20,
+    "tags": ["mongodb", "python", "pymongo"],
+    "date": datetime(2009, 11, 12, 11, 14),
+    "comments": [
+        {"author": "Eliot", "text": "Nice post", "votes": i, "score": i / 3.0}
+        for i in range(20)
+    ],
+}
+
+
+def available_codecs():
+    codecs = [JsonCodec()]
+    try:
+        codecs.append(OrjsonCodec())
+    except ImportError:
+        pass
+    return codecs
+
+
+def run(number):
+    results = []
+    for codec in available_codecs():
+        encoded = codec.dumps(DOCUMENT)
+        dumps = min(timeit.repeat(lambda: codec.dumps(DOCUMENT), number=number, repeat=3))
+        loads = min(timeit.repeat(lambda: codec.loads(encoded), number=number, repeat=3))
+        results.append((codec.name, number / dumps, number / loads))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=10000, help="iterations per measurement")
+    args = parser.parse_args()
+
+    print('{:<10} {:>14} {:>14}'.format('codec', 'dumps (doc/s)', 'loads (doc/s)'))
+    for name, dumps, loads in run(args.number):
+        print('{:<10} {:>14,.0f} {:>14,.0f}'.format(name, dumps, loads))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,3 +17,12 @@
 from __future__ import absolute_import
 
 from pymongres.client import MongresClient
+from pymongres.operations import (
+    DeleteMany,
+    DeleteOne,
+    InsertOne,
+    ReplaceOne,
+    UpdateMany,
+    UpdateOne,
+)
+from pymongres.raw import RawDocument
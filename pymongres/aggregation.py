@@ -0,0 +1,309 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compilation of aggregation pipelines to a single SQL statement
+
+Supported stages are ``$match`` (before any ``$group`` or ``$project``;
+at the beginning of the pipeline it can use indexes), ``$group`` with
+the ``$sum``, ``$avg``, ``$min``, ``$max``, ``$push`` and ``$addToSet``
+accumulators, ``$sort``, ``$skip``, ``$limit`` and ``$project``. Each
+stage is compiled to a clause of the current SELECT, or to a new SELECT
+over it when SQL requires it. The order of a subquery is not kept by the
+query over it, so a sorted SELECT numbers its rows in that order, and
+the SELECT over it sorts by that number, or accumulates ``$push`` in
+that order.
+"""
+
+from __future__ import absolute_import
+
+import itertools
+
+from six import iteritems, string_types
+
+from pymongres.errors import OperationFailure
+from pymongres.json_adapters import JsonCodec
+from pymongres.query import build_json_column, compile_where, escape, json_path, quoted
+
+
+# Column numbering the rows of a sorted SELECT for the one over it
+ORDER_COLUMN = 'pymongres_order'
+
+def compile_pipeline(collection, pipeline, codec=None):
+    """
+    Return the SQL template and parameters of an aggregation pipeline
+    """
+    builder = _PipelineBuilder(collection, codec)
+    for stage in pipeline:
+        if len(stage) != 1:
+            raise OperationFailure("a pipeline stage must have exactly one operator")
+        op, arg = next(iteritems(stage))
+        handler = _STAGES.get(op)
+        if handler is None:
+            raise OperationFailure("unsupported pipeline stage %s" % op)
+        handler(builder, arg)
+    return builder.render()
+
+
+class _Select(object):
+    """
+    One level of SELECT in the compiled statement
+
+    On the base level, rows are the (id, data) columns of the collection
+    table. Other levels have a single jsonb ``data`` column holding the
+    whole document, ``_id`` included.
+    """
+
+    def __init__(self, source, params, base):
+        self.source = source
+        self.params = params
+        self.base = base
+        self.columns = 'id, data' if base else 'data'
+        self.where = []
+        self.group_by = None
+        self.having = None
+        self.order_by = None
+        self.limit = None
+        self.offset = None
+        self.transformed = False
+
+    @property
+    def plain(self):
+        return not (self.transformed or self.order_by or self.limit is not None or self.offset is not None)
+
+    def document(self):
+        """
+        SQL expression of the whole document, _id included
+        """
+        if self.base:
+            return "(data || jsonb_build_object('_id', id))"
+        return 'data'
+
+    def field(self, path):
+        """
+        SQL expression of the (jsonb) value of a document field
+        """
+        if self.base and path == '_id':
+            return 'to_jsonb(id)'
+        return escape(build_json_column(path))
+
+    def render(self):
+        params = list(self.params)
+        sql = 'SELECT {} FROM {}'.format(self.columns, self.source)
+        if self.where:
+            sql += ' WHERE ' + ' AND '.join(self.where)
+        if self.group_by is not None:
+            sql += ' GROUP BY ' + self.group_by
+        if self.having is not None:
+            sql += ' HAVING ' + self.having
+        if self.order_by:
+            sql += ' ORDER BY ' + self.order_by
+        if self.offset is not None:
+            sql += ' OFFSET %s'
+            params.append(self.offset)
+        if self.limit is not None:
+            sql += ' LIMIT %s'
+            params.append(self.limit)
+        return sql, params
+
+
+class _PipelineBuilder(object):
+
+    def __init__(self, collection, codec=None):
+        self.codec = codec or JsonCodec()
+        self.select = _Select(collection, [], base=True)
+        self._aliases = itertools.count(1)
+
+    def wrap(self):
+        """
+        Continue with a new SELECT over the current one
+        """
+        inner = self.select
+        if inner.order_by:
+            inner.columns += ', row_number() OVER (ORDER BY {}) AS {}'.format(inner.order_by, ORDER_COLUMN)
+        sql, params = inner.render()
+        source = '({}) AS stage{}'.format(sql, next(self._aliases))
+        # Without transformation, the id column is still available
+        self.select = _Select(source, params, inner.base)
+        if inner.order_by:
+            self.select.order_by = ORDER_COLUMN
+
+    def render(self):
+        select = self.select
+        if select.base and not select.transformed:
+            select.columns = '{} AS data'.format(select.document())
+        return select.render()
+
+    def match(self, spec):
+        select = self.select
+        if not select.base:
+            raise OperationFailure("$match is only supported before $group and $project")
+        if not select.plain:
+            self.wrap()
+            select = self.select
+        where, params = compile_where(spec, self.codec)
+        if where:
+            select.where.append(where[len(' WHERE '):])
+            select.params.extend(params)
+
+    def group(self, spec):
+        if '_id' not in spec:
+            raise OperationFailure("a group specification must include an _id")
+        if not self.select.plain:
+            self.wrap()
+        select = self.select
+        # Groups are not sorted, but their $push arrays are
+        order_by, select.order_by = select.order_by, None
+
+        key = self._expression(spec['_id'])
+        fields = ["'_id', {}".format(key)]
+        for name, accumulator in iteritems(spec):
+            if name == '_id':
+                continue
+            if not isinstance(accumulator, dict) or len(accumulator) != 1:
+                raise OperationFailure("the field '%s' must be an accumulator object" % name)
+            op, arg = next(iteritems(accumulator))
+            fields.append('{}, {}'.format(escape(quoted(name)), self._accumulator(op, arg, order_by)))
+
+        select.columns = 'jsonb_build_object({}) AS data'.format(', '.join(fields))
+        if spec['_id'] is None:
+            # A single group, which must not exist without input rows
+            select.group_by = None
+            select.having = 'count(*) > 0'
+        else:
+            select.group_by = key
+        select.transformed = True
+        select.base = False
+
+    def sort(self, spec):
+        select = self.select
+        if select.transformed or select.limit is not None or select.offset is not None:
+            self.wrap()
+            select = self.select
+        items = spec.items() if isinstance(spec, dict) else spec
+        clauses = []
+        for key, direction in items:
+            if direction not in (1, -1):
+                raise OperationFailure("$sort key ordering must be 1 (ascending) or -1 (descending)")
+            column = 'id' if select.base and key == '_id' else select.field(key)
+            clauses.append('{} {}'.format(column, 'ASC' if direction == 1 else 'DESC'))
+        select.order_by = ', '.join(clauses)
+
+    def skip(self, skip):
+        if self.select.limit is not None or self.select.offset is not None:
+            self.wrap()
+        self.select.offset = int(skip)
+
+    def limit(self, limit):
+        if self.select.limit is not None:
+            self.wrap()
+        self.select.limit = int(limit)
+
+    def project(self, spec):
+        if not self.select.plain:
+            self.wrap()
+        select = self.select
+        document = select.document()
+
+        included = dict((key, value) for key, value in iteritems(spec) if key != '_id')
+        inclusion = any(value is True or value == 1 or _is_field(value) for value in included.values())
+        if not inclusion and (included or not spec.get('_id', True)):
+            # Exclusion, which {'_id': 0} alone also is
+            expression = document
+            for key in sorted(included):
+                expression = '({} #- {})'.format(expression, escape(quoted(json_path(key))))
+            if not spec.get('_id', True):
+                expression = "({} - '_id')".format(expression)
+        else:
+            tree = {}
+            if spec.get('_id', True):
+                tree['_id'] = '$_id'
+            for key, value in iteritems(included):
+                node = tree
+                path = key.split('.')
+                for item in path[:-1]:
+                    node = node.setdefault(item, {})
+                node[path[-1]] = value if _is_field(value) else '$' + key
+            expression = self._build_object(tree, document)
+
+        select.columns = '{} AS data'.format(expression)
+        select.transformed = True
+        select.base = False
+
+    def _build_object(self, tree, document):
+        """
+        Build the object for a projection tree, leaving out missing fields
+        """
+        parts = []
+        for name in sorted(tree):
+            value = tree[name]
+            key = escape(quoted(name))
+            if isinstance(value, dict):
+                parts.append('jsonb_build_object({}, {})'.format(key, self._build_object(value, document)))
+            else:
+                field = '({} #> {})'.format(document, escape(quoted(json_path(value[1:]))))
+                parts.append("CASE WHEN {0} IS NULL THEN '{{}}'::jsonb ELSE jsonb_build_object({1}, {0}) END".format(field, key))
+        return '({})'.format(' || '.join(parts)) if parts else "'{}'::jsonb"
+
+    def _expression(self, value):
+        """
+        SQL expression of a group key: a field, an object of fields, or a constant
+        """
+        if _is_field(value):
+            return self.select.field(value[1:])
+        if isinstance(value, dict):
+            return 'jsonb_build_object({})'.format(', '.join(
+                '{}, {}'.format(escape(quoted(name)), self._expression(item))
+                for name, item in sorted(iteritems(value))
+            ))
+        return escape(quoted(self.codec.dumps(value))) + '::jsonb'
+
+    def _accumulator(self, op, arg, order_by=None):
+        if op == '$sum' and isinstance(arg, (int, float)) and not isinstance(arg, bool):
+            return 'to_jsonb(count(*) * {})'.format(arg)
+        if not _is_field(arg):
+            raise OperationFailure("unsupported argument for %s: %r" % (op, arg))
+        value = self.select.field(arg[1:])
+        number = "CASE WHEN jsonb_typeof({0}) = 'number' THEN ({0} #>> '{{}}')::numeric END".format(value)
+        text = "CASE WHEN jsonb_typeof({0}) = 'string' THEN {0} #>> '{{}}' END".format(value)
+        if op == '$sum':
+            return 'to_jsonb(COALESCE(sum({}), 0))'.format(number)
+        elif op == '$avg':
+            return 'to_jsonb(avg({}))'.format(number)
+        elif op in ('$min', '$max'):
+            func = op[1:]
+            # Numbers take precedence over strings
+            return 'COALESCE(to_jsonb({0}({1})), to_jsonb({0}({2})))'.format(func, number, text)
+        elif op == '$push':
+            order = ' ORDER BY {}'.format(order_by) if order_by else ''
+            return "COALESCE(jsonb_agg({0}{1}) FILTER (WHERE {0} IS NOT NULL), '[]')".format(value, order)
+        elif op == '$addToSet':
+            return "COALESCE(jsonb_agg(DISTINCT {0}) FILTER (WHERE {0} IS NOT NULL), '[]')".format(value)
+        raise OperationFailure("unsupported accumulator %s" % op)
+
+
+_STAGES = {
+    '$match': _PipelineBuilder.match,
+    '$group': _PipelineBuilder.group,
+    '$sort': _PipelineBuilder.sort,
+    '$skip': _PipelineBuilder.skip,
+    '$limit': _PipelineBuilder.limit,
+    '$project': _PipelineBuilder.project,
+}
+
+
+def _is_field(value):
+    return isinstance(value, string_types) and value.startswith('$')
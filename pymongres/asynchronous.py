@@ -0,0 +1,562 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asyncio variant of the client, built on aiopg
+
+The classes mirror MongresClient, Database, Collection and ResultSet and
+share their query compiler, so that both APIs behave the same::
+
+    client = AsyncMongresClient()
+    posts = client.blog.posts
+    post_id = await posts.insert({'author': 'Mike'})
+    post = await posts.find_one({'_id': post_id})
+    async for post in posts.find({'author': 'Mike'}).sort('date'):
+        ...
+    await client.close()
+
+This module requires Python 3.7+ and the ``aiopg`` package.
+"""
+
+from __future__ import absolute_import
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import itertools
+from itertools import islice
+
+import aiopg
+import psycopg2
+from psycopg2.extensions import quote_ident
+
+from pymongres import query
+from pymongres.catalog import Catalog
+from pymongres.changes import (
+    change_event,
+    CREATE_CHANGES_TABLE,
+    DOCUMENT_QUERY,
+    REPLAY_QUERY,
+    watch_channel,
+    WATCH_FUNCTION,
+    watch_trigger,
+)
+from pymongres.collection import Collection, DEFAULT_BATCH_SIZE as DEFAULT_INSERT_BATCH_SIZE
+from pymongres.json_adapters import default_codec
+from pymongres.loader import DEFAULT_MAX_BATCH_SIZE
+from pymongres.query import Projection
+from pymongres.resultset import BaseResultSet
+
+
+_cursor_ids = itertools.count(1)
+
+
+class AsyncMongresClient(object):
+
+    def __init__(self, min_pool_size=0, max_pool_size=10, wait_queue_timeout=60.0,
+                 catalog_ttl=None, json_codec=None, **kwargs):
+        self.kwargs = kwargs
+        self.json_codec = json_codec if json_codec is not None else default_codec()
+        self.pool_options = {
+            'minsize': min_pool_size,
+            'maxsize': max_pool_size,
+            'timeout': wait_queue_timeout,
+        }
+        self._pools = {}
+        self._pools_lock = None
+        self._catalog = Catalog(ttl=catalog_ttl)
+
+    def __getattr__(self, name):
+        return self._get_database(name)
+
+    def __getitem__(self, name):
+        return self._get_database(name)
+
+    def _get_database(self, name):
+        return AsyncDatabase(self, name)
+
+    async def _get_pool(self, database_name):
+        """
+        Return the aiopg pool for a database, creating it on first use
+        """
+        pool = self._pools.get(database_name)
+        if pool is None:
+            if self._pools_lock is None:
+                # Created here to bind it to the running event loop
+                self._pools_lock = asyncio.Lock()
+            async with self._pools_lock:
+                pool = self._pools.get(database_name)
+                if pool is None:
+                    kwargs = dict(self.kwargs, database=database_name)
+                    kwargs.update(self.pool_options)
+                    pool = self._pools[database_name] = await aiopg.create_pool(
+                        on_connect=self._on_connect, **kwargs
+                    )
+        return pool
+
+    async def _on_connect(self, connection):
+        self.json_codec.register(connection.raw)
+
+    def pool_stats(self):
+        return dict(
+            (name, {
+                'size': pool.size,
+                'min_size': pool.minsize,
+                'max_size': pool.maxsize,
+                'in_use': pool.size - pool.freesize,
+                'idle': pool.freesize,
+            })
+            for name, pool in self._pools.items()
+        )
+
+    async def close(self):
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.close()
+        for pool in pools.values():
+            await pool.wait_closed()
+
+
+class AsyncDatabase(object):
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Borrow a pooled connection (in autocommit mode) for an ``async with`` block
+        """
+        pool = await self.client._get_pool(self.name)
+        async with pool.acquire() as connection:
+            yield connection
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Run an ``async with`` block in a transaction, and yield a cursor
+        """
+        async with self.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute('BEGIN')
+                try:
+                    yield cursor
+                except BaseException:
+                    await cursor.execute('ROLLBACK')
+                    raise
+                else:
+                    await cursor.execute('COMMIT')
+
+    async def collection_names(self):
+        return [name for name in await self._list_tables() if not name.startswith(('pg_', 'sql_', 'pymongres_'))]
+
+    async def drop_collection(self, name):
+        await self._drop_table(name)
+
+    def __getattr__(self, name):
+        return self._get_collection(name)
+
+    def __getitem__(self, name):
+        return self._get_collection(name)
+
+    def _get_collection(self, name):
+        return AsyncCollection(self, name)
+
+    async def _execute(self, sql_query, params=None):
+        async with self.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(sql_query, params)
+                if cursor.description is not None:
+                    return await cursor.fetchall()
+
+    async def _list_tables(self):
+        rows = await self._execute(
+            "SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE'"
+        )
+        names = [row[0] for row in rows]
+        self.client._catalog.load(self.name, names)
+        return names
+
+    async def _table_exists(self, name):
+        tables = self.client._catalog.get(self.name)
+        if tables is None:
+            tables = await self._list_tables()
+        return name in tables
+
+    async def _create_table(self, name):
+        await self._execute("CREATE TABLE IF NOT EXISTS {} (id serial PRIMARY KEY, data jsonb);".format(name))
+        self.client._catalog.add(self.name, name)
+
+    async def _drop_table(self, name):
+        await self._execute("DROP TABLE IF EXISTS {};".format(name))
+        self.client._catalog.discard(self.name, name)
+
+
+class AsyncCollection(object):
+    """
+    Asyncio counterpart of Collection
+
+    The table is created lazily, by the first operation on the collection.
+    """
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        Collection._check_name(name)
+        self._table_checked = False
+
+    @property
+    def _codec(self):
+        return self.database.client.json_codec
+
+    def __eq__(self, other):
+        if isinstance(other, AsyncCollection):
+            return (self.database, self.name) == (other.database, other.name)
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    async def _ensure_table(self):
+        if not self._table_checked:
+            if not await self.database._table_exists(self.name):
+                await self.database._create_table(self.name)
+            self._table_checked = True
+
+    async def insert(self, doc_or_docs, batch_size=DEFAULT_INSERT_BATCH_SIZE):
+        """
+        Insert a document or an iterable of documents
+
+        Multiple documents are sent in multi-row INSERT statements of
+        ``batch_size`` documents, within a single transaction.
+        """
+        await self._ensure_table()
+        if isinstance(doc_or_docs, dict):
+            rows = await self.database._execute(
+                'INSERT INTO {} (data) VALUES (%s) RETURNING (id)'.format(self.name),
+                [self._codec.adapt(doc_or_docs)]
+            )
+            return rows[0][0]
+
+        res = []
+        documents = iter(doc_or_docs)
+        async with self.database.transaction() as cursor:
+            while True:
+                batch = list(islice(documents, batch_size))
+                if not batch:
+                    break
+                values = b','.join(
+                    cursor.mogrify('(%s)', [self._codec.dumps(document)]) for document in batch
+                )
+                await cursor.execute('INSERT INTO {} (data) VALUES {} RETURNING (id)'.format(
+                    self.name, values.decode('utf8')
+                ))
+                res.extend(_id for _id, in await cursor.fetchall())
+        return res
+
+    async def find_one(self, spec=None, fields=None, document_class=dict):
+        await self._ensure_table()
+        projection = Projection.from_fields(fields, document_class)
+        sql_query, params = query.compile_find(
+            self.name, spec, projection=projection, limit=1, codec=self._codec
+        )
+        rows = await self.database._execute(sql_query, params)
+        if not rows:
+            return None
+        return projection.document(rows[0], self._codec.loads)
+
+    def find(self, spec=None, fields=None, document_class=dict):
+        return AsyncResultSet(self, spec, fields, document_class=document_class)
+
+    async def count(self):
+        """
+        Return the number of documents in the collection
+        """
+        await self._ensure_table()
+        sql_query, params = query.compile_count(self.name, None, self._codec)
+        rows = await self.database._execute(sql_query, params)
+        return rows[0][0]
+
+    async def remove(self, spec):
+        """
+        Remove documents from the collection
+        """
+        await self._ensure_table()
+        sql_query, params = query.compile_delete(self.name, spec, self._codec)
+        await self.database._execute(sql_query, params)
+
+    def batch(self, fields=None, document_class=dict, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        """
+        Return an AsyncDocumentLoader, which batches lookups of documents by _id
+        """
+        return AsyncDocumentLoader(self, fields, document_class, max_batch_size)
+
+    async def _find_by_ids(self, ids, fields=None, document_class=dict):
+        await self._ensure_table()
+        projection = Projection.from_fields(fields, document_class)
+        rows = await self.database._execute(query.compile_find_by_ids(self.name, projection), [ids])
+        loads = self._codec.loads
+        return dict((row[0], projection.document(row[1:], loads)) for row in rows)
+
+    async def watch(self, resume_after=None):
+        """
+        Return an AsyncChangeStream of the changes on this collection
+
+        See Collection.watch.
+        """
+        await self._ensure_table()
+        async with self.database.transaction() as cursor:
+            await cursor.execute(CREATE_CHANGES_TABLE)
+            await cursor.execute(WATCH_FUNCTION)
+            await cursor.execute(watch_trigger(self.name))
+
+        client = self.database.client
+        connection = await aiopg.connect(**dict(client.kwargs, database=self.database.name))
+        try:
+            client.json_codec.register(connection.raw)
+            stream = AsyncChangeStream(self, connection, resume_after)
+            await stream._start()
+        except BaseException:
+            connection.close()
+            raise
+        return stream
+
+
+class AsyncDocumentLoader(object):
+    """
+    Asyncio counterpart of DocumentLoader
+
+    The lookups queued by load() during one iteration of the event loop,
+    e.g. by the coroutines of an ``asyncio.gather()``, are sent together
+    in the next one.
+    """
+
+    def __init__(self, collection, fields=None, document_class=dict,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.collection = collection
+        self.fields = fields
+        self.document_class = document_class
+        self.max_batch_size = max_batch_size
+        self._pending = {}
+        self._scheduled = None
+        # The event loop only keeps weak references to tasks
+        self._tasks = set()
+
+    def load(self, _id):
+        """
+        Queue the lookup of a document by _id, and return a future of it
+        """
+        if not isinstance(_id, int):
+            raise TypeError("_id must be an integer")
+        future = self._pending.get(_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._pending[_id] = loop.create_future()
+            if len(self._pending) >= self.max_batch_size:
+                self._dispatch()
+            elif self._scheduled is None:
+                self._scheduled = loop.call_soon(self._dispatch)
+        return future
+
+    async def load_many(self, ids):
+        """
+        Return the documents with the given ids, in order (None if missing)
+        """
+        return await asyncio.gather(*[self.load(_id) for _id in ids])
+
+    async def find_one(self, _id):
+        return await self.load(_id)
+
+    def _dispatch(self):
+        if self._scheduled is not None:
+            self._scheduled.cancel()
+            self._scheduled = None
+        batch, self._pending = self._pending, {}
+        task = asyncio.ensure_future(self._resolve(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, batch):
+        try:
+            documents = await self.collection._find_by_ids(list(batch), self.fields, self.document_class)
+        except Exception as error:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for _id, future in batch.items():
+            if not future.done():
+                future.set_result(documents.get(_id))
+
+
+class AsyncChangeStream(object):
+    """
+    Asyncio counterpart of ChangeStream, iterated with ``async for``
+
+    Iteration waits for the next change, and stops once the stream is
+    closed.
+    """
+
+    def __init__(self, collection, connection, resume_after=None):
+        self.collection = collection
+        self._connection = connection
+        self._resume_token = resume_after
+        self._events = deque()
+        # Changes are numbered in commit order, so older ones were already seen
+        self._last_seq = resume_after
+        self._closed = False
+
+    async def _start(self):
+        async with self._connection.cursor() as cursor:
+            # Listen first, so that no change falls between the replay and the notifications
+            await cursor.execute('LISTEN {}'.format(quote_ident(watch_channel(self.collection.name), cursor.raw)))
+            if self._resume_token is not None:
+                await cursor.execute(REPLAY_QUERY, [self.collection.name, self._resume_token])
+                for seq, operation, _id, document in await cursor.fetchall():
+                    self._last_seq = seq
+                    self._events.append(self._event(seq, operation, _id, document))
+
+    @property
+    def resume_token(self):
+        """
+        Token of the last change returned, to pass as ``resume_after``
+        """
+        return self._resume_token
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._events:
+            if self._closed:
+                raise StopAsyncIteration
+            try:
+                notify = await self._connection.notifies.get()
+            except psycopg2.OperationalError:
+                # Raised when the connection is closed
+                if self._closed:
+                    raise StopAsyncIteration
+                raise
+            await self._receive(notify.payload)
+        return self._next_event()
+
+    async def try_next(self, timeout=0):
+        """
+        Return the next change, or None if there is none within ``timeout`` seconds
+        """
+        if not self._events and not self._closed:
+            try:
+                notify = await asyncio.wait_for(self._connection.notifies.get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            await self._receive(notify.payload)
+        if not self._events:
+            return None
+        return self._next_event()
+
+    async def close(self):
+        self._closed = True
+        await self._connection.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _next_event(self):
+        event = self._events.popleft()
+        self._resume_token = event['_id']
+        return event
+
+    async def _receive(self, payload):
+        change = self.collection._codec.loads(payload)
+        seq = change['seq']
+        if self._last_seq is not None and seq <= self._last_seq:
+            # Already replayed from the change log
+            return
+        self._last_seq = seq
+        if 'document' in change:
+            document = change['document']
+        elif change['operation'] == 'delete':
+            document = None
+        else:
+            async with self._connection.cursor() as cursor:
+                await cursor.execute(DOCUMENT_QUERY, [seq])
+                row = await cursor.fetchone()
+            document = row[0] if row is not None else None
+        self._events.append(self._event(seq, change['operation'], change['id'], document))
+
+    def _event(self, seq, operation, _id, document):
+        return change_event(self.collection.database.name, self.collection.name, seq, operation, _id, document)
+
+
+class AsyncResultSet(BaseResultSet):
+    """
+    Asyncio counterpart of ResultSet, iterated with ``async for``
+
+    Results are streamed from a server-side cursor, ``batch_size`` rows
+    at a time.
+    """
+
+    def __iter__(self):
+        raise TypeError("use 'async for' to iterate over an AsyncResultSet")
+
+    def __aiter__(self):
+        return self._documents()
+
+    async def _documents(self):
+        collection = self.collection
+        await collection._ensure_table()
+        projection = Projection.from_fields(self.fields, self.document_class)
+        sql_query, params = query.compile_find(
+            collection.name, self.spec, self.order_by, projection,
+            limit=self._limit, skip=self._skip, after=self._after,
+            codec=collection._codec,
+        )
+        loads = collection._codec.loads
+
+        if self._batch_size == 0:
+            for row in await collection.database._execute(sql_query, params):
+                yield projection.document(row, loads)
+            return
+
+        name = 'pymongres_cursor_{}'.format(next(_cursor_ids))
+        async with collection.database.transaction() as cursor:
+            await cursor.execute('DECLARE {} NO SCROLL CURSOR FOR {}'.format(name, sql_query), params)
+            while True:
+                await cursor.execute('FETCH FORWARD %s FROM {}'.format(name), [self._batch_size])
+                rows = await cursor.fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    yield projection.document(row, loads)
+
+    async def to_list(self):
+        return [document async for document in self]
+
+    async def count(self):
+        await self.collection._ensure_table()
+        sql_query, params = query.compile_count(self.collection.name, self.spec, self.collection._codec)
+        rows = await self.collection.database._execute(sql_query, params)
+        return rows[0][0]
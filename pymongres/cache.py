@@ -0,0 +1,202 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Opt-in cache of query results, see Collection.enable_cache
+"""
+
+from __future__ import absolute_import
+
+import copy
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from six import iteritems
+
+from pymongres.lru import LRUCache
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Channel notified by the trigger installed on cached collections
+NOTIFY_CHANNEL = 'pymongres_cache'
+
+NOTIFY_FUNCTION = """
+    CREATE OR REPLACE FUNCTION pymongres_cache_notify() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('pymongres_cache', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+NOTIFY_TRIGGER = """
+    DROP TRIGGER IF EXISTS pymongres_cache ON {collection};
+    CREATE TRIGGER pymongres_cache
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {collection}
+        FOR EACH STATEMENT EXECUTE PROCEDURE pymongres_cache_notify()
+"""
+
+
+class ResultCache(object):
+    """
+    Thread-safe LRU cache of the results of the queries on one collection
+
+    Entries expire ``ttl`` seconds after they are stored, and all of them
+    are dropped by invalidate(). A result computed while the cache was
+    being invalidated is not stored, since it may predate the write.
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = LRUCache(max_size)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def fetch(self, key, compute):
+        """
+        Return the cached result for a key, or compute and store it
+
+        Results are copied, so that callers may modify them.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at is None or time.time() < expires_at:
+                with self._lock:
+                    self._hits += 1
+                return copy.deepcopy(value)
+            self._entries.pop(key)
+            with self._lock:
+                self._expirations += 1
+
+        with self._lock:
+            self._misses += 1
+            generation = self._generation
+
+        value = compute()
+        expires_at = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            if generation == self._generation:
+                self._evictions += len(self._entries.put(key, (copy.deepcopy(value), expires_at)))
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+            }
+
+
+def freeze(value):
+    """
+    Return a hashable key for a spec, fields or sort argument
+
+    Types are part of the key, since 1, 1.0 and True are equal in Python
+    but not in documents.
+    """
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted((key, freeze(item)) for key, item in iteritems(value))))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(freeze(item) for item in value))
+    return (type(value).__name__, value)
+
+
+class CacheInvalidator(object):
+    """
+    Invalidate caches when the trigger on their collection notifies
+
+    A background thread listens on a dedicated connection to one
+    database, and calls ``on_notify(collection_name)`` for every write
+    committed to a collection with the trigger, whatever the client. As
+    notifications sent while it is disconnected are lost, it calls
+    ``on_reset()`` whenever it (re)connects.
+    """
+
+    def __init__(self, connect, on_notify, on_reset, poll_interval=1.0, retry_interval=1.0):
+        self._connect = connect
+        self._on_notify = on_notify
+        self._on_reset = on_reset
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self._stopped = threading.Event()
+        self._listening = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pymongres-cache-invalidator')
+        self._thread.daemon = True
+
+    def start(self, timeout=10.0):
+        """
+        Start listening, waiting until notifications can be received
+        """
+        self._thread.start()
+        if not self._listening.wait(timeout):
+            log.warning("cache invalidator not listening after %.1fs", timeout)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            connection = None
+            try:
+                connection = self._connect()
+                connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with connection.cursor() as cursor:
+                    cursor.execute('LISTEN {}'.format(NOTIFY_CHANNEL))
+                self._on_reset()
+                self._listening.set()
+                self._listen(connection)
+            except psycopg2.Error:
+                log.warning("cache invalidation connection failed, retrying", exc_info=True)
+                self._on_reset()
+                self._stopped.wait(self.retry_interval)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def _listen(self, connection):
+        while not self._stopped.is_set():
+            if select.select([connection], [], [], self.poll_interval) == ([], [], []):
+                continue
+            connection.poll()
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+                self._on_notify(notify.payload)
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import threading
+import time
+
+
+class Catalog(object):
+    """
+    Per-client cache of the tables known to exist in each database
+
+    Entries are loaded in one query by ``Database._list_tables``, then kept
+    up to date by ``Database._create_table`` and ``Database._drop_table``.
+    With a ``ttl`` (in seconds) a database's entry is reloaded once it gets
+    older than that, to notice tables dropped by other clients.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def get(self, database_name):
+        """
+        Return the set of known table names, or None if it must be loaded
+        """
+        with self._lock:
+            entry = self._tables.get(database_name)
+            if entry is None:
+                return None
+            tables, loaded_at = entry
+            if self.ttl is not None and time.time() - loaded_at > self.ttl:
+                del self._tables[database_name]
+                return None
+            return tables
+
+    def load(self, database_name, names):
+        with self._lock:
+            self._tables[database_name] = (frozenset(names), time.time())
+
+    def add(self, database_name, name):
+        self._update(database_name, lambda tables: tables | frozenset([name]))
+
+    def discard(self, database_name, name):
+        self._update(database_name, lambda tables: tables - frozenset([name]))
+
+    def invalidate(self, database_name=None):
+        with self._lock:
+            if database_name is None:
+                self._tables.clear()
+            else:
+                self._tables.pop(database_name, None)
+
+    def _update(self, database_name, func):
+        with self._lock:
+            entry = self._tables.get(database_name)
+            if entry is not None:
+                tables, loaded_at = entry
+                self._tables[database_name] = (func(tables), loaded_at)
@@ -0,0 +1,284 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Change streams, see Collection.watch
+
+A trigger records every insert, update and delete on a watched
+collection in the ``pymongres_changes`` table, and publishes it with
+NOTIFY on a channel of the collection. Notifications carry the whole
+change, unless the document is too large for a notification payload,
+in which case the stream reads it from the change log. The change log
+also lets a stream resume after a given change, by replaying the
+changes recorded since.
+
+The trigger is deferred to the commit of the transaction, where it
+takes a lock held until the end of the commit before numbering the
+changes. Sequence numbers thus follow the commit order, which resuming
+relies on, at the cost of serializing the commits of the transactions
+that write to watched collections.
+"""
+
+from __future__ import absolute_import
+
+from collections import deque
+import select
+import threading
+
+import psycopg2
+from psycopg2.extensions import quote_ident
+
+from pymongres.query import short_identifier
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Table recording the changes made to watched collections
+CHANGES_TABLE = 'pymongres_changes'
+
+# Notification payloads must be shorter than 8000 bytes
+MAX_PAYLOAD_SIZE = 7900
+
+# Key of the advisory lock numbering the changes in commit order
+WATCH_LOCK_KEY = 7170735
+
+CREATE_CHANGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS pymongres_changes (
+        seq bigserial PRIMARY KEY,
+        collection text NOT NULL,
+        operation text NOT NULL,
+        document_id integer NOT NULL,
+        document jsonb,
+        created_at timestamptz NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS pymongres_changes_collection ON pymongres_changes (collection, seq)
+"""
+
+WATCH_FUNCTION = """
+    CREATE OR REPLACE FUNCTION pymongres_watch_notify() RETURNS trigger AS $$
+    DECLARE
+        change_seq bigint;
+        change_id integer;
+        change_document jsonb;
+        payload text;
+    BEGIN
+        PERFORM pg_advisory_xact_lock({lock_key});
+        IF TG_OP = 'DELETE' THEN
+            change_id := OLD.id;
+        ELSE
+            change_id := NEW.id;
+            change_document := NEW.data;
+        END IF;
+        INSERT INTO pymongres_changes (collection, operation, document_id, document)
+            VALUES (TG_TABLE_NAME, lower(TG_OP), change_id, change_document)
+            RETURNING seq INTO change_seq;
+        payload := json_build_object(
+            'seq', change_seq, 'operation', lower(TG_OP), 'id', change_id, 'document', change_document
+        )::text;
+        IF octet_length(payload) > {max_payload_size} THEN
+            -- The stream reads the document from the change log
+            payload := json_build_object('seq', change_seq, 'operation', lower(TG_OP), 'id', change_id)::text;
+        END IF;
+        PERFORM pg_notify(TG_ARGV[0], payload);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+""".replace('{lock_key}', str(WATCH_LOCK_KEY)).replace('{max_payload_size}', str(MAX_PAYLOAD_SIZE))
+
+WATCH_TRIGGER = """
+    DROP TRIGGER IF EXISTS pymongres_watch ON {collection};
+    CREATE CONSTRAINT TRIGGER pymongres_watch
+        AFTER INSERT OR UPDATE OR DELETE ON {collection}
+        DEFERRABLE INITIALLY DEFERRED
+        FOR EACH ROW EXECUTE PROCEDURE pymongres_watch_notify({channel})
+"""
+
+UNWATCH_TRIGGER = "DROP TRIGGER IF EXISTS pymongres_watch ON {collection}"
+
+REPLAY_QUERY = (
+    "SELECT seq, operation, document_id, document FROM pymongres_changes "
+    "WHERE collection = %s AND seq > %s ORDER BY seq"
+)
+
+DOCUMENT_QUERY = "SELECT document FROM pymongres_changes WHERE seq = %s"
+
+
+def watch_channel(collection):
+    """
+    Return the channel notified of the changes on a collection
+    """
+    return short_identifier(u'pymongres_watch_{}'.format(collection))
+
+
+def watch_trigger(collection):
+    """
+    Return the statements installing the trigger on a collection
+    """
+    # The channel is passed to the trigger function as a string literal
+    channel = "'{}'".format(watch_channel(collection).replace("'", "''"))
+    return WATCH_TRIGGER.format(collection=collection, channel=channel)
+
+
+def change_event(database, collection, seq, operation, _id, document):
+    """
+    Return a change event, shaped like MongoDB's
+
+    The ``_id`` of the event is its resume token.
+    """
+    if document is not None:
+        document['_id'] = _id
+    return {
+        '_id': seq,
+        'operationType': operation,
+        'ns': {'db': database, 'coll': collection},
+        'documentKey': {'_id': _id},
+        'fullDocument': document,
+    }
+
+
+class ChangeStream(object):
+    """
+    Blocking iterator over the changes of a collection
+
+    Iteration blocks until the next change, and stops once the stream is
+    closed, which may be done from another thread. Use try_next() to wait
+    for at most a given time instead. After a connection failure, open a
+    new stream with ``resume_after=stream.resume_token``.
+    """
+
+    def __init__(self, collection, resume_after=None, poll_interval=1.0):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self._resume_token = resume_after
+        self._events = deque()
+        # Changes are numbered in commit order, so older ones were already seen
+        self._last_seq = resume_after
+        self._lock = threading.Lock()
+        self._waiting = False
+        self._closed = False
+
+        database = collection.database
+        self._connection = psycopg2.connect(**dict(database.client.kwargs, database=database.name))
+        try:
+            self._connection.autocommit = True
+            database.client.json_codec.register(self._connection)
+            with self._connection.cursor() as cursor:
+                # Listen first, so that no change falls between the replay and the notifications
+                cursor.execute('LISTEN {}'.format(quote_ident(watch_channel(collection.name), cursor)))
+                if resume_after is not None:
+                    cursor.execute(REPLAY_QUERY, [collection.name, resume_after])
+                    for seq, operation, _id, document in cursor:
+                        self._last_seq = seq
+                        self._events.append(self._event(seq, operation, _id, document))
+        except BaseException:
+            self._connection.close()
+            raise
+
+    @property
+    def resume_token(self):
+        """
+        Token of the last change returned, to pass as ``resume_after``
+        """
+        return self._resume_token
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            event = self.try_next(self.poll_interval)
+            if event is not None:
+                return event
+            if self._closed:
+                raise StopIteration
+    next = __next__
+
+    def try_next(self, timeout=0):
+        """
+        Return the next change, or None if there is none within ``timeout`` seconds
+        """
+        if not self._events:
+            self._wait(timeout)
+        if not self._events:
+            return None
+        event = self._events.popleft()
+        self._resume_token = event['_id']
+        return event
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._waiting:
+                # The waiting thread closes the connection when it wakes up
+                return
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _wait(self, timeout):
+        with self._lock:
+            if self._closed:
+                return
+            self._waiting = True
+        try:
+            connection = self._connection
+            if not connection.notifies and select.select([connection], [], [], timeout)[0]:
+                connection.poll()
+            while connection.notifies:
+                self._receive(connection.notifies.pop(0).payload)
+        finally:
+            with self._lock:
+                self._waiting = False
+                closed = self._closed
+            if closed:
+                self._connection.close()
+
+    def _receive(self, payload):
+        change = self.collection._codec.loads(payload)
+        seq = change['seq']
+        if self._last_seq is not None and seq <= self._last_seq:
+            # Already replayed from the change log
+            return
+        self._last_seq = seq
+        if 'document' in change:
+            document = change['document']
+        elif change['operation'] == 'delete':
+            document = None
+        else:
+            document = self._read_document(seq)
+        self._events.append(self._event(seq, change['operation'], change['id'], document))
+
+    def _read_document(self, seq):
+        with self._connection.cursor() as cursor:
+            cursor.execute(DOCUMENT_QUERY, [seq])
+            row = cursor.fetchone()
+        if row is None:
+            log.warning("change %d was pruned from the change log before it was read", seq)
+            return None
+        return row[0]
+
+    def _event(self, seq, operation, _id, document):
+        return change_event(self.collection.database.name, self.collection.name, seq, operation, _id, document)
@@ -16,13 +16,49 @@
 
 from __future__ import absolute_import
 
+import threading
+
+import psycopg2
+
+from pymongres.cache import CacheInvalidator
+from pymongres.catalog import Catalog
 from pymongres.database import Database
+from pymongres.json_adapters import default_codec
+from pymongres.monitoring import counting_loads, Monitor
+from pymongres.pool import ConnectionPool
 
 
 class MongresClient(object):
 
-    def __init__(self, **kwargs):
+    def __init__(self, min_pool_size=0, max_pool_size=10, max_idle_time=None,
+                 wait_queue_timeout=None, max_prepared_statements=256,
+                 catalog_ttl=None, json_codec=None, event_listeners=None,
+                 redact_params=False, **kwargs):
         self.kwargs = kwargs
+        self.json_codec = json_codec if json_codec is not None else default_codec()
+        self.pool_options = {
+            'min_size': min_pool_size,
+            'max_size': max_pool_size,
+            'max_idle_time': max_idle_time,
+            'wait_queue_timeout': wait_queue_timeout,
+            'max_prepared_statements': max_prepared_statements,
+        }
+        self._pools = {}
+        self._catalog = Catalog(ttl=catalog_ttl)
+        self._pools_lock = threading.Lock()
+        self._monitor = Monitor(event_listeners, redact_params)
+        self._result_caches = {}
+        self._invalidators = {}
+        self._caches_lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """
+        Register a :class:`~pymongres.monitoring.CommandListener`
+        """
+        self._monitor.add_listener(listener)
+
+    def remove_listener(self, listener):
+        self._monitor.remove_listener(listener)
 
     def __getattr__(self, name):
         return self._get_database(name)
@@ -32,3 +68,85 @@ class MongresClient(object):
 
     def _get_database(self, name):
         return Database(self, name)
+
+    def _get_pool(self, database_name):
+        """
+        Return the connection pool for a database, creating it on first use
+        """
+        pool = self._pools.get(database_name)
+        if pool is None:
+            with self._pools_lock:
+                pool = self._pools.get(database_name)
+                if pool is None:
+                    kwargs = dict(self.kwargs, database=database_name)
+                    kwargs.update(self.pool_options)
+                    pool = self._pools[database_name] = ConnectionPool(
+                        configure=self._configure_connection, **kwargs
+                    )
+        return pool
+
+    def _configure_connection(self, connection):
+        connection.loads = counting_loads(self._monitor, connection, self.json_codec.loads)
+        self.json_codec.register(connection, connection.loads)
+
+    def _result_cache(self, database_name, collection_name):
+        return self._result_caches.get((database_name, collection_name))
+
+    def _enable_cache(self, database_name, collection_name, cache, notify):
+        invalidator = None
+        with self._caches_lock:
+            self._result_caches[(database_name, collection_name)] = cache
+            if notify and database_name not in self._invalidators:
+                invalidator = self._invalidators[database_name] = CacheInvalidator(
+                    connect=lambda: psycopg2.connect(**dict(self.kwargs, database=database_name)),
+                    on_notify=lambda name: self._invalidate_cache(database_name, name),
+                    on_reset=lambda: self._invalidate_cache(database_name),
+                )
+        if invalidator is not None:
+            # Outside of the lock, which invalidations need
+            invalidator.start()
+
+    def _disable_cache(self, database_name, collection_name):
+        with self._caches_lock:
+            self._result_caches.pop((database_name, collection_name), None)
+
+    def _invalidate_cache(self, database_name, collection_name=None):
+        with self._caches_lock:
+            caches = [
+                cache for (database, collection), cache in self._result_caches.items()
+                if database == database_name and collection_name in (None, collection)
+            ]
+        for cache in caches:
+            cache.invalidate()
+
+    def cache_stats(self):
+        """
+        Return result cache statistics, keyed by "database.collection"
+        """
+        with self._caches_lock:
+            caches = list(self._result_caches.items())
+        return dict(
+            ('{}.{}'.format(database, collection), cache.stats())
+            for (database, collection), cache in caches
+        )
+
+    def pool_stats(self):
+        """
+        Return connection pool statistics, keyed by database name
+        """
+        with self._pools_lock:
+            pools = list(self._pools.items())
+        return dict((name, pool.stats()) for name, pool in pools)
+
+    def close(self):
+        """
+        Close all pooled connections
+        """
+        with self._caches_lock:
+            invalidators, self._invalidators = self._invalidators, {}
+        for invalidator in invalidators.values():
+            invalidator.stop()
+        with self._pools_lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.close()
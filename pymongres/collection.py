@@ -16,15 +16,34 @@
 
 from __future__ import absolute_import
 
-from datetime import datetime
-
-from six import iteritems
-
-from psycopg2.extensions import QuotedString
-
-from pymongres.errors import InvalidName
-from pymongres.json_adapters import Json
+from contextlib import contextmanager
+from itertools import groupby, islice
+import json
+
+from six import StringIO
+
+import psycopg2
+from psycopg2.errorcodes import INVALID_COLUMN_REFERENCE, INVALID_PARAMETER_VALUE, UNDEFINED_OBJECT
+from psycopg2.extensions import quote_ident, TRANSACTION_STATUS_INERROR
+from psycopg2.extras import execute_values
+
+from pymongres.errors import BulkInsertError, BulkWriteError, InvalidName, OperationFailure
+from pymongres import query
+from pymongres.aggregation import compile_pipeline
+from pymongres.cache import freeze, NOTIFY_FUNCTION, NOTIFY_TRIGGER, ResultCache
+from pymongres.changes import (
+    ChangeStream,
+    CREATE_CHANGES_TABLE,
+    UNWATCH_TRIGGER,
+    WATCH_FUNCTION,
+    watch_trigger,
+)
+from pymongres.jsonl import COPY_OPTIONS, line_counter, LineBatches, STAGING_TABLE
+from pymongres.loader import DEFAULT_MAX_BATCH_SIZE, DocumentLoader
+from pymongres.operations import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateOne
+from pymongres.query import build_column, Projection, short_identifier
 from pymongres.resultset import ResultSet
+from pymongres.results import BulkWriteResult, UpdateResult
 
 
 import logging
@@ -38,6 +57,22 @@ except NameError:
     basestring = unicode = str
 
 
+# Number of documents sent per statement by bulk inserts
+DEFAULT_BATCH_SIZE = 1000
+
+# Batches at least this large are loaded with COPY instead of INSERT
+COPY_THRESHOLD = 10000
+
+ASCENDING = 1
+DESCENDING = -1
+
+# Name reported for the primary key index, as in MongoDB
+ID_INDEX_NAME = '_id_'
+
+# Index key covering every field of the documents
+WILDCARD_KEY = '$**'
+
+
 class Collection(object):
 
     def __init__(self, database, name):
@@ -64,198 +99,867 @@ class Collection(object):
     def __ne__(self, other):
         return not self == other
 
-    def insert(self, doc_or_docs, manipulate=False):
+    def insert(self, doc_or_docs, manipulate=False, ordered=True,
+               batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Insert a document or an iterable of documents
+
+        Multiple documents are sent in batches of ``batch_size`` within a
+        single transaction, and their ids are returned in input order. With
+        ``ordered=True`` the first failure aborts the whole insert. With
+        ``ordered=False`` bad documents are skipped, the others are
+        committed, and a :class:`BulkInsertError` reports the failures.
+        """
         assert manipulate == False  # SON manipulators are not supported
         if isinstance(doc_or_docs, dict):
             return self._insert_single(doc_or_docs)
         else:
-            return self._insert_multi(doc_or_docs)
+            return self._insert_multi(doc_or_docs, ordered, batch_size)
+
+    def _insert_multi(self, documents, ordered=True, batch_size=DEFAULT_BATCH_SIZE):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
 
-    def _insert_multi(self, documents):
         res = []
-        for document in documents:
-            _id = self._insert_single(document)
-            res.append(_id)
+        errors = []
+        documents = iter(documents)
+        with self._write('insert') as op:
+            with op.connection.cursor() as cursor:
+                while True:
+                    batch = list(islice(documents, batch_size))
+                    if not batch:
+                        break
+                    offset = len(res)
+                    if ordered:
+                        res.extend(self._insert_batch(op, cursor, self._encode_batch(batch)))
+                    else:
+                        ids, batch_errors = self._insert_batch_unordered(op, cursor, batch)
+                        res.extend(ids)
+                        errors.extend((offset + index, exc) for index, exc in batch_errors)
+
+        if errors:
+            raise BulkInsertError(res, errors)
         return res
 
+    @property
+    def _codec(self):
+        return self.database.client.json_codec
+
+    def _operation(self, name):
+        return self.database._operation(self.name, name)
+
+    @contextmanager
+    def _write(self, name):
+        """
+        Run an operation modifying the collection, invalidating its cache
+        """
+        try:
+            with self._operation(name) as op:
+                yield op
+        finally:
+            cache = self._cache
+            if cache is not None:
+                cache.invalidate()
+
+    @property
+    def _cache(self):
+        return self.database.client._result_cache(self.database.name, self.name)
+
+    def _cached(self, key, compute):
+        cache = self._cache
+        if cache is None:
+            return compute()
+        return cache.fetch(key, compute)
+
+    def enable_cache(self, max_size=1024, ttl=60, notify=False):
+        """
+        Cache the results of find_one() and count() on this collection
+
+        At most ``max_size`` results are kept, each for ``ttl`` seconds
+        (None for no expiry). The cache is invalidated whenever this client
+        writes to the collection. With ``notify=True``, a trigger makes
+        PostgreSQL notify every write, from any client, and the cache is
+        also invalidated by these notifications.
+        """
+        if notify:
+            with self._operation('enable_cache') as op:
+                with op.connection.cursor() as cursor:
+                    op.execute(cursor, NOTIFY_FUNCTION)
+                    op.execute(cursor, NOTIFY_TRIGGER.format(collection=self.name))
+        self.database.client._enable_cache(
+            self.database.name, self.name, ResultCache(max_size, ttl), notify
+        )
+
+    def disable_cache(self):
+        self.database.client._disable_cache(self.database.name, self.name)
+
+    def cache_stats(self):
+        """
+        Return the hit, miss, eviction and invalidation counts of the cache
+        """
+        cache = self._cache
+        return None if cache is None else cache.stats()
+
+    def watch(self, resume_after=None, poll_interval=1.0):
+        """
+        Return a ChangeStream of the inserts, updates and deletes on this collection
+
+        The first call installs a trigger that records every change in a
+        change log and notifies it, whatever the client. Changes are
+        yielded once committed, as events with the ``operationType``,
+        ``documentKey`` and ``fullDocument`` (None for deletes) of the
+        change. The ``_id`` of an event is a resume token: a stream opened
+        with ``resume_after`` first replays the changes recorded since.
+        Changes are numbered at commit, so that the commits of transactions
+        writing to watched collections are serialized.
+        Closing the stream may take up to ``poll_interval`` seconds when it
+        is being iterated in another thread.
+        """
+        self._install_watch_trigger()
+        return ChangeStream(self, resume_after, poll_interval)
+
+    def _install_watch_trigger(self):
+        with self._operation('watch') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, CREATE_CHANGES_TABLE)
+                op.execute(cursor, WATCH_FUNCTION)
+                op.execute(cursor, watch_trigger(self.name))
+
+    def unwatch(self):
+        """
+        Remove the trigger installed by watch(), leaving the change log as is
+        """
+        with self._operation('unwatch') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, UNWATCH_TRIGGER.format(collection=self.name))
+
+    def prune_changes(self, resume_token):
+        """
+        Delete the changes up to a resume token from the change log
+
+        Streams can no longer resume from before that change. Returns the
+        number of changes deleted.
+        """
+        with self._operation('prune_changes') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(
+                    cursor,
+                    'DELETE FROM pymongres_changes WHERE collection = %s AND seq <= %s',
+                    [self.name, resume_token],
+                )
+                return cursor.rowcount
+
+    def _encode_batch(self, batch):
+        dumps = self._codec.dumps
+        return [dumps(document) for document in batch]
+
+    def _insert_batch(self, op, cursor, encoded):
+        if len(encoded) >= COPY_THRESHOLD:
+            return self._copy_batch(op, cursor, encoded)
+        sql_query = 'INSERT INTO {} (data) VALUES %s RETURNING (id)'.format(self.name)
+        rows = op.call(
+            cursor, sql_query, execute_values,
+            cursor, sql_query, [(data,) for data in encoded],
+            page_size=len(encoded),
+            fetch=True,
+        )
+        return [_id for _id, in rows]
+
+    def _copy_batch(self, op, cursor, encoded):
+        """
+        Load a batch with COPY, using ids allocated beforehand from the
+        table sequence since COPY cannot return them
+        """
+        op.execute(
+            cursor,
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            (self.name, len(encoded)),
+        )
+        ids = sorted(_id for _id, in op.fetchall(cursor))
+        buf = StringIO()
+        for _id, data in zip(ids, encoded):
+            buf.write(u'{}\t{}\n'.format(_id, _copy_escape(data)))
+        buf.seek(0)
+        sql_query = 'COPY {} (id, data) FROM STDIN'.format(self.name)
+        op.call(cursor, sql_query, cursor.copy_expert, sql_query, buf)
+        return ids
+
+    def _insert_batch_unordered(self, op, cursor, batch):
+        """
+        Insert a batch, falling back to one document at a time (each in its
+        own savepoint) to isolate the failing ones
+        """
+        encoded = []
+        errors = []
+        for index, document in enumerate(batch):
+            try:
+                encoded.append(self._codec.dumps(document))
+            except Exception as exc:
+                encoded.append(None)
+                errors.append((index, exc))
+
+        if not errors:
+            try:
+                cursor.execute('SAVEPOINT pymongres_batch')
+                ids = self._insert_batch(op, cursor, encoded)
+                cursor.execute('RELEASE SAVEPOINT pymongres_batch')
+                return ids, errors
+            except psycopg2.Error:
+                cursor.execute('ROLLBACK TO SAVEPOINT pymongres_batch')
+
+        ids = []
+        for index, data in enumerate(encoded):
+            if data is None:
+                ids.append(None)
+                continue
+            try:
+                cursor.execute('SAVEPOINT pymongres_document')
+                op.execute(
+                    cursor,
+                    'INSERT INTO {} (data) VALUES (%s) RETURNING (id)'.format(self.name),
+                    [data]
+                )
+                _id, = op.fetchone(cursor)
+                cursor.execute('RELEASE SAVEPOINT pymongres_document')
+            except psycopg2.Error as exc:
+                cursor.execute('ROLLBACK TO SAVEPOINT pymongres_document')
+                _id = None
+                errors.append((index, exc))
+            ids.append(_id)
+        errors.sort(key=lambda error: error[0])
+        return ids, errors
+
     def _insert_single(self, document):
-        with self.database.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(
+        with self._write('insert') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(
+                    cursor,
                     'INSERT INTO {} (data) VALUES (%s) RETURNING (id)'.format(self.name),
-                    [Json(document)]
+                    [self._codec.adapt(document)]
                 )
-                _id, = cursor.fetchone()
+                _id, = op.fetchone(cursor)
                 return _id
 
-    def find_one(self, spec=None, fields=None):
-        sql_query = self._find_query(spec)
+    def find_one(self, spec=None, fields=None, document_class=dict):
+        """
+        Return the first matching document, or None
+
+        With ``document_class=RawDocument``, the document is returned
+        undecoded and only decoded when its fields are accessed.
+        """
+        return self._cached(
+            ('find_one', freeze(spec), freeze(fields), None, document_class),
+            lambda: self._find_one(spec, fields, document_class),
+        )
+
+    def _find_one(self, spec, fields, document_class=dict):
+        projection = Projection.from_fields(fields, document_class)
+        sql_query, params = self._find_query(spec, projection=projection, limit=1)
 
-        with self.database.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(sql_query)
-                row = cursor.fetchone()
+        with self._operation('find_one') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, sql_query, params, prepared=True)
+                row = op.fetchone(cursor)
                 if row is None:
                     return None
                 else:
-                    return self._document_from_row(row, fields=fields)
+                    return projection.document(row, self._loads(op, projection))
 
-    def _find_query(self, spec, order_by=None):
-        sql_query = 'SELECT * FROM {collection}{where}{sort}'.format(
-            collection=self.name,
-            where=self._build_where_clause(spec),
-            sort=self._build_order_by_clause(order_by),
-        )
-        log.debug(sql_query)
-        return sql_query
+    def batch(self, fields=None, document_class=dict, window=None,
+              max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        """
+        Return a DocumentLoader, which batches lookups of documents by _id
+
+        Lookups queued in a ``with`` block are sent in a single query::
+
+            with posts.batch() as batch:
+                pending = [batch.load(_id) for _id in ids]
+            documents = [document.result() for document in pending]
+
+        With a ``window`` in seconds, a loader shared by many threads
+        coalesces the find_one() calls made within that time.
+        """
+        return DocumentLoader(self, fields, document_class, window, max_batch_size)
+
+    def _find_by_ids(self, ids, fields=None, document_class=dict):
+        """
+        Return a dict of the documents with the given ids, by _id
+        """
+        projection = Projection.from_fields(fields, document_class)
+        sql_query = query.compile_find_by_ids(self.name, projection)
+
+        with self._operation('find_by_ids') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, sql_query, [ids], prepared=True)
+                loads = self._loads(op, projection)
+                return dict((row[0], projection.document(row[1:], loads)) for row in op.fetchall(cursor))
+
+    def _loads(self, op, projection):
+        # Raw documents are decoded after the operation, outside its statistics
+        if projection.raw:
+            return self._codec.loads
+        return op.connection.loads
+
+    def _find_query(self, spec, order_by=None, projection=None, **kwargs):
+        return query.compile_find(self.name, spec, order_by, projection, codec=self._codec, **kwargs)
 
     def _count_query(self, spec):
-        sql_query = 'SELECT COUNT(*) FROM {collection}{where}'.format(
-            collection=self.name,
-            where=self._build_where_clause(spec),
-        )
-        log.debug(sql_query)
-        return sql_query
+        return query.compile_count(self.name, spec, self._codec)
 
-    @staticmethod
-    def _build_where_clause(spec):
-        if spec is None:
-            spec = {}
-
-        filters = []
-        for key, value in spec.items():
-            column = Collection._build_column(key)
-            predicate = Collection._build_where_predicate(value)
-            clause = "{} {}".format(column, predicate)
-            filters.append(clause)
-
-        if filters:
-            return ' WHERE {}'.format('AND'.join(filters))
-        else:
-            return ''
+    def find(self, spec=None, fields=None, document_class=dict):
+        return ResultSet(self, spec, fields, document_class=document_class)
 
-    @staticmethod
-    def _build_column(key):
-        if key == '_id':
-            return "id"
-        else:
-            return "data->>{}".format(quoted(key))
+    def count(self):
+        """
+        Return the number of documents in the collection
+        """
+        return self._cached(('count', freeze(None)), lambda: self._count(None))
 
-    @staticmethod
-    def _build_where_predicate(value):
-        if isinstance(value, dict):
-            assert len(value) == 1
-            op, value = next(iteritems(value))
-            if op == '$lt':
-                return "< {}".format(quoted(value))
-            elif op == '$lte':
-                return "<= {}".format(quoted(value))
-            elif op == '$gt':
-                return "> {}".format(quoted(value))
-            elif op == '$gte':
-                return ">= {}".format(quoted(value))
-            else:
-                raise Exception("Unsupported operator %s" % op)
-        else:
-            return "= {}".format(quoted(value))
+    def _count(self, spec):
+        sql_query, params = self._count_query(spec)
 
-    @staticmethod
-    def _build_order_by_clause(key):
-        if key is None:
-            return ''
-        column = Collection._build_column(key)
-        return ' ORDER BY {}'.format(column)
+        with self._operation('count') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, sql_query, params, prepared=True)
+                count, = op.fetchone(cursor)
 
-    @staticmethod
-    def _document_from_row(row, fields=None):
-        _id, data = row
-        return Collection._filter_document(_id, data, fields)
+        return count
 
-    @staticmethod
-    def _filter_document(_id, data, fields=None):
-        if fields is None:
-            data['_id'] = _id
-            return data
-        elif isinstance(fields, dict):
-            return Collection._filter_document_by_dict(_id, data, fields)
-        else:
-            return Collection._filter_document_by_list(_id, data, fields)
+    def _id_bounds(self, spec):
+        """
+        Return the lowest and highest ids of the documents matching a spec
+        """
+        where, params = query.compile_where(spec, self._codec)
+        sql_query = 'SELECT MIN(id), MAX(id) FROM {}{}'.format(self.name, where)
 
-    @staticmethod
-    def _filter_document_by_list(_id, data, fields=None):
+        with self._operation('id_bounds') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, sql_query, params, prepared=True)
+                return op.fetchone(cursor)
+
+    def aggregate(self, pipeline):
+        """
+        Run an aggregation pipeline as one SQL statement
+
+        The pipeline is evaluated by PostgreSQL and the list of resulting
+        documents is returned.
+        """
+        sql_query, params = compile_pipeline(self.name, pipeline, self._codec)
+        log.debug('%s %r', sql_query, params)
+
+        with self._operation('aggregate') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, sql_query, params, prepared=True)
+                return [data for data, in op.fetchall(cursor)]
+
+    def create_index(self, key_or_list, unique=False, sparse=False, name=None):
+        """
+        Create a B-tree index on one or more document keys
+
+        Keys are indexed through the same expressions as those produced by
+        the query builder, so that comparisons and string equalities on them
+        can use the index. Other equalities compile to containment tests,
+        which only the wildcard index serves.
+        Sparse indexes only contain documents that have one of the keys.
+        The wildcard key ``'$**'`` creates a GIN index on whole documents
+        instead, which serves equality filters on any key.
+        Creating an existing index again does nothing, unless the options
+        differ, which raises OperationFailure. Returns the name of the index.
+        """
+        keys = _index_keys(key_or_list)
+        if name is None:
+            name = _index_name(keys)
+
+        if WILDCARD_KEY in (key for key, _ in keys):
+            if keys != [(WILDCARD_KEY, ASCENDING)] or unique or sparse:
+                raise ValueError("wildcard indexes must be ascending, single-key, non-unique and non-sparse")
+            return self._create_index(name, 'USING gin (data jsonb_path_ops)', {
+                'key': keys, 'unique': False, 'sparse': False,
+            })
+
+        columns = []
+        for key, direction in keys:
+            column = build_column(key)
+            if key != '_id':
+                column = '({})'.format(column)
+            columns.append('{} {}'.format(column, 'ASC' if direction == ASCENDING else 'DESC'))
+
+        where = ''
+        if sparse:
+            where = ' WHERE {}'.format(' OR '.join(
+                '{} IS NOT NULL'.format(build_column(key)) for key, _ in keys
+            ))
+
+        definition = '({}){}'.format(', '.join(columns), where)
+        return self._create_index(name, definition, {
+            'key': keys, 'unique': unique, 'sparse': sparse,
+        })
+
+    def _create_index(self, name, definition, info):
+        info = dict(info, name=name)
+        with self._operation('create_index') as op:
+            with op.connection.cursor() as cursor:
+                index = quote_ident(self._index_relname(name), cursor)
+                op.execute(
+                    cursor,
+                    "SELECT to_regclass(%s) IS NOT NULL, obj_description(to_regclass(%s), 'pg_class')",
+                    [index, index],
+                )
+                exists, comment = op.fetchone(cursor)
+                if exists:
+                    # Leave the index and its description as they are
+                    if comment is not None and json.loads(comment) != json.loads(json.dumps(info)):
+                        raise OperationFailure(
+                            "index with name [{}] already exists with different options".format(name)
+                        )
+                    return name
+
+                sql_query = 'CREATE {unique}INDEX IF NOT EXISTS {index} ON {collection} {definition}'.format(
+                    unique='UNIQUE ' if info['unique'] else '',
+                    index=index,
+                    collection=self.name,
+                    definition=definition,
+                )
+                log.debug(sql_query)
+                op.execute(cursor, sql_query)
+                op.execute(cursor, 'COMMENT ON INDEX {} IS %s'.format(index), [json.dumps(info)])
+        return name
+
+    def ensure_index(self, key_or_list, **kwargs):
+        """
+        Deprecated alias of create_index, which is already idempotent
+        """
+        return self.create_index(key_or_list, **kwargs)
+
+    def drop_index(self, index_or_name):
+        """
+        Drop an index, given its name or the key specification it was
+        created with
         """
-        Exclusive list of fields to include
+        name = index_or_name
+        if not isinstance(name, basestring):
+            name = _index_name(_index_keys(name))
+        if name == ID_INDEX_NAME:
+            raise OperationFailure("cannot drop _id index")
+
+        try:
+            with self._operation('drop_index') as op:
+                with op.connection.cursor() as cursor:
+                    op.execute(cursor, 'DROP INDEX {}'.format(
+                        quote_ident(self._index_relname(name), cursor)
+                    ))
+        except psycopg2.Error as exc:
+            if exc.pgcode == UNDEFINED_OBJECT:
+                raise OperationFailure("index not found with name [{}]".format(name))
+            raise
+
+    def drop_indexes(self):
+        """
+        Drop all indexes but the one on _id
+        """
+        for name in self.index_information():
+            if name != ID_INDEX_NAME:
+                self.drop_index(name)
 
-        Note: _id is always included in this case
+    def index_information(self):
+        """
+        Return a dictionary describing the indexes created on the collection
+        """
+        sql_query = """
+            SELECT ix.indisprimary, obj_description(ix.indexrelid, 'pg_class')
+            FROM pg_index ix
+            WHERE ix.indrelid = %s::regclass
         """
+        with self._operation('index_information') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, sql_query, [self.name])
+                rows = op.fetchall(cursor)
+
         res = {}
-        for field in fields:
-            if field == '_id':
+        for primary, comment in rows:
+            if primary:
+                res[ID_INDEX_NAME] = {'key': [('_id', ASCENDING)], 'unique': True}
                 continue
-            path = field.split('.')
-            source, target = data, res
-            if len(path) > 1:
-                for item in path[:-1]:
-                    source = source[item]
-                    target = target.setdefault(item, {})
-            name = path[-1]
-            target[name] = source[name]
-        res['_id'] = _id
+            try:
+                info = json.loads(comment)
+            except (TypeError, ValueError):
+                continue  # not created by create_index
+            res[info.pop('name')] = {
+                'key': [tuple(item) for item in info['key']],
+                'unique': info['unique'],
+                'sparse': info['sparse'],
+            }
         return res
 
-    @staticmethod
-    def _filter_document_by_dict(_id, data, fields=None):
+    def _index_relname(self, name):
+        # Index names are per schema in PostgreSQL, and per collection in MongoDB
+        return short_identifier(u'{}_{}'.format(self.name, name))
+
+    def _index_name_of(self, relname):
+        """
+        Return the name of an index given its PostgreSQL name
+        """
+        if relname == '{}_pkey'.format(self.name):
+            return ID_INDEX_NAME
+        prefix = '{}_'.format(self.name)
+        if relname.startswith(prefix):
+            return relname[len(prefix):]
+        return relname
+
+    def distinct(self, key, spec=None):
         """
-        Exclusive list of fields to include
+        Return the list of distinct values of a key, in ascending jsonb order
         """
-        data['_id'] = _id
-        for field, include in iteritems(fields):
-            if not include:
-                path = field.split('.')
-                target = data
-                if len(path) > 1:
-                    for item in path[:-1]:
-                        target = target[item]
-                name = path[-1]
-                del target[name]
-        return data
+        sql_query, params = query.compile_distinct(self.name, key, spec, self._codec)
 
-    def find(self, spec=None, fields=None):
-        return ResultSet(self, spec, fields)
+        with self._operation('distinct') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, sql_query, params, prepared=True)
+                return [value for value, in op.fetchall(cursor)]
 
-    def count(self):
-        """
-        Return the number of documents in the collection
+    def estimated_document_count(self):
         """
+        Return an estimate of the number of documents in the collection
 
-        sql_query = 'SELECT COUNT(*) FROM {}'.format(self.name)
+        The estimate comes from planner statistics, scaled to the current
+        size of the table as the planner does, so it takes constant time.
+        Tables without statistics are counted exactly: before PostgreSQL
+        14, a table that was never analyzed reports 0 rows and 0 pages.
+        """
+        sql_query = """
+            SELECT
+                CASE WHEN relpages > 0 AND reltuples >= 0 THEN reltuples / relpages END,
+                pg_relation_size(oid) / current_setting('block_size')::int
+            FROM pg_class
+            WHERE oid = %s::regclass
+        """
+        with self._operation('estimated_document_count') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, sql_query, [self.name])
+                density, pages = op.fetchone(cursor)
+
+        if pages == 0:
+            return 0
+        if density is not None:
+            return int(round(density * pages))
+        return self.count()
+
+    def update_one(self, spec, document, upsert=False):
+        """
+        Update the first document matching the spec
 
-        with self.database.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(sql_query)
-                count, = cursor.fetchone()
+        ``document`` holds update operators (``$set``, ``$unset``, ``$inc``
+        and ``$push``), which are applied by the server in a single
+        statement. With ``upsert=True``, a document built from the spec
+        and the update (including ``$setOnInsert``) is inserted if none
+        matches, which requires a unique index on the keys of the spec.
+        """
+        if upsert:
+            return self._upsert('update_one', spec, document, replace=False)
+        return self._update('update_one', query.compile_update(self.name, spec, document, False, self._codec))
 
-        return count
+    def update_many(self, spec, document, upsert=False):
+        """
+        Update all the documents matching the spec
+        """
+        if upsert:
+            return self._upsert('update_many', spec, document, replace=False)
+        return self._update('update_many', query.compile_update(self.name, spec, document, True, self._codec))
 
-    def remove(self, spec):
+    def replace_one(self, spec, document, upsert=False):
         """
-        Remove documents from the collection
+        Replace the first document matching the spec, keeping its _id
+
+        Upserts have the same requirements as with update_one.
         """
-        sql_query = 'DELETE FROM {collection}{where}'.format(
-            collection=self.name,
-            where=self._build_where_clause(spec),
+        if upsert:
+            return self._upsert('replace_one', spec, document, replace=True)
+        return self._update('replace_one', query.compile_replace(self.name, spec, document, self._codec))
+
+    def _update(self, name, compiled):
+        with self._write(name) as op:
+            with op.connection.cursor() as cursor:
+                return self._execute_update(op, cursor, compiled)
+
+    def _upsert(self, name, spec, document, replace):
+        with self._write(name) as op:
+            with op.connection.cursor() as cursor:
+                return self._execute_upsert(op, cursor, spec, document, replace)
+
+    @staticmethod
+    def _execute_update(op, cursor, compiled):
+        sql_query, params = compiled
+        try:
+            op.execute(cursor, sql_query, params, prepared=True)
+        except psycopg2.Error as exc:
+            _check_push_error(exc)
+            raise
+        matched, modified = op.fetchone(cursor)
+        return UpdateResult(matched, modified)
+
+    def _execute_upsert(self, op, cursor, spec, document, replace):
+        sql_query, params = query.compile_upsert(self.name, spec, document, replace, self._codec)
+
+        try:
+            op.execute(cursor, sql_query, params, prepared=True)
+        except psycopg2.Error as exc:
+            if exc.pgcode == INVALID_COLUMN_REFERENCE:
+                raise OperationFailure("upsert requires a unique index on {}".format(
+                    ', '.join(sorted(spec))
+                ))
+            _check_push_error(exc)
+            raise
+
+        row = op.fetchone(cursor)
+        if row is None:
+            # The existing document already had the new contents
+            return UpdateResult(1, 0)
+        _id, inserted = row
+        if inserted:
+            if '_id' in spec:
+                self._advance_id_sequence(op, cursor, _id)
+            return UpdateResult(0, 0, upserted_id=_id)
+        return UpdateResult(1, 1)
+
+    def _advance_id_sequence(self, op, cursor, _id):
+        # An explicit id does not use the sequence, which must not hand it out later
+        op.execute(
+            cursor,
+            "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+            "GREATEST(%s, nextval(pg_get_serial_sequence(%s, 'id'))))",
+            [self.name, _id, self.name],
         )
-        log.debug(sql_query)
 
-        with self.database.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(sql_query)
+    def bulk_write(self, requests, ordered=True):
+        """
+        Apply a list of write operations in a single transaction
+
+        Consecutive InsertOne operations are sent in batches as with
+        insert(), and consecutive DeleteMany operations as a single DELETE.
+        With ``ordered=True`` the first failure rolls back the whole bulk
+        write. With ``ordered=False`` failing operations are skipped and
+        the others are committed. Failures are reported by a
+        :class:`BulkWriteError` giving the index of each failed operation.
+        """
+        result = BulkWriteResult()
+        errors = []
+        with self._write('bulk_write') as op:
+            with op.connection.cursor() as cursor:
+                for _, group in groupby(enumerate(requests), _bulk_group):
+                    group_errors = self._bulk_apply(op, cursor, list(group), result, ordered)
+                    if group_errors and ordered:
+                        # Raising rolls back the operations applied so far
+                        raise BulkWriteError(BulkWriteResult(), group_errors)
+                    errors.extend(group_errors)
+
+        if errors:
+            raise BulkWriteError(result, errors)
+        return result
+
+    def _bulk_apply(self, op, cursor, group, result, ordered):
+        """
+        Apply a group of consecutive operations, returning their errors
+        """
+        first = group[0][1]
+        if isinstance(first, InsertOne):
+            return self._bulk_insert(op, cursor, group, result, ordered)
+
+        if isinstance(first, DeleteMany) and len(group) > 1:
+            try:
+                sql_query, params = query.compile_delete_any(
+                    self.name, [request.spec for _, request in group], self._codec
+                )
+                cursor.execute('SAVEPOINT pymongres_bulk')
+                op.execute(cursor, sql_query, params)
+                deleted = cursor.rowcount
+                cursor.execute('RELEASE SAVEPOINT pymongres_bulk')
+            except Exception:
+                # Fall back to one statement per operation to find the culprits
+                if op.connection.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+                    cursor.execute('ROLLBACK TO SAVEPOINT pymongres_bulk')
+            else:
+                result.deleted_count += deleted
+                return []
+
+        errors = []
+        for index, request in group:
+            try:
+                if not ordered:
+                    cursor.execute('SAVEPOINT pymongres_bulk')
+                self._bulk_execute(op, cursor, index, request, result)
+                if not ordered:
+                    cursor.execute('RELEASE SAVEPOINT pymongres_bulk')
+            except Exception as exc:
+                errors.append((index, exc))
+                if ordered:
+                    break
+                cursor.execute('ROLLBACK TO SAVEPOINT pymongres_bulk')
+        return errors
+
+    def _bulk_insert(self, op, cursor, group, result, ordered):
+        errors = []
+        for start in range(0, len(group), DEFAULT_BATCH_SIZE):
+            batch = group[start:start + DEFAULT_BATCH_SIZE]
+            ids, batch_errors = self._insert_batch_unordered(op, cursor, [request.document for _, request in batch])
+            for (index, _), _id in zip(batch, ids):
+                if _id is not None:
+                    result.inserted_count += 1
+                    result.inserted_ids[index] = _id
+            errors.extend((batch[offset][0], exc) for offset, exc in batch_errors)
+            if errors and ordered:
+                return errors[:1]
+        return errors
+
+    def _bulk_execute(self, op, cursor, index, request, result):
+        if isinstance(request, DeleteOne):
+            sql_query, params = query.compile_delete(self.name, request.spec, self._codec, request.multi)
+            op.execute(cursor, sql_query, params, prepared=True)
+            result.deleted_count += cursor.rowcount
+        elif isinstance(request, UpdateOne):
+            if request.upsert:
+                res = self._execute_upsert(op, cursor, request.spec, request.document, replace=False)
+            else:
+                res = self._execute_update(op, cursor, query.compile_update(
+                    self.name, request.spec, request.document, request.multi, self._codec
+                ))
+            result._add_update(index, res)
+        elif isinstance(request, ReplaceOne):
+            if request.upsert:
+                res = self._execute_upsert(op, cursor, request.spec, request.document, replace=True)
+            else:
+                res = self._execute_update(op, cursor, query.compile_replace(
+                    self.name, request.spec, request.document, self._codec
+                ))
+            result._add_update(index, res)
+        else:
+            raise TypeError("{!r} is not a valid write operation".format(request))
+
+    def export_jsonl(self, fileobj, spec=None, progress=None,
+                     progress_interval=DEFAULT_BATCH_SIZE):
+        """
+        Write the documents matching the spec to a file, as JSON lines
+
+        Documents are streamed with COPY in _id order, each with its _id.
+        ``progress(count)`` is called every ``progress_interval``
+        documents. Returns the number of documents written.
+        """
+        sql_query, params = query.compile_export(self.name, spec, self._codec)
+        counter = line_counter(fileobj, progress_interval, progress)
+
+        with self._operation('export_jsonl') as op:
+            with op.connection.cursor() as cursor:
+                # COPY does not take parameters
+                copy_query = b'COPY (' + cursor.mogrify(sql_query, params) + \
+                    ' ) TO STDOUT WITH ({})'.format(COPY_OPTIONS).encode('ascii')
+                op.call(cursor, copy_query, cursor.copy_expert, copy_query, counter)
 
+        return counter.count
 
-def quoted(value, encoding='utf8'):
-    if isinstance(value, basestring):
-        return QuotedString(value).getquoted().decode(encoding)
-    elif isinstance(value, datetime):
-        return quoted(value.isoformat())
-    else:
-        return value
+    def import_jsonl(self, fileobj, batch_size=DEFAULT_BATCH_SIZE, progress=None,
+                     keep_ids=True):
+        """
+        Insert the documents read from a file of JSON lines
+
+        Each batch of ``batch_size`` lines is loaded with COPY into a
+        staging table and inserted from there, all in one transaction.
+        With ``keep_ids``, documents with an integer _id that fits the id
+        column, as written by export_jsonl(), keep it; they are inserted
+        first in each batch, and the others get new ids allocated past
+        them. Any other _id is ignored. Blank lines are skipped. ``progress(count)`` is called after each batch. Returns
+        the number of documents inserted.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+
+        copy_query = 'COPY {} (data) FROM STDIN WITH ({})'.format(STAGING_TABLE, COPY_OPTIONS)
+        insert_query = "INSERT INTO {} (data) SELECT data - '_id' FROM {} WHERE data IS NOT NULL".format(
+            self.name, STAGING_TABLE
+        )
+        if keep_ids:
+            # Only integers in the range of the id column are kept
+            kept = (
+                "CASE WHEN jsonb_typeof(data->'_id') = 'number'"
+                " THEN (data->>'_id')::numeric BETWEEN -2147483648 AND 2147483647"
+                " AND (data->>'_id')::numeric % 1 = 0 ELSE false END"
+            )
+            keep_query = (
+                "INSERT INTO {} (id, data) SELECT (data->>'_id')::numeric::integer, data - '_id' "
+                "FROM {} WHERE data IS NOT NULL AND {}"
+            ).format(self.name, STAGING_TABLE, kept)
+            insert_query += " AND NOT {}".format(kept)
+            # Ids given explicitly must not be allocated again
+            advance_query = "SELECT setval(%s, GREATEST(MAX(id), nextval(%s))) FROM {}".format(self.name)
+
+        batches = LineBatches(fileobj, batch_size)
+        count = 0
+        with self._write('import_jsonl') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, 'CREATE TEMPORARY TABLE {} (data jsonb) ON COMMIT DROP'.format(STAGING_TABLE))
+                op.execute(cursor, "SELECT pg_get_serial_sequence(%s, 'id')", [self.name])
+                sequence, = op.fetchone(cursor)
+                while batches.next_batch():
+                    op.call(cursor, copy_query, cursor.copy_expert, copy_query, batches)
+                    if keep_ids:
+                        op.execute(cursor, keep_query)
+                        count += cursor.rowcount
+                        op.execute(cursor, advance_query, [sequence, sequence])
+                    op.execute(cursor, insert_query)
+                    count += cursor.rowcount
+                    op.execute(cursor, 'TRUNCATE {}'.format(STAGING_TABLE))
+                    if progress is not None:
+                        progress(count)
+
+        return count
+
+    def remove(self, spec):
+        """
+        Remove documents from the collection
+        """
+        sql_query, params = query.compile_delete(self.name, spec, self._codec)
+
+        with self._write('remove') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, sql_query, params, prepared=True)
+
+
+def _check_push_error(exc):
+    # Raised by the array check of $push, the only use of jsonb_array_length() in updates
+    if exc.pgcode == INVALID_PARAMETER_VALUE and 'array length' in (exc.diag.message_primary or ''):
+        raise OperationFailure("$push requires the field to be missing or an array: {}".format(
+            exc.diag.message_primary
+        ))
+
+
+def _bulk_group(item):
+    # Batchable operations of the same kind share a group, others are alone
+    index, op = item
+    if getattr(op, 'batchable', False):
+        return type(op), None
+    return type(op), index
+
+
+def _index_keys(key_or_list):
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, ASCENDING)]
+    keys = []
+    for key, direction in key_or_list:
+        if direction not in (ASCENDING, DESCENDING):
+            raise ValueError("index direction must be ASCENDING (1) or DESCENDING (-1)")
+        keys.append((key, direction))
+    if not keys:
+        raise ValueError("key_or_list must not be empty")
+    return keys
+
+
+def _index_name(keys):
+    return '_'.join('{}_{}'.format(key, direction) for key, direction in keys)
+
+
+def _copy_escape(text):
+    """
+    Escape a value for the COPY text format
+    """
+    return (text.replace('\\', '\\\\')
+                .replace('\t', '\\t')
+                .replace('\n', '\\n')
+                .replace('\r', '\\r'))
@@ -16,8 +16,6 @@
 
 from __future__ import absolute_import
 
-import psycopg2
-
 from pymongres.collection import Collection
 
 
@@ -28,14 +26,44 @@ class Database(object):
         self.name = name
 
     def connection(self):
-        return psycopg2.connect(database=self.name, **self.client.kwargs)
+        """
+        Borrow a pooled connection for the duration of a ``with`` block
+        """
+        return self.client._get_pool(self.name).connection()
+
+    def _operation(self, collection, name):
+        """
+        Run a monitored operation on a pooled connection
+        """
+        return self.client._monitor.operation(self.client._get_pool(self.name), self.name, collection, name)
 
     def collection_names(self):
-        return [name for name in self._list_tables() if not name.startswith(('pg_', 'sql_'))]
+        return [name for name in self._list_tables() if not name.startswith(('pg_', 'sql_', 'pymongres_'))]
 
     def drop_collection(self, name):
         self._drop_table(name)
 
+    def migrate_to_jsonb(self):
+        """
+        Convert collections created with a json data column to jsonb
+
+        Returns the names of the converted collections.
+        """
+        with self._operation(None, 'migrate_to_jsonb') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(
+                    cursor,
+                    "SELECT table_name FROM information_schema.columns "
+                    "WHERE table_schema = current_schema() AND column_name = 'data' AND data_type = 'json'"
+                )
+                names = [row[0] for row in op.fetchall(cursor)]
+                for name in names:
+                    op.execute(cursor, "ALTER TABLE {} ALTER COLUMN data TYPE jsonb USING data::jsonb".format(name))
+        if names:
+            # Statements prepared on the json columns must not be reused
+            self.client._get_pool(self.name).reset_prepared_statements()
+        return names
+
     def __getattr__(self, name):
         return self._get_collection(name)
 
@@ -51,23 +79,32 @@ class Database(object):
                 cursor.execute("CREATE EXTENSION IF NOT EXISTS json")
 
     def _list_tables(self):
-        with self.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE'")
-                return [row[0] for row in cursor.fetchall()]
+        with self._operation(None, 'list_collections') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, "SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE'")
+                names = [row[0] for row in op.fetchall(cursor)]
+        self.client._catalog.load(self.name, names)
+        return names
 
     def _table_exists(self, name):
-        with self.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name=%s)", (name,))
-                return cursor.fetchone()[0]
+        """
+        Check the client's catalog cache, loading it on first use
+        """
+        tables = self.client._catalog.get(self.name)
+        if tables is None:
+            tables = self._list_tables()
+        return name in tables
 
     def _create_table(self, name):
-        with self.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("CREATE TABLE {} (id serial PRIMARY KEY, data json);".format(name))
+        with self._operation(name, 'create_collection') as op:
+            with op.connection.cursor() as cursor:
+                # Another client may have created it since the catalog was loaded
+                op.execute(cursor, "CREATE TABLE IF NOT EXISTS {} (id serial PRIMARY KEY, data jsonb);".format(name))
+        self.client._catalog.add(self.name, name)
 
     def _drop_table(self, name):
-        with self.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("DROP TABLE IF EXISTS {};".format(name))
+        with self._operation(name, 'drop_collection') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, "DROP TABLE IF EXISTS {};".format(name))
+        self.client._catalog.discard(self.name, name)
+        self.client._invalidate_cache(self.name, name)
@@ -23,3 +23,47 @@ class PyMongresError(Exception):
 
 class InvalidName(PyMongresError):
     pass
+
+
+class PoolTimeout(PyMongresError):
+    pass
+
+
+class PoolClosed(PyMongresError):
+    pass
+
+
+class BulkInsertError(PyMongresError):
+    """
+    Some documents of an unordered bulk insert could not be inserted
+
+    ``inserted_ids`` has one entry per input document (None for failed
+    ones) and ``errors`` is a list of ``(index, exception)`` pairs.
+    """
+
+    def __init__(self, inserted_ids, errors):
+        super(BulkInsertError, self).__init__(
+            "%d document(s) could not be inserted" % len(errors)
+        )
+        self.inserted_ids = inserted_ids
+        self.errors = errors
+
+
+class BulkWriteError(PyMongresError):
+    """
+    Some operations of a bulk write failed
+
+    ``result`` is the :class:`BulkWriteResult` of the operations that were
+    applied and ``errors`` is a list of ``(index, exception)`` pairs.
+    """
+
+    def __init__(self, result, errors):
+        super(BulkWriteError, self).__init__(
+            "%d operation(s) failed" % len(errors)
+        )
+        self.result = result
+        self.errors = errors
+
+
+class OperationFailure(PyMongresError):
+    pass
@@ -19,7 +19,8 @@ from __future__ import absolute_import
 from datetime import datetime
 import json
 
-from psycopg2.extras import Json as BaseJson
+from psycopg2.extras import Json
+from psycopg2.extras import register_default_json, register_default_jsonb
 
 
 class DateTimeEncoder(json.JSONEncoder):
@@ -30,8 +31,65 @@ class DateTimeEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-class Json(BaseJson):
+class JsonCodec(object):
+    """
+    Encoding and decoding of documents, based on the standard library
+
+    Subclasses can plug in other JSON libraries. Datetimes must be encoded
+    as ISO 8601 strings, like ``datetime.isoformat()`` does, so that
+    queries compare them consistently whatever the codec.
+    """
+
+    name = 'json'
+
     def dumps(self, obj):
         return json.dumps(obj, cls=DateTimeEncoder)
 
+    def loads(self, s):
+        return json.loads(s)
+
+    def adapt(self, obj):
+        """
+        Wrap a document to pass it as a query parameter
+        """
+        return Json(obj, dumps=self.dumps)
+
+    def register(self, conn_or_curs, loads=None):
+        """
+        Decode json and jsonb values read through a connection with this codec
+
+        ``loads`` can wrap the codec's own ``loads`` method.
+        """
+        loads = loads or self.loads
+        register_default_json(conn_or_curs, loads=loads)
+        register_default_jsonb(conn_or_curs, loads=loads)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    Codec based on the orjson library, which is implemented in Rust
+    """
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._dumps = orjson.dumps
+        self._loads = orjson.loads
+        self._options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        return self._dumps(obj, option=self._options).decode('utf8')
+
+    def loads(self, s):
+        return self._loads(s)
+
 
+def default_codec():
+    """
+    Return the fastest codec available
+    """
+    try:
+        return OrjsonCodec()
+    except ImportError:
+        return JsonCodec()
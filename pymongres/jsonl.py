@@ -0,0 +1,122 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Streaming of documents as JSON lines through COPY
+
+Lines go through COPY in CSV format with a quote and a delimiter that
+can never appear unescaped in JSON, so that they are passed verbatim in
+both directions, without any per-document processing in Python.
+"""
+
+from __future__ import absolute_import
+
+import io
+
+
+# Options making COPY read and write JSON lines as they are
+COPY_OPTIONS = "FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02'"
+
+STAGING_TABLE = 'pymongres_import'
+
+
+class LineCounter(object):
+    """
+    File-like object counting the lines written to another one
+
+    ``progress(count)`` is called every time ``interval`` more lines have
+    been written.
+    """
+
+    def __init__(self, fileobj, interval, progress=None):
+        self._file = fileobj
+        self._interval = interval
+        self._progress = progress
+        self._next = interval
+        self.count = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self.count += data.count(b'\n' if isinstance(data, bytes) else u'\n')
+        if self._progress is not None and self.count >= self._next:
+            self._next = self.count + self._interval
+            self._progress(self.count)
+
+
+class TextLineCounter(LineCounter, io.TextIOBase):
+    """
+    Line counter for text files, to which psycopg2 writes str
+    """
+
+    def write(self, data):
+        LineCounter.write(self, data)
+        return len(data)
+
+
+def line_counter(fileobj, interval, progress=None):
+    cls = TextLineCounter if isinstance(fileobj, io.TextIOBase) else LineCounter
+    return cls(fileobj, interval, progress)
+
+
+class LineBatches(object):
+    """
+    File-like object reading another one ``batch_size`` lines at a time
+
+    read() returns an empty string at the end of every batch, so that
+    each COPY loads one batch. Data is read in chunks rather than line by
+    line, and at most one chunk is held in memory.
+    """
+
+    def __init__(self, fileobj, batch_size, chunk_size=65536):
+        self._file = fileobj
+        self._batch_size = batch_size
+        self._chunk_size = chunk_size
+        self._pending = None
+        self._lines = 0
+        self.eof = False
+
+    def next_batch(self):
+        """
+        Start the next batch, returning False if there is none
+        """
+        self._lines = 0
+        if not self._pending:
+            self._pending = self._file.read(self._chunk_size)
+        if not self._pending:
+            self.eof = True
+        return not self.eof
+
+    def read(self, size=-1):
+        if self._lines >= self._batch_size:
+            return ''
+        chunk = self._pending or self._file.read(self._chunk_size)
+        self._pending = None
+        if not chunk:
+            self.eof = True
+            return chunk
+
+        newline = b'\n' if isinstance(chunk, bytes) else u'\n'
+        remaining = self._batch_size - self._lines
+        if chunk.count(newline) < remaining:
+            self._lines += chunk.count(newline)
+            return chunk
+
+        index = -1
+        for _ in range(remaining):
+            index = chunk.index(newline, index + 1)
+        self._pending = chunk[index + 1:]
+        self._lines = self._batch_size
+        return chunk[:index + 1]
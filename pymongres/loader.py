@@ -0,0 +1,147 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batched lookups of documents by _id, see Collection.batch
+"""
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+import numbers
+import threading
+
+
+# Maximum number of ids looked up by one query
+DEFAULT_MAX_BATCH_SIZE = 1000
+
+
+class PendingDocument(object):
+    """
+    Result of a lookup queued by a DocumentLoader
+    """
+
+    __slots__ = ('_loader', '_id', '_done', '_document', '_error')
+
+    def __init__(self, loader, _id):
+        self._loader = loader
+        self._id = _id
+        self._done = threading.Event()
+        self._document = None
+        self._error = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """
+        Return the document, or None if there is none with this _id
+
+        With a time window, the lookups queued in the meantime are sent
+        along once it is over. Otherwise, the pending lookups are sent
+        right away.
+        """
+        if not self._done.is_set():
+            if self._loader.window:
+                self._done.wait(self._loader.window)
+            if not self._done.is_set():
+                self._loader.dispatch()
+                # Another thread may be running the query of this lookup
+                self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._document
+
+    def _resolve(self, document=None, error=None):
+        self._document = document
+        self._error = error
+        self._done.set()
+
+
+class DocumentLoader(object):
+    """
+    Coalesce lookups of documents by _id into one query per batch
+
+    load() queues a lookup and returns a PendingDocument. The queued ids
+    are deduplicated, and looked up together with ``id = ANY(...)`` when
+    a result is first needed, when ``max_batch_size`` ids are queued, or
+    when the ``with`` block of the loader ends. With a ``window`` (in
+    seconds), find_one() may be called from many threads: a result waits
+    for up to that long for other lookups to share the query with.
+
+    Lookups of the same _id in a batch share the same document object.
+    """
+
+    def __init__(self, collection, fields=None, document_class=dict, window=None,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.collection = collection
+        self.fields = fields
+        self.document_class = document_class
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+
+    def load(self, _id):
+        """
+        Queue the lookup of a document by _id, and return a PendingDocument
+        """
+        if not isinstance(_id, numbers.Integral):
+            raise TypeError("_id must be an integer")
+        with self._lock:
+            pending = self._pending.get(_id)
+            if pending is None:
+                pending = self._pending[_id] = PendingDocument(self, _id)
+            full = len(self._pending) >= self.max_batch_size
+        if full:
+            self.dispatch()
+        return pending
+
+    def load_many(self, ids):
+        """
+        Return the documents with the given ids, in order (None if missing)
+        """
+        pending = [self.load(_id) for _id in ids]
+        return [document.result() for document in pending]
+
+    def find_one(self, _id):
+        return self.load(_id).result()
+
+    def dispatch(self):
+        """
+        Look up the queued ids now
+        """
+        with self._lock:
+            batch, self._pending = self._pending, OrderedDict()
+        if not batch:
+            return
+        try:
+            documents = self.collection._find_by_ids(list(batch), self.fields, self.document_class)
+        except BaseException as error:
+            for pending in batch.values():
+                pending._resolve(error=error)
+            raise
+        for _id, pending in batch.items():
+            pending._resolve(documents.get(_id))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.dispatch()
@@ -0,0 +1,299 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Monitoring of the operations run by a client
+
+Listeners registered on a :class:`~pymongres.client.MongresClient` are
+notified when each operation starts, and when it succeeds or fails, in
+the spirit of PyMongo's command monitoring. An operation is one call to
+a collection method (or one iteration of a result set) and may run
+several statements on its connection.
+"""
+
+from __future__ import absolute_import
+
+import itertools
+import threading
+import time
+
+from six import text_type
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class CommandListener(object):
+    """
+    Base class for listeners, whose methods receive the events
+
+    Listeners are called synchronously in the thread running the
+    operation, so they should be quick. Their exceptions are logged and
+    otherwise ignored.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class CommandStartedEvent(object):
+    """
+    An operation is about to run its first statement
+
+    ``sql`` and ``params`` are those of that statement. ``params`` is None
+    if the client redacts parameters.
+    """
+
+    def __init__(self, operation):
+        self.operation_id = operation.operation_id
+        self.database = operation.database
+        self.collection = operation.collection
+        self.operation = operation.name
+        self.sql = operation.sql
+        self.params = operation.params
+        self.acquire_time = operation.acquire_time
+
+    def __repr__(self):
+        return '<{} {}.{} {} #{}>'.format(
+            type(self).__name__, self.database, self.collection, self.operation, self.operation_id,
+        )
+
+
+class CommandSucceededEvent(CommandStartedEvent):
+    """
+    An operation completed
+
+    Times are in seconds. ``duration`` is the wall time of the whole
+    operation, including ``acquire_time`` spent waiting for a pooled
+    connection. ``server_time`` is the time spent waiting for PostgreSQL
+    to execute the statements and send their results, excluding JSON
+    decoding. ``rows`` counts the rows returned or written, and
+    ``bytes_decoded`` the UTF-8 size of the JSON documents decoded.
+    """
+
+    def __init__(self, operation):
+        super(CommandSucceededEvent, self).__init__(operation)
+        self.duration = operation.duration
+        self.server_time = operation.server_time
+        self.statements = operation.statements
+        self.rows = operation.rows
+        self.bytes_decoded = operation.bytes_decoded
+
+
+class CommandFailedEvent(CommandSucceededEvent):
+    """
+    An operation raised ``failure``
+    """
+
+    def __init__(self, operation, failure):
+        super(CommandFailedEvent, self).__init__(operation)
+        self.failure = failure
+
+
+class Monitor(object):
+    """
+    Registry of the listeners of a client
+    """
+
+    def __init__(self, listeners=None, redact_params=False):
+        self.listeners = tuple(listeners or ())
+        self.redact_params = redact_params
+        self._lock = threading.Lock()
+        self._operation_ids = itertools.count(1)
+
+    def add_listener(self, listener):
+        with self._lock:
+            # Replaced rather than mutated, so that publishing needs no lock
+            self.listeners = self.listeners + (listener,)
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self.listeners = tuple(item for item in self.listeners if item is not listener)
+
+    def operation(self, pool, database, collection, name):
+        """
+        Return a context manager running an operation on a pooled connection
+        """
+        return Operation(self, pool, database, collection, name)
+
+    def _publish(self, method, event):
+        for listener in self.listeners:
+            try:
+                getattr(listener, method)(event)
+            except Exception:
+                log.exception("listener %r failed on %r", listener, event)
+
+
+class Operation(object):
+    """
+    Context manager tracking one operation
+
+    Entering it checks out a connection (``self.connection``), which is
+    committed and returned to the pool on exit. Statements must be run
+    with execute() and results read with the fetch methods so that they
+    are accounted for. Without listeners, nothing is timed or published.
+    """
+
+    def __init__(self, monitor, pool, database, collection, name):
+        self.monitor = monitor
+        self.operation_id = next(monitor._operation_ids)
+        self.database = database
+        self.collection = collection
+        self.name = name
+        self.connection = None
+        self.sql = None
+        self.params = None
+        self.statements = 0
+        self.rows = 0
+        self.acquire_time = 0.0
+        self.server_time = 0.0
+        self.duration = 0.0
+        self.bytes_decoded = 0
+
+        self._pool = pool
+        self._enabled = bool(monitor.listeners)
+        self._context = None
+        self._started = None
+        self._published = False
+        self._decoded = None
+
+    def __enter__(self):
+        self._context = self._pool.connection()
+        if not self._enabled:
+            self.connection = self._context.__enter__()
+            return self
+        self._started = time.time()
+        try:
+            self.connection = self._context.__enter__()
+        except Exception as exc:
+            self._finish(exc)
+            raise
+        self.acquire_time = time.time() - self._started
+        self._decoded = self.connection.bytes_decoded
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._enabled:
+            self._context.__exit__(exc_type, exc, tb)
+            return False
+        decoded = self.connection.bytes_decoded
+        try:
+            self._context.__exit__(exc_type, exc, tb)
+        except Exception as commit_exc:
+            self._finish(commit_exc, decoded)
+            raise
+        # An abandoned result set iterator is not a failure
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            self._finish(exc, decoded)
+        else:
+            self._finish(None, decoded)
+        return False
+
+    def execute(self, cursor, sql, params=None, prepared=False):
+        """
+        Run a statement, as a prepared statement if ``prepared`` is true
+        """
+        self._statement(sql, params)
+        if prepared:
+            self._timed(self.connection.execute_prepared, cursor, sql, params)
+        else:
+            self._timed(cursor.execute, sql, params)
+        if cursor.description is None and cursor.rowcount > 0:
+            self.rows += cursor.rowcount
+
+    def call(self, cursor, sql, func, *args, **kwargs):
+        """
+        Run a statement through another function, such as execute_values
+        """
+        self._statement(sql, None)
+        res = self._timed(func, *args, **kwargs)
+        if cursor.rowcount > 0:
+            self.rows += cursor.rowcount
+        return res
+
+    def fetchone(self, cursor):
+        row = self._timed(cursor.fetchone)
+        if row is not None:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, cursor, size):
+        rows = self._timed(cursor.fetchmany, size)
+        self.rows += len(rows)
+        return rows
+
+    def fetchall(self, cursor):
+        rows = self._timed(cursor.fetchall)
+        self.rows += len(rows)
+        return rows
+
+    def _timed(self, func, *args, **kwargs):
+        if not self._enabled:
+            return func(*args, **kwargs)
+        started = time.time()
+        decode_time = self.connection.decode_time
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # Documents decoded while fetching are not waiting on the server
+            self.server_time += time.time() - started - (self.connection.decode_time - decode_time)
+
+    def _statement(self, sql, params):
+        self.statements += 1
+        if self._enabled and not self._published:
+            self.sql = sql
+            self.params = None if self.monitor.redact_params else params
+            self._publish_started()
+
+    def _publish_started(self):
+        self._published = True
+        self.monitor._publish('started', CommandStartedEvent(self))
+
+    def _finish(self, exc, decoded=None):
+        self.duration = time.time() - self._started
+        if decoded is not None and self._decoded is not None:
+            self.bytes_decoded = decoded - self._decoded
+        if not self._published:
+            self._publish_started()
+        if exc is None:
+            self.monitor._publish('succeeded', CommandSucceededEvent(self))
+        else:
+            self.monitor._publish('failed', CommandFailedEvent(self, exc))
+
+
+def counting_loads(monitor, connection, loads):
+    """
+    Wrap a JSON decoding function to account for its work on a connection
+
+    The work is only accounted for while the monitor has listeners.
+    """
+    def counted(s):
+        if not monitor.listeners:
+            return loads(s)
+        started = time.time()
+        try:
+            return loads(s)
+        finally:
+            connection.decode_time += time.time() - started
+            connection.bytes_decoded += len(s.encode('utf-8')) if isinstance(s, text_type) else len(s)
+    return counted
@@ -0,0 +1,89 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Write operations for Collection.bulk_write, named as in PyMongo
+"""
+
+from __future__ import absolute_import
+
+
+class _WriteOp(object):
+
+    # Consecutive operations of a batchable kind are sent as one statement
+    batchable = False
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            repr(value) for value in self._args()
+        ))
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self._args() == other._args()
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class InsertOne(_WriteOp):
+
+    batchable = True
+
+    def __init__(self, document):
+        self.document = document
+
+    def _args(self):
+        return (self.document,)
+
+
+class DeleteOne(_WriteOp):
+
+    multi = False
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def _args(self):
+        return (self.spec,)
+
+
+class DeleteMany(DeleteOne):
+
+    batchable = True
+    multi = True
+
+
+class ReplaceOne(_WriteOp):
+
+    def __init__(self, spec, document, upsert=False):
+        self.spec = spec
+        self.document = document
+        self.upsert = upsert
+
+    def _args(self):
+        return (self.spec, self.document, self.upsert)
+
+
+class UpdateOne(ReplaceOne):
+
+    multi = False
+
+
+class UpdateMany(UpdateOne):
+
+    multi = True
@@ -0,0 +1,156 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Parallel scans of a collection, split into ranges of ids
+
+Each range is read on its own connection by a worker process, which
+decodes the documents and applies a function to them. Without a
+function, workers send back the JSON text of the rows, which is cheaper
+to pickle than decoded documents. Results are sent back range by range,
+with a bounded number of ranges in flight.
+"""
+
+from __future__ import absolute_import
+
+from collections import deque
+import multiprocessing
+
+from six.moves import queue
+
+from pymongres.query import Projection
+from pymongres.raw import RawDocument
+
+
+# Number of consecutive ids scanned by one task
+DEFAULT_CHUNK_SIZE = 10000
+
+# Client of the current worker process
+_client = None
+
+
+def id_ranges(low, high, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split ``[low, high]`` into ``(start, stop)`` ranges of ``chunk_size`` ids
+    """
+    for start in range(low, high + 1, chunk_size):
+        yield start, min(start + chunk_size, high + 1)
+
+
+def _init_worker(kwargs):
+    global _client
+    from pymongres.client import MongresClient
+    _client = MongresClient(max_pool_size=1, **kwargs)
+
+
+def _scan(task):
+    """
+    Return the results of a range, or the exception it raised
+    """
+    from pymongres.resultset import ResultSet
+    database, collection, spec, fields, document_class, id_range, func = task
+    try:
+        if func is None:
+            documents = ResultSet(_client[database][collection], spec, fields, batch_size=0, id_range=id_range)
+            projection = Projection.from_fields(fields, RawDocument)
+            return True, [row for _, rows in documents._batches(projection) for row in rows]
+        documents = ResultSet(
+            _client[database][collection], spec, fields, batch_size=0, id_range=id_range,
+            document_class=document_class,
+        )
+        return True, [func(document) for document in documents]
+    except Exception as exc:
+        return False, exc
+
+
+def parallel_scan(result_set, func=None, workers=None, ordered=True,
+                  chunk_size=DEFAULT_CHUNK_SIZE, max_in_flight=None):
+    """
+    Yield ``func(document)`` for the documents of a result set
+
+    See ResultSet.parallel_map.
+    """
+    collection = result_set.collection
+    database = collection.database
+    client = database.client
+
+    low, high = collection._id_bounds(result_set.spec)
+    if low is None:
+        return
+
+    workers = workers or multiprocessing.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
+    document_class = result_set.document_class
+    tasks = (
+        (database.name, collection.name, result_set.spec, result_set.fields, document_class, id_range, func)
+        for id_range in id_ranges(low, high, chunk_size)
+    )
+    kwargs = dict(client.kwargs, json_codec=client.json_codec)
+    if func is None:
+        projection = Projection.from_fields(result_set.fields, RawDocument)
+
+        def results(output):
+            return _documents(output, projection, client.json_codec.loads, document_class)
+    else:
+        results = _results
+
+    pool = multiprocessing.Pool(workers, _init_worker, (kwargs,))
+    try:
+        pending = deque()
+        # Outputs of unordered scans, in completion order
+        done = None if ordered else queue.Queue()
+        for task in tasks:
+            pending.append(pool.apply_async(_scan, (task,), callback=None if ordered else done.put))
+            if len(pending) >= max_in_flight:
+                for res in results(_next_result(pending, done)):
+                    yield res
+        while pending:
+            for res in results(_next_result(pending, done)):
+                yield res
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _next_result(pending, done):
+    """
+    Remove and return the output of the first task, or of the first
+    completed one if ``done`` is a queue of outputs
+    """
+    if done is None:
+        return pending.popleft().get()
+    pending.popleft()
+    return done.get()
+
+
+def _results(output):
+    ok, value = output
+    if not ok:
+        raise value
+    return value
+
+
+def _documents(output, projection, loads, document_class):
+    """
+    Decode the rows sent back by a worker
+    """
+    for row in _results(output):
+        document = projection.document(row, loads)
+        if document_class is RawDocument:
+            yield document
+        else:
+            # The raw document is dropped, so its dict can be handed out
+            yield document._decoded()
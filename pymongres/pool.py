@@ -0,0 +1,370 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from collections import deque
+from contextlib import contextmanager
+import itertools
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import connection as BaseConnection
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from pymongres.errors import PoolClosed, PoolTimeout
+from pymongres.lru import LRUCache
+from pymongres.query import prepared_types, to_prepared
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class PooledConnection(BaseConnection):
+    """
+    psycopg2 connection carrying the bookkeeping needed by the pool
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PooledConnection, self).__init__(*args, **kwargs)
+        self.pid = os.getpid()
+        self.created_at = self.last_used = time.time()
+        self.prepared_statements = None
+        self.statements_epoch = 0
+        self._statement_ids = itertools.count(1)
+
+        # JSON decoding function and statistics, see monitoring.counting_loads
+        self.loads = None
+        self.bytes_decoded = 0
+        self.decode_time = 0.0
+
+    def execute_prepared(self, cursor, sql, params):
+        """
+        Execute a query template as a prepared statement
+
+        Statements are prepared on first use and cached by SQL text and
+        parameter types, so that PostgreSQL only parses and plans each
+        query shape once per connection. Without a statement cache, the
+        query is executed directly.
+        """
+        if self.prepared_statements is None:
+            cursor.execute(sql, params)
+            return
+
+        types = prepared_types(params)
+        name = self.prepared_statements.get((sql, types))
+        if name is None:
+            name = 'pymongres_{}'.format(next(self._statement_ids))
+            cursor.execute('PREPARE {}{} AS {}'.format(
+                name, ' ({})'.format(', '.join(types)) if types else '', to_prepared(sql)
+            ))
+            for _, evicted in self.prepared_statements.put((sql, types), name):
+                cursor.execute('DEALLOCATE {}'.format(evicted))
+
+        if params:
+            placeholders = ', '.join(['%s'] * len(params))
+            cursor.execute('EXECUTE {} ({})'.format(name, placeholders), params)
+        else:
+            cursor.execute('EXECUTE {}'.format(name))
+
+    def reset_prepared_statements(self):
+        """
+        Deallocate the prepared statements of the connection
+        """
+        if self.prepared_statements is not None:
+            with self.cursor() as cursor:
+                cursor.execute('DEALLOCATE ALL')
+            self.commit()
+            self.prepared_statements.clear()
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of connections to one PostgreSQL database
+
+    Connections are handed out most-recently-used first, so that a
+    lightly loaded pool keeps reusing a few warm connections and lets the
+    others reach ``max_idle_time``.
+    """
+
+    def __init__(self, min_size=0, max_size=10, max_idle_time=None,
+                 wait_queue_timeout=None, health_check_interval=30,
+                 max_prepared_statements=256, configure=None, **kwargs):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        if min_size > max_size:
+            raise ValueError("min_size cannot be greater than max_size")
+
+        self.kwargs = kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.wait_queue_timeout = wait_queue_timeout
+        self.health_check_interval = health_check_interval
+        self.max_prepared_statements = max_prepared_statements
+        self.configure = configure
+
+        self._reset()
+        self._fill()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._created = 0
+        self._discarded = 0
+        self._statements_epoch = 0
+
+        # Connections inherited from the parent process are kept referenced
+        # so that garbage collection never closes the parent's sessions.
+        self._inherited = []
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a ``with`` block
+
+        The transaction is committed if the block succeeds and rolled back
+        otherwise, then the connection goes back to the pool.
+        """
+        connection = self.checkout()
+        try:
+            yield connection
+        except BaseException:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        else:
+            connection.commit()
+        finally:
+            self.checkin(connection)
+
+    def checkout(self):
+        self._check_fork()
+        started = time.time()
+        while True:
+            connection = self._acquire(started)
+            if connection is None:
+                try:
+                    connection = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+                break
+            if self._is_healthy(connection):
+                break
+            self._discard(connection)
+        if connection.statements_epoch != self._statements_epoch:
+            try:
+                connection.reset_prepared_statements()
+            except Exception:
+                self._discard(connection)
+                raise
+            connection.statements_epoch = self._statements_epoch
+        return connection
+
+    def checkin(self, connection):
+        if connection.pid != os.getpid():
+            self._inherited.append(connection)
+            return
+
+        if not connection.closed and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                connection.close()
+
+        with self._cond:
+            self._in_use -= 1
+            if connection.closed or self._closed:
+                self._discarded += 1
+                self._close_quietly(connection)
+            else:
+                connection.last_used = time.time()
+                self._idle.append(connection)
+                self._prune_idle()
+            self._cond.notify()
+
+    def close(self):
+        """
+        Close idle connections now, and in-use ones when they are returned
+        """
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._close_quietly(self._idle.popleft())
+            self._cond.notify_all()
+
+    def reset_prepared_statements(self):
+        """
+        Deallocate the prepared statements of every connection
+
+        Needed after schema changes that alter the result type of cached
+        statements. Connections do it when they are next checked out.
+        """
+        with self._cond:
+            self._statements_epoch += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._in_use + len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+                'connections_created': self._created,
+                'connections_discarded': self._discarded,
+            }
+
+    def _acquire(self, started):
+        """
+        Take an idle connection, or reserve a slot for a new one (None)
+        """
+        deadline = None
+        if self.wait_queue_timeout is not None:
+            deadline = started + self.wait_queue_timeout
+
+        with self._cond:
+            waited = False
+            try:
+                while True:
+                    if self._closed:
+                        raise PoolClosed("connection pool is closed")
+                    self._prune_idle()
+                    if self._idle:
+                        connection = self._idle.pop()
+                        break
+                    if self._in_use < self.max_size:
+                        connection = None
+                        break
+                    if not waited:
+                        waited = True
+                        self._waiting += 1
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise PoolTimeout(
+                                "timed out after %.3fs waiting for a connection "
+                                "(max_size=%d)" % (self.wait_queue_timeout, self.max_size)
+                            )
+                        self._cond.wait(remaining)
+            finally:
+                if waited:
+                    self._waiting -= 1
+                    wait_time = time.time() - started
+                    self._waits += 1
+                    self._wait_time += wait_time
+                    self._max_wait_time = max(self._max_wait_time, wait_time)
+
+            self._in_use += 1
+            self._checkouts += 1
+            return connection
+
+    def _release_slot(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _discard(self, connection):
+        self._close_quietly(connection)
+        with self._cond:
+            self._in_use -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def _connect(self):
+        connection = psycopg2.connect(connection_factory=PooledConnection, **self.kwargs)
+        if self.configure is not None:
+            self.configure(connection)
+        if self.max_prepared_statements:
+            connection.prepared_statements = LRUCache(self.max_prepared_statements)
+        connection.statements_epoch = self._statements_epoch
+        with self._cond:
+            self._created += 1
+        return connection
+
+    def _fill(self):
+        while True:
+            with self._cond:
+                if self._in_use + len(self._idle) >= self.min_size:
+                    return
+                self._in_use += 1
+            try:
+                connection = self._connect()
+            except Exception:
+                self._release_slot()
+                raise
+            self.checkin(connection)
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        if time.time() - connection.last_used < self.health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+        except psycopg2.Error:
+            log.debug("discarding broken connection %r", connection)
+            return False
+        return True
+
+    def _prune_idle(self):
+        """
+        Close connections idle for longer than max_idle_time (lock held)
+        """
+        if self.max_idle_time is None:
+            return
+        limit = time.time() - self.max_idle_time
+        # The least recently used connections are on the left
+        while self._idle and self._in_use + len(self._idle) > self.min_size:
+            if self._idle[0].last_used > limit:
+                break
+            self._close_quietly(self._idle.popleft())
+            self._discarded += 1
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            inherited = list(self._idle) + self._inherited
+            self._reset()
+            self._inherited = inherited
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
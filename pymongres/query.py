@@ -0,0 +1,885 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compilation of query specs to parameterized SQL
+
+A spec is split into its *shape* (keys and operators) and its values.
+The SQL template only depends on the shape, so it is built once and then
+reused from a cache, with the values passed as query parameters.
+"""
+
+from __future__ import absolute_import
+
+from datetime import datetime
+from decimal import Decimal
+import hashlib
+import itertools
+import json
+import math
+import numbers
+import re
+
+from six import iteritems
+
+from psycopg2.extensions import QuotedString
+
+from pymongres.errors import OperationFailure
+from pymongres.json_adapters import JsonCodec
+from pymongres.lru import LRUCache
+from pymongres.raw import RawDocument
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Python 3
+try:
+    unicode
+except NameError:
+    basestring = unicode = str
+
+
+# Maximum number of compiled SQL templates kept in memory
+TEMPLATE_CACHE_SIZE = 1024
+
+# Longer identifiers are truncated by PostgreSQL
+MAX_IDENTIFIER_LENGTH = 63
+
+COMPARISON_OPERATORS = {
+    '$eq': '=',
+    '$lt': '<',
+    '$lte': '<=',
+    '$gt': '>',
+    '$gte': '>=',
+}
+
+# Pseudo-operator for the jsonb containment of all plain equality filters
+CONTAINS = '$contains'
+
+# Pseudo-operator for the jsonb equality of a document or array value
+JSON_EQUALS = '$jsoneq'
+
+_templates = LRUCache(TEMPLATE_CACHE_SIZE)
+
+_default_codec = JsonCodec()
+
+
+def compile_find(collection, spec, order_by=None, projection=None,
+                 limit=None, skip=None, after=None, id_range=None, codec=None):
+    """
+    Compile a find query
+
+    ``after`` enables keyset pagination: only documents sorting after it
+    are returned. It is the last ``_id`` seen when the query is not sorted
+    (or sorted by ``_id``), and otherwise either the last sort key value
+    or a ``(sort key value, _id)`` pair that also breaks ties.
+    ``id_range`` is a ``(start, stop)`` pair restricting the scan to ids
+    in ``[start, stop)``, in id order unless sorted otherwise.
+    """
+    if projection is None:
+        projection = Projection.from_fields(None)
+
+    keyset = None
+    extra_params = []
+    if after is not None:
+        if order_by in (None, '_id'):
+            order_by = '_id'
+            keyset = 'value'
+            extra_params.append(after)
+        elif isinstance(after, tuple):
+            keyset = 'pair'
+            value, _id = after
+            extra_params.extend([_param(value), _id])
+        else:
+            keyset = 'value'
+            extra_params.append(_param(after))
+    if id_range is not None:
+        if order_by is None:
+            order_by = '_id'
+        extra_params.extend(id_range)
+    if limit:
+        extra_params.append(limit)
+    if skip:
+        extra_params.append(skip)
+
+    def build(where):
+        order_by_clause = build_order_by_clause(order_by)
+        if order_by not in (None, '_id') and (limit or skip or keyset):
+            # Break ties so that consecutive pages are consistent
+            order_by_clause += ', id'
+        if keyset is not None:
+            column = escape(build_column(order_by))
+            if keyset == 'pair':
+                predicate = '({}, id) > (%s, %s)'.format(column)
+            else:
+                predicate = '{} > %s'.format(column)
+            where = '{} {}'.format(where + ' AND' if where else ' WHERE', predicate)
+        if id_range is not None:
+            where = '{} id >= %s AND id < %s'.format(where + ' AND' if where else ' WHERE')
+        return 'SELECT {columns} FROM {collection}{where}{sort}{limit}{skip}'.format(
+            columns=escape(projection.columns()),
+            collection=collection,
+            where=where,
+            sort=order_by_clause,
+            limit=' LIMIT %s' if limit else '',
+            skip=' OFFSET %s' if skip else '',
+        )
+
+    sql, params = _compile(
+        ('find', collection, order_by, projection.key, keyset, id_range is not None, bool(limit), bool(skip)),
+        spec, build, codec,
+    )
+    return sql, params + extra_params
+
+
+def compile_find_by_ids(collection, projection):
+    """
+    Return the query of the documents whose ids are in an array parameter
+
+    The id is selected first, in front of the projection's columns.
+    """
+    return 'SELECT id, {} FROM {} WHERE id = ANY(%s)'.format(escape(projection.columns()), collection)
+
+
+def compile_count(collection, spec, codec=None):
+    return _compile(
+        ('count', collection), spec,
+        lambda where: 'SELECT COUNT(*) FROM {collection}{where}'.format(
+            collection=collection,
+            where=where,
+        ), codec
+    )
+
+
+def compile_export(collection, spec, codec=None):
+    """
+    Compile a query for the documents matching a spec, with their _id
+    """
+    return _compile(
+        ('export', collection), spec,
+        lambda where: "SELECT data || jsonb_build_object('_id', id) FROM {collection}{where} ORDER BY id".format(
+            collection=collection,
+            where=where,
+        ), codec
+    )
+
+
+def compile_distinct(collection, key, spec, codec=None):
+    """
+    Compile a query for the distinct values of a key
+
+    Values are deduplicated and sorted as jsonb, so that values of
+    different JSON types, such as 1 and "1", stay distinct. In jsonb
+    order, strings sort before numbers.
+    """
+    column = escape(build_column(key))
+    value = 'id' if key == '_id' else escape(build_json_column(key))
+
+    def build(where):
+        return 'SELECT DISTINCT ON ({value}) {value} FROM {collection}{where} {column} IS NOT NULL ORDER BY {value}'.format(
+            column=column,
+            value=value,
+            collection=collection,
+            where=where + ' AND' if where else ' WHERE',
+        )
+
+    return _compile(('distinct', collection, key), spec, build, codec)
+
+
+def compile_delete(collection, spec, codec=None, multi=True):
+    if multi:
+        build = lambda where: 'DELETE FROM {collection}{where}'.format(
+            collection=collection,
+            where=where,
+        )
+    else:
+        build = lambda where: 'DELETE FROM {collection} WHERE id = (SELECT id FROM {collection}{where} LIMIT 1 FOR UPDATE)'.format(
+            collection=collection,
+            where=where,
+        )
+    return _compile(('delete', collection, multi), spec, build, codec)
+
+
+def compile_delete_any(collection, specs, codec=None):
+    """
+    Compile the deletion of the documents matching any of several specs
+    """
+    filters = []
+    params = []
+    for spec in specs:
+        where, spec_params = compile_where(spec, codec)
+        if not where:
+            return compile_delete(collection, None, codec)
+        filters.append('({})'.format(where[len(' WHERE '):]))
+        params.extend(spec_params)
+    sql = 'DELETE FROM {collection} WHERE {filters}'.format(
+        collection=collection,
+        filters=' OR '.join(filters),
+    )
+    return sql, params
+
+
+UPDATE_OPERATORS = ('$set', '$unset', '$inc', '$push', '$setOnInsert')
+
+
+def compile_update(collection, spec, document, multi=False, codec=None):
+    """
+    Compile an update document to a single UPDATE statement
+
+    The statement locks the matching rows, computes their new data with
+    jsonb functions and only writes the rows that actually change. It
+    returns the number of matched and modified documents.
+    """
+    codec = codec or _default_codec
+    update_shape, update_params = analyze_update(document, codec)
+    shape, params = analyze(spec, codec)
+
+    key = ('update', collection, multi, update_shape, shape)
+    sql = _templates.get(key)
+    if sql is None:
+        sql = build_update(collection, build_update_expression(update_shape),
+                           build_where_clause(shape), multi)
+        _templates.put(key, sql)
+    params = update_params + params
+    log.debug('%s %r', sql, params)
+    return sql, params
+
+
+def compile_replace(collection, spec, document, codec=None):
+    """
+    Compile the replacement of the first document matching a spec
+    """
+    codec = codec or _default_codec
+    document = _replacement(spec, document)
+    shape, params = analyze(spec, codec)
+
+    key = ('replace', collection, shape)
+    sql = _templates.get(key)
+    if sql is None:
+        sql = build_update(collection, '%s::jsonb', build_where_clause(shape), False)
+        _templates.put(key, sql)
+    params = [codec.adapt(document)] + params
+    log.debug('%s %r', sql, params)
+    return sql, params
+
+
+def build_update(collection, expression, where, multi):
+    return (
+        'WITH matched AS ('
+        'SELECT id AS matched_id, {expression} AS new_data FROM {collection}{where}{limit} FOR UPDATE'
+        '), updated AS ('
+        'UPDATE {collection} SET data = new_data FROM matched'
+        ' WHERE id = matched_id AND data IS DISTINCT FROM new_data RETURNING 1'
+        ') SELECT (SELECT COUNT(*) FROM matched), (SELECT COUNT(*) FROM updated)'
+    ).format(
+        expression=expression,
+        collection=collection,
+        where=where,
+        limit='' if multi else ' LIMIT 1',
+    )
+
+
+def compile_upsert(collection, spec, document, replace=False, codec=None):
+    """
+    Compile an upsert to a single INSERT ... ON CONFLICT DO UPDATE
+
+    The spec must consist of equality filters on the keys of a unique
+    index, which PostgreSQL uses to detect the existing document. The
+    inserted document is built from the spec and the update (or is the
+    replacement), and an existing document keeps its id. The statement
+    returns the id and whether it was inserted, or no row if the
+    existing document was left unchanged.
+    """
+    codec = codec or _default_codec
+    keys = analyze_upsert_spec(spec)
+    if replace:
+        inserted = _replacement(spec, document)
+        update_shape, update_params = None, []
+    else:
+        update_shape, update_params = analyze_update(document, codec)
+        inserted = apply_update(_upsert_seed(spec), document, insert=True)
+
+    key = ('upsert', collection, keys, update_shape)
+    sql = _templates.get(key)
+    if sql is None:
+        sql = build_upsert(collection, keys, update_shape)
+        _templates.put(key, sql)
+
+    params = [codec.adapt(inserted)] + update_params + update_params
+    if '_id' in keys:
+        params.insert(0, spec['_id'])
+    log.debug('%s %r', sql, params)
+    return sql, params
+
+
+def build_upsert(collection, keys, update_shape):
+    if update_shape is None:
+        expression = 'EXCLUDED.data'
+    else:
+        expression = build_update_expression(update_shape, '{}.data'.format(collection))
+    target = ', '.join(
+        'id' if key == '_id' else '({})'.format(escape(build_column(key)))
+        for key in keys
+    )
+    return (
+        'INSERT INTO {collection} ({columns}) VALUES ({values})'
+        ' ON CONFLICT ({target}) DO UPDATE SET data = {expression}'
+        ' WHERE {collection}.data IS DISTINCT FROM {expression}'
+        ' RETURNING id, xmax = 0'
+    ).format(
+        collection=collection,
+        columns='id, data' if '_id' in keys else 'data',
+        values='%s, %s' if '_id' in keys else '%s',
+        target=target,
+        expression=expression,
+    )
+
+
+def analyze_upsert_spec(spec):
+    """
+    Return the keys of an upsert spec, which must only hold equalities
+    """
+    if not spec:
+        raise OperationFailure("upsert requires a filter on the keys of a unique index")
+    for key, value in iteritems(spec):
+        if isinstance(value, (dict, list)) or value is None:
+            raise OperationFailure("upsert filters must be equalities on scalar values")
+    _check_paths(sorted(spec), "Upsert filters")
+    return tuple(sorted(spec))
+
+
+def _upsert_seed(spec):
+    document = {}
+    for key, value in iteritems(spec):
+        if key != '_id':
+            _set_path(document, key, value)
+    return document
+
+
+def _replacement(spec, document):
+    """
+    Return a replacement document, checked against the spec
+
+    Keys filtered on are copied to the replacement, so that an upserted
+    document matches its filter.
+    """
+    if any(key.startswith('$') for key in document):
+        raise ValueError("replacement document must not contain $ operators")
+    document = dict(document)
+    if '_id' in document:
+        _id = document.pop('_id')
+        if (spec or {}).get('_id') != _id:
+            raise OperationFailure("the _id of a document cannot be changed")
+    for key, value in iteritems(spec or {}):
+        if key == '_id' or _is_operator_dict(value):
+            continue
+        current = _get_path(document, key)
+        if current is _MISSING:
+            _set_path(document, key, value)
+        elif current != value:
+            raise ValueError("replacement document conflicts with the filter on %r" % key)
+    return document
+
+
+def analyze_update(document, codec=None):
+    """
+    Split an update document into its shape and the list of its values
+
+    Paths may not overlap, as in MongoDB, so that every operator can read
+    the current value of its path from the original document.
+    """
+    if not document:
+        raise ValueError("update document must not be empty")
+    if not all(op.startswith('$') for op in document):
+        raise ValueError("update document must only contain $ operators")
+
+    codec = codec or _default_codec
+    shape = []
+    params = []
+    paths = []
+    for op in sorted(document):
+        if op not in UPDATE_OPERATORS:
+            raise OperationFailure("Unsupported update operator %s" % op)
+        fields = document[op]
+        if not isinstance(fields, dict):
+            raise OperationFailure("Modifiers for %s must be a document" % op)
+        for key in sorted(fields):
+            value = fields[key]
+            _check_update_path(key, paths)
+            paths.append(key)
+            if op == '$setOnInsert':
+                continue
+            elif op == '$unset':
+                shape.append((op, key))
+            elif op == '$inc':
+                if isinstance(value, bool) or not isinstance(value, numbers.Number):
+                    raise OperationFailure("Cannot increment with non-numeric argument %r" % (value,))
+                shape.append((op, key))
+                params.append(value)
+            elif op == '$push' and isinstance(value, dict) and '$each' in value:
+                shape.append(('$each', key))
+                params.append(codec.adapt(list(value['$each'])))
+            else:
+                shape.append((op, key))
+                params.append(codec.adapt(value))
+
+    # Missing parent objects of nested paths are created first
+    parents = set()
+    for op, key in shape:
+        if op != '$unset':
+            parts = key.split('.')
+            parents.update('.'.join(parts[:i]) for i in range(1, len(parts)))
+    parents = [(None, key) for key in sorted(parents, key=lambda key: (key.count('.'), key))]
+
+    return tuple(parents + shape), params
+
+
+def _check_update_path(key, paths):
+    if key == '_id' or key.startswith('_id.'):
+        raise OperationFailure("Performing an update on the path '_id' would modify the immutable field '_id'")
+    other = _overlapping_path(key, paths)
+    if other is not None:
+        raise OperationFailure("Updating the path '%s' would create a conflict at '%s'" % (key, other))
+
+
+def _check_paths(keys, what):
+    """
+    Raise OperationFailure if a key is another one, or is under it
+    """
+    paths = []
+    for key in keys:
+        other = _overlapping_path(key, paths)
+        if other is not None:
+            raise OperationFailure("%s on the paths '%s' and '%s' overlap" % (what, other, key))
+        paths.append(key)
+
+
+def _overlapping_path(key, paths):
+    for other in paths:
+        if key == other or key.startswith(other + '.') or other.startswith(key + '.'):
+            return other
+    return None
+
+
+def build_update_expression(update_shape, source='data'):
+    """
+    Return the jsonb expression of the data column after an update
+    """
+    expression = source
+    for op, key in update_shape:
+        path = escape(quoted(json_path(key)))
+        current = '{}#>{}'.format(source, path)
+        if op is None:
+            value = "COALESCE({}, '{{}}')".format(current)
+        elif op == '$set':
+            value = '%s::jsonb'
+        elif op == '$unset':
+            expression = '({} #- {})'.format(expression, path)
+            continue
+        elif op == '$inc':
+            value = 'to_jsonb(COALESCE(({}#>>{})::numeric, 0) + %s)'.format(source, path)
+        elif op == '$push':
+            value = "{} || jsonb_build_array(%s::jsonb)".format(_pushed_array(current))
+        elif op == '$each':
+            value = "{} || %s::jsonb".format(_pushed_array(current))
+        expression = 'jsonb_set({}, {}, {}, true)'.format(expression, path, value)
+    return expression
+
+
+def _pushed_array(current):
+    # jsonb_array_length() raises invalid_parameter_value on other values than arrays
+    return "CASE WHEN {0} IS NULL OR jsonb_array_length({0}) >= 0 THEN COALESCE({0}, '[]') END".format(current)
+
+
+def apply_update(document, update, insert=False):
+    """
+    Apply an update document to a document in Python
+
+    This is used to build the document inserted by an upsert, in which
+    case ``$setOnInsert`` applies as well.
+    """
+    for op in sorted(update):
+        for key, value in iteritems(update[op]):
+            if op == '$set' or (op == '$setOnInsert' and insert):
+                _set_path(document, key, value)
+            elif op == '$unset':
+                _unset_path(document, key)
+            elif op == '$inc':
+                current = _get_path(document, key)
+                _set_path(document, key, value + (0 if current is _MISSING else current))
+            elif op == '$push':
+                current = _get_path(document, key)
+                if current is not _MISSING and not isinstance(current, list):
+                    raise OperationFailure("$push requires the field '%s' to be missing or an array" % key)
+                items = [] if current is _MISSING else list(current)
+                if isinstance(value, dict) and '$each' in value:
+                    items.extend(value['$each'])
+                else:
+                    items.append(value)
+                _set_path(document, key, items)
+    return document
+
+
+def compile_where(spec, codec=None):
+    """
+    Compile a spec to a WHERE clause template and its parameters
+    """
+    return _compile(('where',), spec, lambda where: where, codec)
+
+
+def _compile(key, spec, build, codec=None):
+    shape, params = analyze(spec, codec)
+    key = key + (shape,)
+    sql = _templates.get(key)
+    if sql is None:
+        sql = build(build_where_clause(shape))
+        _templates.put(key, sql)
+    log.debug('%s %r', sql, params)
+    return sql, params
+
+
+def analyze(spec, codec=None):
+    """
+    Split a spec into its shape and the list of its values
+
+    Plain equality filters are combined into a single jsonb containment
+    predicate (``data @> '{...}'``) that a GIN index on the data column
+    can serve. For string values, the equivalent ``data->>key`` comparison
+    is added as well so that B-tree indexes created with create_index
+    still apply. Containment alone would also match supersets of document
+    and array values, so these are compared as jsonb too.
+    """
+    if spec is None:
+        spec = {}
+
+    codec = codec or _default_codec
+    shape = []
+    params = []
+    contained = {}
+    _check_paths(
+        [key for key in sorted(spec) if key != '_id' and not _is_operator_dict(spec[key])],
+        "Equality filters",
+    )
+    for key in sorted(spec):
+        value = spec[key]
+        if key != '_id' and not _is_operator_dict(value):
+            _set_path(contained, key, value)
+            if isinstance(value, (basestring, datetime)):
+                shape.append((key, '$eq'))
+                params.append(_param(value))
+            elif isinstance(value, (dict, list)):
+                shape.append((key, JSON_EQUALS))
+                params.append(codec.adapt(value))
+            continue
+        if isinstance(value, dict):
+            assert len(value) == 1
+            op, value = next(iteritems(value))
+            if op not in COMPARISON_OPERATORS:
+                raise Exception("Unsupported operator %s" % op)
+        else:
+            op = '$eq'
+        shape.append((key, op))
+        params.append(_param(value))
+
+    if contained:
+        shape.insert(0, (None, CONTAINS))
+        params.insert(0, codec.adapt(contained))
+
+    return tuple(shape), params
+
+
+def build_where_clause(shape):
+    filters = []
+    for key, op in shape:
+        if op == CONTAINS:
+            filters.append('data @> %s')
+        elif op == JSON_EQUALS:
+            filters.append('{} = %s::jsonb'.format(escape(build_json_column(key))))
+        else:
+            column = escape(build_column(key))
+            filters.append('{} {} %s'.format(column, COMPARISON_OPERATORS[op]))
+
+    if filters:
+        return ' WHERE {}'.format(' AND '.join(filters))
+    else:
+        return ''
+
+
+def build_column(key):
+    """
+    Return the SQL expression for a (possibly dotted) document key
+    """
+    if key == '_id':
+        return "id"
+    elif '.' in key:
+        return "data#>>{}".format(quoted(json_path(key)))
+    else:
+        return "data->>{}".format(quoted(key))
+
+
+def build_order_by_clause(key):
+    if key is None:
+        return ''
+    column = escape(build_column(key))
+    return ' ORDER BY {}'.format(column)
+
+
+_PLACEHOLDER = re.compile(r'%([s%])')
+
+
+def to_prepared(sql):
+    """
+    Convert a query template to the $n placeholders used by PREPARE
+    """
+    numbers = itertools.count(1)
+
+    def replace(match):
+        if match.group(1) == '%':
+            return '%'
+        return '${}'.format(next(numbers))
+
+    return _PLACEHOLDER.sub(replace, sql)
+
+
+def prepared_types(params):
+    """
+    Return the types to declare for the parameters of a prepared statement
+
+    They are the types PostgreSQL gives to the literals that psycopg2
+    interpolates in queries that are not prepared, so that both behave
+    the same: numbers and booleans are typed, and other values are left
+    to be resolved from their context (``unknown``). Otherwise PREPARE
+    would infer them from the query, e.g. text for ``data->>'a' > $1``.
+    """
+    return tuple(_prepared_type(param) for param in params or ())
+
+
+def _prepared_type(value):
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, numbers.Integral):
+        if -2 ** 31 <= value < 2 ** 31:
+            return 'integer'
+        if -2 ** 63 <= value < 2 ** 63:
+            return 'bigint'
+        return 'numeric'
+    if isinstance(value, float):
+        # Infinities and NaN are sent as 'Infinity'::float and 'NaN'::float
+        return 'double precision' if math.isinf(value) or math.isnan(value) else 'numeric'
+    if isinstance(value, Decimal):
+        return 'numeric'
+    if isinstance(value, list) and value:
+        types = set(_prepared_type(item) for item in value)
+        if types <= set(['integer', 'bigint']):
+            return 'bigint[]' if 'bigint' in types else 'integer[]'
+        if all(isinstance(item, basestring) for item in value):
+            return 'text[]'
+    return 'unknown'
+
+
+class Projection(object):
+    """
+    Field selection compiled into the SELECT list
+
+    Included fields are fetched one by one as JSON text, so that neither
+    the rest of the document nor missing fields are transferred. Excluded
+    fields are removed from the document by the server.
+
+    With ``raw=True``, documents are fetched as JSON text and returned as
+    RawDocument objects, which only decode it when accessed.
+    """
+
+    INCLUDE = 'include'
+    EXCLUDE = 'exclude'
+
+    def __init__(self, include_id=True, mode=None, paths=(), raw=False):
+        self.include_id = include_id
+        self.mode = mode
+        self.paths = tuple(paths)
+        self.raw = raw
+        self.key = (include_id, mode, self.paths, raw)
+
+    @classmethod
+    def from_fields(cls, fields, document_class=dict):
+        """
+        Build a projection from a list of fields to include (``_id`` is
+        always included), or a dict of fields to include or exclude
+
+        A dict cannot mix included and excluded fields, except for ``_id``.
+        """
+        if document_class is dict:
+            raw = False
+        elif document_class is RawDocument:
+            raw = True
+        else:
+            raise TypeError("document_class must be dict or RawDocument")
+
+        if fields is None:
+            return cls(raw=raw)
+        if not isinstance(fields, dict):
+            paths = [field for field in fields if field != '_id']
+            _check_paths(sorted(paths), "Projections")
+            return cls(True, cls.INCLUDE, paths, raw)
+
+        _check_paths(sorted(field for field in fields if field != '_id'), "Projections")
+        include_id = bool(fields.get('_id', True))
+        included = [field for field, include in iteritems(fields) if include and field != '_id']
+        excluded = [field for field, include in iteritems(fields) if not include and field != '_id']
+        if included and excluded:
+            raise OperationFailure("Projections cannot mix inclusion and exclusion, as on '%s' and '%s'" % (
+                sorted(included)[0], sorted(excluded)[0],
+            ))
+        if included or (fields.get('_id') and not excluded):
+            # Including only _id leaves out every other field
+            return cls(include_id, cls.INCLUDE, sorted(included), raw)
+        if excluded:
+            return cls(include_id, cls.EXCLUDE, sorted(excluded), raw)
+        return cls(include_id, raw=raw)
+
+    def columns(self):
+        columns = ['id'] if self.include_id else []
+        if self.mode == self.INCLUDE:
+            columns.extend('({})::text'.format(build_json_column(path)) for path in self.paths)
+        elif self.mode == self.EXCLUDE:
+            data = 'data'
+            for path in self.paths:
+                if '.' in path:
+                    data = '({} #- {})'.format(data, quoted(json_path(path)))
+                else:
+                    data = '({} - {})'.format(data, quoted(path))
+            columns.append('({})::text'.format(data) if self.raw else data)
+        else:
+            columns.append('data::text' if self.raw else 'data')
+        return ', '.join(columns) or 'NULL'
+
+    def document(self, row, loads=json.loads):
+        values = iter(row)
+        _id = next(values) if self.include_id else None
+        if self.mode == self.INCLUDE:
+            document = {}
+            for path, text in zip(self.paths, values):
+                if text is not None:
+                    _set_path(document, path, loads(text))
+            if self.raw:
+                # Only the selected fields were transferred and decoded
+                if self.include_id:
+                    document['_id'] = _id
+                return RawDocument(_id, None, loads, document)
+        elif self.raw:
+            return RawDocument(_id, next(values), loads)
+        else:
+            document = next(values)
+        if self.include_id:
+            document['_id'] = _id
+        return document
+
+
+def build_json_column(key):
+    """
+    Return the SQL expression for the JSON value of a document key
+    """
+    if '.' in key:
+        return "data#>{}".format(quoted(json_path(key)))
+    else:
+        return "data->{}".format(quoted(key))
+
+
+def escape(sql):
+    # Literal percent signs must be doubled in query templates
+    return sql.replace('%', '%%')
+
+
+def _param(value):
+    # Dates are stored as ISO 8601 strings by the JSON encoder
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and any(key.startswith('$') for key in value)
+
+
+def _set_path(document, key, value):
+    """
+    Set a (possibly dotted) key in a nested document
+    """
+    path = key.split('.')
+    for item in path[:-1]:
+        document = document.setdefault(item, {})
+        if not isinstance(document, dict):
+            raise OperationFailure("cannot set '%s' under the non-object value of '%s'" % (key, item))
+    document[path[-1]] = value
+
+
+_MISSING = object()
+
+
+def _get_path(document, key):
+    """
+    Get a (possibly dotted) key from a nested document, or _MISSING
+    """
+    for item in key.split('.'):
+        if not isinstance(document, dict) or item not in document:
+            return _MISSING
+        document = document[item]
+    return document
+
+
+def _unset_path(document, key):
+    path = key.split('.')
+    for item in path[:-1]:
+        document = document.get(item)
+        if not isinstance(document, dict):
+            return
+    document.pop(path[-1], None)
+
+
+def json_path(key):
+    """
+    Convert a dotted key to a PostgreSQL text array literal
+    """
+    return u'{{{}}}'.format(u','.join(
+        u'"{}"'.format(part.replace('\\', '\\\\').replace('"', '\\"'))
+        for part in key.split('.')
+    ))
+
+
+def short_identifier(name):
+    """
+    Shorten a name to fit a PostgreSQL identifier
+
+    PostgreSQL silently truncates longer identifiers, which could make
+    distinct names collide, so they are cut and suffixed with a hash of
+    the full name instead.
+    """
+    encoded = name.encode('utf8')
+    if len(encoded) <= MAX_IDENTIFIER_LENGTH:
+        return name
+    digest = hashlib.md5(encoded).hexdigest()[:8]
+    prefix = encoded[:MAX_IDENTIFIER_LENGTH - len(digest) - 1].decode('utf8', 'ignore')
+    return u'{}_{}'.format(prefix, digest)
+
+
+def quoted(value, encoding='utf8'):
+    if isinstance(value, basestring):
+        return QuotedString(value).getquoted().decode(encoding)
+    elif isinstance(value, datetime):
+        return quoted(value.isoformat())
+    else:
+        return value
@@ -0,0 +1,107 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Documents decoded on demand
+"""
+
+from __future__ import absolute_import
+
+import copy
+import json
+
+from six.moves.collections_abc import Mapping
+
+
+class RawDocument(Mapping):
+    """
+    Read-only document holding the JSON text of a row
+
+    The text is only decoded when a field other than ``_id`` is first
+    accessed, so that rows which are skipped, counted or only identified
+    cost neither the decoding time nor the memory of a dict. Use
+    to_dict() for a regular, modifiable document.
+    """
+
+    __slots__ = ('_id', '_raw', '_loads', '_document')
+
+    def __init__(self, _id, raw, loads=json.loads, document=None):
+        self._id = _id
+        self._raw = raw
+        self._loads = loads
+        self._document = document
+
+    @property
+    def raw(self):
+        """
+        JSON text of the document, without its ``_id``
+        """
+        if self._raw is None:
+            document = dict(self._decoded())
+            document.pop('_id', None)
+            self._raw = json.dumps(document)
+        return self._raw
+
+    @property
+    def decoded(self):
+        """
+        Whether the JSON text has been decoded
+        """
+        return self._document is not None
+
+    def _decoded(self):
+        if self._document is None:
+            document = self._loads(self._raw)
+            if self._id is not None:
+                document['_id'] = self._id
+            self._document = document
+        return self._document
+
+    def __getitem__(self, key):
+        if key == '_id' and self._id is not None:
+            return self._id
+        return self._decoded()[key]
+
+    def __iter__(self):
+        return iter(self._decoded())
+
+    def __len__(self):
+        return len(self._decoded())
+
+    def __contains__(self, key):
+        if key == '_id' and self._id is not None:
+            return True
+        return key in self._decoded()
+
+    def __repr__(self):
+        if self._document is None:
+            return 'RawDocument(_id={!r}, raw={!r})'.format(self._id, self._raw)
+        return 'RawDocument({!r})'.format(self._document)
+
+    def __reduce__(self):
+        return (RawDocument, (self._id, self.raw))
+
+    def to_dict(self):
+        """
+        Decode the whole document into a new dict
+        """
+        if self._document is None:
+            document = self._loads(self._raw)
+            if self._id is not None:
+                document['_id'] = self._id
+            return document
+        return copy.deepcopy(self._document)
+
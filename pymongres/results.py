@@ -0,0 +1,65 @@
+# coding: utf-8
+
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Results of write operations, as returned by PyMongo
+"""
+
+from __future__ import absolute_import
+
+
+class UpdateResult(object):
+
+    def __init__(self, matched_count, modified_count, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+    def __repr__(self):
+        return '{}(matched_count={!r}, modified_count={!r}, upserted_id={!r})'.format(
+            type(self).__name__, self.matched_count, self.modified_count, self.upserted_id,
+        )
+
+
+class BulkWriteResult(object):
+    """
+    Counts of the documents affected by a bulk write
+
+    ``inserted_ids`` and ``upserted_ids`` map the index of the operations
+    that created a document to its _id.
+    """
+
+    def __init__(self):
+        self.inserted_count = 0
+        self.matched_count = 0
+        self.modified_count = 0
+        self.deleted_count = 0
+        self.upserted_count = 0
+        self.inserted_ids = {}
+        self.upserted_ids = {}
+
+    def _add_update(self, index, result):
+        self.matched_count += result.matched_count
+        self.modified_count += result.modified_count
+        if result.upserted_id is not None:
+            self.upserted_count += 1
+            self.upserted_ids[index] = result.upserted_id
+
+    def __repr__(self):
+        return '{}(inserted_count={!r}, matched_count={!r}, modified_count={!r}, deleted_count={!r}, upserted_count={!r})'.format(
+            type(self).__name__, self.inserted_count, self.matched_count,
+            self.modified_count, self.deleted_count, self.upserted_count,
+        )
@@ -16,42 +16,240 @@
 
 from __future__ import absolute_import
 
+import itertools
 
-class ResultSet(object):
+from pymongres.cache import freeze
+from pymongres.parallel import DEFAULT_CHUNK_SIZE, parallel_scan
+from pymongres.query import Projection
 
-    def __init__(self, collection, spec, fields, order_by=None):
+
+# Number of rows fetched per round trip from the server-side cursor
+DEFAULT_BATCH_SIZE = 1000
+
+_cursor_ids = itertools.count(1)
+
+
+class BaseResultSet(object):
+    """
+    Query of a collection, refined by modifiers returning new result sets
+
+    Subclasses run the query: ResultSet with blocking calls, and
+    AsyncResultSet with asyncio.
+    """
+
+    def __init__(self, collection, spec, fields, order_by=None,
+                 batch_size=DEFAULT_BATCH_SIZE, limit=0, skip=0, after=None,
+                 id_range=None, document_class=dict):
         self.collection = collection
         self.spec = spec
         self.fields = fields
         self.order_by = order_by
+        self._batch_size = batch_size
+        self._limit = limit
+        self._skip = skip
+        self._after = after
+        self._id_range = id_range
+        self.document_class = document_class
+
+    def _clone(self, **kwargs):
+        params = {
+            'collection': self.collection,
+            'spec': self.spec,
+            'fields': self.fields,
+            'order_by': self.order_by,
+            'batch_size': self._batch_size,
+            'limit': self._limit,
+            'skip': self._skip,
+            'after': self._after,
+            'id_range': self._id_range,
+            'document_class': self.document_class,
+        }
+        params.update(kwargs)
+        return type(self)(**params)
+
+    def sort(self, key):
+        return self._clone(order_by=key)
+
+    def limit(self, limit):
+        """
+        Return at most ``limit`` documents (0 means no limit)
+        """
+        if limit < 0:
+            raise ValueError("limit must be positive")
+        return self._clone(limit=limit)
+
+    def skip(self, skip):
+        """
+        Skip the first ``skip`` documents
+
+        The server still has to compute the skipped rows: prefer after()
+        for deep pagination.
+        """
+        if skip < 0:
+            raise ValueError("skip must be positive")
+        return self._clone(skip=skip)
+
+    def after(self, value):
+        """
+        Keyset pagination: only return documents sorting after ``value``
+
+        ``value`` is the last ``_id`` of the previous page if the result
+        set is not sorted, and otherwise the last sort key value or a
+        ``(sort key value, _id)`` pair. Unlike skip(), this lets an index
+        on the sort key jump directly to the start of the page.
+        """
+        return self._clone(after=value)
+
+    def batch_size(self, batch_size):
+        """
+        Stream results from a server-side cursor, ``batch_size`` rows at a time
+
+        Only one batch is held in memory at once. A batch size of 0 uses a
+        client-side cursor instead, which fetches the whole result at once.
+        """
+        if batch_size < 0:
+            raise ValueError("batch_size must be positive")
+        return self._clone(batch_size=batch_size)
+
+
+class ResultSet(BaseResultSet):
 
     def __iter__(self):
-        sql_query = self.collection._find_query(self.spec, self.order_by)
+        projection = Projection.from_fields(self.fields, self.document_class)
+        for loads, rows in self._batches(projection):
+            for row in rows:
+                yield projection.document(row, loads)
 
-        with self.collection.database.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(sql_query)
-                for row in iter(cursor.fetchone, None):
-                    yield self.collection._document_from_row(row, fields=self.fields)
+    def _batches(self, projection):
+        """
+        Yield the rows of the query as they are fetched, with the function
+        decoding their JSON text
+        """
+        sql_query, params = self.collection._find_query(
+            self.spec, self.order_by, projection,
+            limit=self._limit, skip=self._skip, after=self._after,
+            id_range=self._id_range,
+        )
+
+        with self.collection._operation('find') as op:
+            with self._cursor(op.connection) as cursor:
+                # Server-side cursors cannot be declared over prepared statements
+                op.execute(cursor, sql_query, params)
+                fetch_size = self._batch_size or DEFAULT_BATCH_SIZE
+                loads = self.collection._loads(op, projection)
+                for rows in iter(lambda: op.fetchmany(cursor, fetch_size), []):
+                    yield loads, rows
+
+    def _cursor(self, connection):
+        if self._batch_size == 0:
+            return connection.cursor()
+        cursor = connection.cursor(name='pymongres_cursor_%d' % next(_cursor_ids))
+        cursor.itersize = self._batch_size
+        return cursor
 
     def __next__(self):
         return next(self.__iter__())
     next = __next__
 
     def count(self):
-        sql_query = self.collection._count_query(self.spec)
-
-        with self.collection.database.connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(sql_query)
-                count, = cursor.fetchone()
+        return self.collection._cached(
+            ('count', freeze(self.spec)),
+            lambda: self.collection._count(self.spec),
+        )
 
-        return count
+    def explain(self, analyze=False):
+        """
+        Return the PostgreSQL plan of the query, with a digest
 
-    def sort(self, key):
-        return ResultSet(
-            collection=self.collection,
-            spec=self.spec,
-            fields=self.fields,
-            order_by=key,
+        With ``analyze=True`` the query is executed to report actual row
+        counts, timings and buffer usage. The digest tells whether the
+        collection is read by a sequential scan and which of its indexes
+        are used, by the names returned by index_information().
+        """
+        projection = Projection.from_fields(self.fields, self.document_class)
+        sql_query, params = self.collection._find_query(
+            self.spec, self.order_by, projection,
+            limit=self._limit, skip=self._skip, after=self._after,
+            id_range=self._id_range,
         )
+        options = 'FORMAT JSON, ANALYZE, BUFFERS' if analyze else 'FORMAT JSON'
+
+        with self.collection._operation('explain') as op:
+            with op.connection.cursor() as cursor:
+                op.execute(cursor, 'EXPLAIN ({}) {}'.format(options, sql_query), params)
+                (plan,), = op.fetchall(cursor)
+
+        return _explain_digest(self.collection, sql_query, plan[0])
+
+    def parallel_map(self, func, workers=None, ordered=True,
+                     chunk_size=DEFAULT_CHUNK_SIZE, max_in_flight=None):
+        """
+        Apply a function to the documents in a pool of worker processes
+
+        The scan is split into ranges of ``chunk_size`` ids, each read and
+        processed by a worker on its own connection, and the results are
+        yielded in _id order, or as ranges complete if ``ordered`` is
+        false. At most ``max_in_flight`` ranges (twice the number of
+        workers by default) are processed or waiting to be consumed at any
+        time. ``func`` must be picklable, e.g. a module-level function.
+        Documents inserted in the meantime may or may not be seen.
+        """
+        if self.order_by not in (None, '_id') or self._limit or self._skip or self._after is not None:
+            raise ValueError("parallel scans do not support sort(), limit(), skip() or after()")
+        return parallel_scan(self, func, workers, ordered, chunk_size, max_in_flight)
+
+    def parallel_iter(self, **kwargs):
+        """
+        Iterate over the documents, read by worker processes
+
+        Workers send back the JSON text of the documents, which is decoded
+        in this process (or on access, for RawDocument results): use
+        parallel_map to run the work on the documents in the workers.
+        Takes the same options as parallel_map.
+        """
+        return self.parallel_map(None, **kwargs)
+
+    def distinct(self, key):
+        """
+        Return the distinct values of a key among the matching documents
+        """
+        return self.collection.distinct(key, self.spec)
+
+
+_INDEX_NODE_TYPES = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+
+
+def _explain_digest(collection, sql_query, plan):
+    nodes = []
+    stack = [plan['Plan']]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(node.get('Plans', [])))
+
+    indexes = []
+    for node in nodes:
+        relname = node.get('Index Name')
+        if node['Node Type'] in _INDEX_NODE_TYPES and relname:
+            name = collection._index_name_of(relname)
+            if name not in indexes:
+                indexes.append(name)
+
+    top = plan['Plan']
+    return {
+        'query': sql_query,
+        'plan': plan,
+        'seq_scan': any(
+            node['Node Type'] == 'Seq Scan' and node.get('Relation Name') == collection.name
+            for node in nodes
+        ),
+        'index_scan': bool(indexes),
+        'indexes': indexes,
+        'node_types': [node['Node Type'] for node in nodes],
+        'estimated_rows': top['Plan Rows'],
+        'actual_rows': top['Actual Rows'] * top['Actual Loops'] if 'Actual Rows' in top else None,
+        'shared_hit_blocks': top.get('Shared Hit Blocks'),
+        'shared_read_blocks': top.get('Shared Read Blocks'),
+        'planning_time': plan.get('Planning Time'),
+        'execution_time': plan.get('Execution Time'),
+    }
@@ -20,9 +20,13 @@ setup(
         "psycopg2",
         "six",
     ],
+    extras_require={
+        "async": ["aiopg"],
+        "fast": ["orjson"],
+    },
     setup_requires=[],
     tests_require=[],
-    packages=find_packages(exclude=['ez_setup', 'tests']),
+    packages=find_packages(exclude=['ez_setup', 'tests', 'benchmarks', 'benchmarks.*']),
     include_package_data=True,
     zip_safe=False,
     classifiers=[
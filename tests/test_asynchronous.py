@@ -0,0 +1,122 @@
+# coding: utf-8
+
+# Copyright 2009-2012 10gen, Inc.
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import asyncio
+from datetime import datetime
+import unittest
+
+try:
+    import aiopg
+except ImportError:
+    aiopg = None
+
+
+@unittest.skipIf(aiopg is None, "requires aiopg")
+class TestAsyncCollection(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        from pymongres.asynchronous import AsyncMongresClient
+        self.client = AsyncMongresClient()
+        self.db = self.client.pymongres_test
+        await self.db.drop_collection("test")
+
+    async def asyncTearDown(self):
+        await self.db.drop_collection("test")
+        await self.client.close()
+
+    async def test_insert_and_find_one(self):
+        _id = await self.db.test.insert({'author': 'Mike', 'date': datetime(2009, 11, 12)})
+        doc = await self.db.test.find_one({'author': 'Mike'})
+        self.assertEqual(_id, doc['_id'])
+        self.assertEqual('2009-11-12T00:00:00', doc['date'])
+        self.assertIsNone(await self.db.test.find_one({'author': 'Eliot'}))
+        self.assertIn('test', await self.db.collection_names())
+
+    async def test_bulk_insert(self):
+        ids = await self.db.test.insert(({'i': i, 'pct': '%s'} for i in range(7)), batch_size=3)
+        self.assertEqual(7, len(ids))
+        self.assertEqual(7, await self.db.test.count())
+        doc = await self.db.test.find_one({'_id': ids[4]})
+        self.assertEqual(4, doc['i'])
+
+    async def test_find(self):
+        await self.db.test.insert([{'i': i, 'k': 'k%d' % (i % 3)} for i in range(10)])
+        docs = [doc async for doc in self.db.test.find({'k': 'k1'}, ['i']).sort('_id').batch_size(2)]
+        self.assertEqual([1, 4, 7], [doc['i'] for doc in docs])
+        self.assertEqual(['_id', 'i'], sorted(docs[0]))
+        docs = await self.db.test.find().sort('_id').skip(2).limit(3).batch_size(0).to_list()
+        self.assertEqual([2, 3, 4], [doc['i'] for doc in docs])
+        self.assertEqual(4, await self.db.test.find({'k': 'k0'}).limit(1).count())
+
+    async def test_same_sql_as_sync_client(self):
+        from pymongres import MongresClient
+        await self.db.test.insert({'a': 1})
+        sync_docs = list(MongresClient().pymongres_test.test.find({'a': 1}))
+        async_docs = await self.db.test.find({'a': 1}).to_list()
+        self.assertEqual(sync_docs, async_docs)
+
+    async def test_remove(self):
+        await self.db.test.insert([{'i': i} for i in range(3)])
+        await self.db.test.remove({'i': 1})
+        self.assertEqual(2, await self.db.test.count())
+
+    async def test_pool_stats(self):
+        await self.db.test.count()
+        stats = self.client.pool_stats()['pymongres_test']
+        self.assertEqual(0, stats['in_use'])
+        self.assertGreaterEqual(stats['idle'], 1)
+
+    def test_sync_iteration_is_an_error(self):
+        self.assertRaises(TypeError, iter, self.db.test.find())
+
+    def test_blocking_methods_are_not_inherited(self):
+        result_set = self.db.test.find()
+        for name in ('distinct', 'explain', 'parallel_map', 'parallel_iter'):
+            self.assertFalse(hasattr(result_set, name), name)
+
+    async def test_batch(self):
+        ids = await self.db.test.insert([{'i': i} for i in range(4)])
+        batch = self.db.test.batch()
+        documents = await asyncio.gather(
+            batch.find_one(ids[2]), batch.find_one(ids[0]), batch.find_one(ids[2]), batch.find_one(10 ** 6),
+        )
+        self.assertEqual([2, 0, 2, None], [document and document['i'] for document in documents])
+        self.assertIs(documents[0], documents[2])
+        documents = await self.db.test.batch(fields=['i'], max_batch_size=3).load_many(reversed(ids))
+        self.assertEqual([3, 2, 1, 0], [document['i'] for document in documents])
+
+    async def test_watch(self):
+        stream = await self.db.test.watch()
+        async with stream:
+            self.assertIsNone(await stream.try_next())
+            _id = await self.db.test.insert({'name': 'a'})
+            await self.db.test.remove({'name': 'a'})
+            changes = []
+            async for change in stream:
+                changes.append(change)
+                if len(changes) == 2:
+                    break
+        self.assertEqual(['insert', 'delete'], [change['operationType'] for change in changes])
+        self.assertEqual({'_id': _id, 'name': 'a'}, changes[0]['fullDocument'])
+
+        stream = await self.db.test.watch(resume_after=changes[0]['_id'])
+        async with stream:
+            change = await stream.try_next(timeout=5)
+            self.assertEqual(changes[1]['_id'], change['_id'])
+        self.assertEqual([], [change async for change in stream])
@@ -20,6 +20,8 @@ from __future__ import absolute_import
 from six import iterkeys
 from six.moves import xrange
 
+import json
+import time
 import unittest
 
 
@@ -124,3 +126,1303 @@ class TestCollectionName(unittest.TestCase):
         db.test.insert(({'a': i} for i in xrange(5)), manipulate=False)
         self.assertEqual(5, db.test.count())
         db.test.remove({})
+
+
+class TestBulkInsert(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_ids_in_input_order(self):
+        ids = self.db.test.insert(({'i': i} for i in xrange(25)), batch_size=10)
+        self.assertEqual(25, len(ids))
+        for i, _id in enumerate(ids):
+            self.assertEqual(i, self.db.test.find_one({'_id': _id})['i'])
+
+    def test_copy(self):
+        import pymongres.collection
+        threshold = pymongres.collection.COPY_THRESHOLD
+        pymongres.collection.COPY_THRESHOLD = 5
+        try:
+            docs = [{'i': i, 'text': u'tab\there\nback\\slash é'} for i in xrange(12)]
+            ids = self.db.test.insert(docs, batch_size=5)
+        finally:
+            pymongres.collection.COPY_THRESHOLD = threshold
+        self.assertEqual(12, self.db.test.count())
+        for i, _id in enumerate(ids):
+            doc = self.db.test.find_one({'_id': _id})
+            self.assertEqual(i, doc['i'])
+            self.assertEqual(u'tab\there\nback\\slash é', doc['text'])
+        self.assertGreater(self.db.test.insert({'i': 12}), ids[-1])
+
+    def test_ordered_failure_inserts_nothing(self):
+        docs = [{'i': 0}, {'i': object()}, {'i': 2}]
+        self.assertRaises(TypeError, self.db.test.insert, docs)
+        self.assertEqual(0, self.db.test.count())
+
+    def test_unordered_skips_bad_documents(self):
+        from pymongres.errors import BulkInsertError
+        docs = [{'i': 0}, {'i': object()}, {'i': 2}]
+        with self.assertRaises(BulkInsertError) as cm:
+            self.db.test.insert(docs, ordered=False, batch_size=2)
+        ids = cm.exception.inserted_ids
+        self.assertEqual(3, len(ids))
+        self.assertIsNone(ids[1])
+        self.assertEqual([1], [index for index, exc in cm.exception.errors])
+        self.assertEqual(2, self.db.test.count())
+        self.assertEqual(2, self.db.test.find_one({'_id': ids[2]})['i'])
+
+    def test_unordered_without_errors(self):
+        ids = self.db.test.insert([{'i': 0}, {'i': 1}], ordered=False)
+        self.assertEqual(2, len(ids))
+
+
+class TestBatchSize(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.insert({'i': i} for i in xrange(10))
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_server_side_cursor(self):
+        docs = list(self.db.test.find().sort('_id').batch_size(3))
+        self.assertEqual(list(xrange(10)), [doc['i'] for doc in docs])
+
+    def test_client_side_cursor(self):
+        docs = list(self.db.test.find().batch_size(0))
+        self.assertEqual(10, len(docs))
+
+    def test_abandoned_iteration_releases_connection(self):
+        pool = self.client._get_pool('pymongres_test')
+        doc = next(self.db.test.find().batch_size(2))
+        self.assertIn('i', doc)
+        self.assertEqual(0, pool.stats()['in_use'])
+
+    def test_negative_batch_size(self):
+        self.assertRaises(ValueError, self.db.test.find().batch_size, -1)
+
+
+class TestCatalogCache(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.pool = self.client._get_pool('pymongres_test')
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_known_collection_costs_no_query(self):
+        self.db.test
+        checkouts = self.pool.stats()['checkouts']
+        self.db.test
+        self.client.pymongres_test['test']
+        self.assertEqual(checkouts, self.pool.stats()['checkouts'])
+
+    def test_drop_collection_updates_cache(self):
+        self.db.test
+        self.db.drop_collection("test")
+        self.assertFalse(self.db._table_exists("test"))
+        self.db.test.insert({'a': 1})
+        self.assertTrue(self.db._table_exists("test"))
+
+    def test_table_created_by_another_client(self):
+        from pymongres import MongresClient
+        self.db.drop_collection("test")
+        self.assertFalse(self.db._table_exists("test"))
+        MongresClient().pymongres_test.test.insert({'a': 1})
+        self.assertEqual(1, self.db.test.count())
+
+    def test_ttl(self):
+        from pymongres.catalog import Catalog
+        catalog = Catalog(ttl=0)
+        catalog.load('db', ['test'])
+        self.assertIsNone(catalog.get('db'))
+        catalog = Catalog()
+        catalog.load('db', ['test'])
+        catalog.add('db', 'other')
+        self.assertEqual(set(['test', 'other']), catalog.get('db'))
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.insert([
+            {'author': 'Mike', 'date': '2009-11-12', 'c': {'d': i}} for i in xrange(5)
+        ])
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def _plan(self, spec):
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                sql_query, params = self.db.test._find_query(spec)
+                cursor.execute("EXPLAIN " + sql_query, params)
+                return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def test_create_index(self):
+        name = self.db.test.create_index([('author', 1), ('date', -1)])
+        self.assertEqual('author_1_date_-1', name)
+        self.assertIn('test_author_1_date_-1', self._plan({'author': 'Mike'}))
+
+    def test_dotted_key(self):
+        self.assertEqual(1, self.db.test.find({'c.d': 3}).count())
+        self.db.test.create_index('c.d')
+        self.assertIn('test_c.d_1', self._plan({'c.d': {'$gte': '3'}}))
+        # Numeric equalities compile to containment, which B-tree indexes don't serve
+        self.assertNotIn('test_c.d_1', self._plan({'c.d': 3}))
+        self.db.test.create_index('$**')
+        self.assertIn('test_$**_1', self._plan({'c.d': 3}))
+
+    def test_overlapping_paths(self):
+        from pymongres.errors import OperationFailure
+        self.assertRaises(OperationFailure, self.db.test.find_one, {'c': {'d': 1}, 'c.d': 1})
+        self.assertRaises(OperationFailure, self.db.test.find_one, {}, {'c': 1, 'c.d': 1})
+        self.assertRaises(OperationFailure, self.db.test.update_one, {'c': 1, 'c.d': 1}, {'$set': {'x': 1}}, upsert=True)
+
+    def test_sparse_index(self):
+        self.db.test.create_index('author', sparse=True)
+        self.assertIn('test_author_1', self._plan({'author': 'Mike'}))
+
+    def test_unique_index(self):
+        import psycopg2
+        self.db.test.create_index('c.d', unique=True)
+        self.assertRaises(psycopg2.IntegrityError, self.db.test.insert, {'c': {'d': 1}})
+
+    def test_index_information(self):
+        self.db.test.create_index([('author', 1), ('c.d', -1)], unique=True)
+        self.db.test.ensure_index('date', sparse=True)
+        info = self.db.test.index_information()
+        self.assertEqual(set(['_id_', 'author_1_c.d_-1', 'date_1']), set(info))
+        self.assertEqual([('_id', 1)], info['_id_']['key'])
+        self.assertEqual([('author', 1), ('c.d', -1)], info['author_1_c.d_-1']['key'])
+        self.assertTrue(info['author_1_c.d_-1']['unique'])
+        self.assertTrue(info['date_1']['sparse'])
+
+    def test_create_index_twice(self):
+        from pymongres.errors import OperationFailure
+        self.db.test.create_index('author')
+        self.db.test.create_index('author')
+        self.assertEqual(2, len(self.db.test.index_information()))
+        self.assertRaises(OperationFailure, self.db.test.create_index, 'author', unique=True)
+        self.assertFalse(self.db.test.index_information()['author_1']['unique'])
+
+    def test_long_index_names(self):
+        first = self.db.test.create_index('author', name='a' * 70 + '1')
+        second = self.db.test.create_index('date', name='a' * 70 + '2')
+        info = self.db.test.index_information()
+        self.assertEqual([('author', 1)], info[first]['key'])
+        self.assertEqual([('date', 1)], info[second]['key'])
+        self.db.test.drop_index(first)
+        self.assertEqual(set(['_id_', second]), set(self.db.test.index_information()))
+
+    def test_drop_index(self):
+        from pymongres.errors import OperationFailure
+        self.db.test.create_index('author')
+        self.db.test.create_index([('date', -1)])
+        self.db.test.drop_index('author_1')
+        self.db.test.drop_index([('date', -1)])
+        self.assertEqual(['_id_'], list(self.db.test.index_information()))
+        self.assertRaises(OperationFailure, self.db.test.drop_index, 'author_1')
+        self.assertRaises(OperationFailure, self.db.test.drop_index, '_id_')
+
+    def test_drop_indexes(self):
+        self.db.test.create_index('author')
+        self.db.test.create_index('date')
+        self.db.test.drop_indexes()
+        self.assertEqual(['_id_'], list(self.db.test.index_information()))
+
+    def test_invalid_direction(self):
+        self.assertRaises(ValueError, self.db.test.create_index, [('author', 'text')])
+
+
+class TestJsonbQueries(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.insert([
+            {'a': i, 'b': {'c': i % 2, 'd': 'x'}, 'e': True} for i in xrange(10)
+        ])
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_where_clause(self):
+        from pymongres.query import compile_where
+        sql, params = compile_where({'a.b': 1})
+        self.assertEqual(" WHERE data @> %s", sql)
+        self.assertEqual({'a': {'b': 1}}, params[0].adapted)
+        sql, params = compile_where({'a': 'x'})
+        self.assertEqual(" WHERE data @> %s AND data->>'a' = %s", sql)
+        self.assertEqual('x', params[1])
+        sql, params = compile_where({'a.b': [1]})
+        self.assertEqual(""" WHERE data @> %s AND data#>'{"a","b"}' = %s::jsonb""", sql)
+        self.assertEqual([1], params[1].adapted)
+
+    def test_typed_equality(self):
+        self.assertEqual(1, self.db.test.find({'a': 3}).count())
+        self.assertEqual(0, self.db.test.find({'a': '3'}).count())
+        self.assertEqual(10, self.db.test.find({'e': True}).count())
+
+    def test_nested_equality(self):
+        self.assertEqual(5, self.db.test.find({'b': {'c': 1, 'd': 'x'}}).count())
+        self.assertEqual(0, self.db.test.find({'b': {'c': 1}}).count())
+        self.assertEqual(0, self.db.test.find({'b': {}}).count())
+        self.assertEqual(5, self.db.test.find({'b.c': 0, 'b.d': 'x'}).count())
+        self.assertEqual(1, self.db.test.find({'a': 4, 'b.c': 0}).count())
+        self.assertEqual(0, self.db.test.find({'a': 4, 'b.c': 1}).count())
+
+    def test_array_equality(self):
+        self.db.test.insert([{'tags': ['t1', 'z']}, {'tags': ['z']}, {'tags': []}])
+        self.assertEqual([['z']], [document['tags'] for document in self.db.test.find({'tags': ['z']})])
+        self.assertEqual([[]], [document['tags'] for document in self.db.test.find({'tags': []})])
+        self.assertIsNotNone(self.db.test.find_one({'tags': ['t1', 'z']}))
+
+    def test_wildcard_index(self):
+        self.assertEqual('$**_1', self.db.test.create_index('$**'))
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                sql_query, params = self.db.test._find_query({'b.c': 1, 'a': 3})
+                cursor.execute("EXPLAIN " + sql_query, params)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                sql_query, params = self.db.test._find_query({'b': {'c': 1, 'd': 'x'}})
+                cursor.execute("EXPLAIN " + sql_query, params)
+                plan += '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertEqual(2, plan.count('test_$**_1'))
+        self.assertRaises(ValueError, self.db.test.create_index, '$**', unique=True)
+        self.assertRaises(ValueError, self.db.test.create_index, [('$**', 1), ('a', 1)])
+
+    def test_migrate_to_jsonb(self):
+        self.db.drop_collection("test_json")
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE TABLE test_json (id serial PRIMARY KEY, data json)")
+                cursor.execute("""INSERT INTO test_json (data) VALUES ('{"a": 1}')""")
+        self.assertIn('test_json', self.db.migrate_to_jsonb())
+        self.assertEqual(1, self.db.test_json.find({'a': 1}).count())
+        self.assertEqual([], self.db.migrate_to_jsonb())
+        self.db.drop_collection("test_json")
+
+
+class TestProjection(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.insert({"a": 1, "b": None, "c": {"d": 5, "e": [1, 2]}, "big": list(xrange(100))})
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_columns(self):
+        from pymongres.query import Projection
+        self.assertEqual(
+            "id, (data->'a')::text, (data#>'{\"c\",\"d\"}')::text",
+            Projection.from_fields(['a', 'c.d']).columns(),
+        )
+        self.assertEqual(
+            "((data - 'big') #- '{\"c\",\"e\"}')",
+            Projection.from_fields({'_id': 0, 'big': 0, 'c.e': 0}).columns(),
+        )
+
+    def test_inclusion(self):
+        doc = self.db.test.find_one({}, ['a', 'c.e', 'missing'])
+        self.assertEqual(sorted(['_id', 'a', 'c']), sorted(doc))
+        self.assertEqual({'e': [1, 2]}, doc['c'])
+
+    def test_explicit_null_is_included(self):
+        doc = self.db.test.find_one({}, ['b'])
+        self.assertIn('b', doc)
+        self.assertIsNone(doc['b'])
+
+    def test_dict_inclusion(self):
+        doc = self.db.test.find_one({}, {'a': 1, '_id': 0})
+        self.assertEqual({'a': 1}, doc)
+
+    def test_id_only(self):
+        doc = self.db.test.find_one({}, {'_id': 1})
+        self.assertEqual(['_id'], list(doc))
+        self.assertEqual(doc, self.db.test.find_one({}, ['_id']))
+
+    def test_mixed_projection(self):
+        from pymongres.errors import OperationFailure
+        self.assertRaises(OperationFailure, self.db.test.find_one, {}, {'a': 1, 'big': 0})
+        self.assertEqual(['a'], list(self.db.test.find_one({}, {'a': 1, '_id': 0})))
+
+    def test_dotted_exclusion(self):
+        doc = next(self.db.test.find({}, {'big': False, 'c.e': False}))
+        self.assertEqual({'d': 5}, doc['c'])
+        self.assertNotIn('big', doc)
+        self.assertIn('_id', doc)
+
+
+class TestPagination(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.ids = self.db.test.insert({'i': i, 'k': 'k%d' % (i // 2)} for i in xrange(10))
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_limit(self):
+        docs = list(self.db.test.find().sort('_id').limit(3))
+        self.assertEqual([0, 1, 2], [doc['i'] for doc in docs])
+        self.assertEqual(10, len(list(self.db.test.find().limit(0))))
+
+    def test_skip(self):
+        docs = list(self.db.test.find().sort('_id').skip(8))
+        self.assertEqual([8, 9], [doc['i'] for doc in docs])
+        docs = list(self.db.test.find().sort('_id').skip(2).limit(2))
+        self.assertEqual([2, 3], [doc['i'] for doc in docs])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.db.test.find().limit, -1)
+        self.assertRaises(ValueError, self.db.test.find().skip, -1)
+
+    def test_after_id(self):
+        docs = list(self.db.test.find().after(self.ids[6]).limit(2))
+        self.assertEqual([7, 8], [doc['i'] for doc in docs])
+
+    def test_after_sort_key(self):
+        docs = list(self.db.test.find().sort('k').after('k3'))
+        self.assertEqual([8, 9], sorted(doc['i'] for doc in docs))
+
+    def test_after_pair(self):
+        pages = []
+        after = None
+        while True:
+            result_set = self.db.test.find({'k': {'$gte': 'k0'}}, ['k']).sort('k').limit(3)
+            if after is not None:
+                result_set = result_set.after(after)
+            page = list(result_set)
+            if not page:
+                break
+            pages.append(page)
+            after = (page[-1]['k'], page[-1]['_id'])
+        self.assertEqual([3, 3, 3, 1], [len(page) for page in pages])
+        self.assertEqual(self.ids, [doc['_id'] for page in pages for doc in page])
+
+    def test_find_one_limits_query(self):
+        sql, params = self.db.test._find_query(None, limit=1)
+        self.assertTrue(sql.endswith(' LIMIT %s'))
+        self.assertEqual([1], params)
+
+
+class TestAggregate(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.insert([
+            {'author': 'Mike', 'votes': 3, 'tag': 'a', 'meta': {'lang': 'en'}},
+            {'author': 'Mike', 'votes': 5, 'tag': 'b', 'meta': {'lang': 'fr'}},
+            {'author': 'Eliot', 'votes': 1, 'tag': 'a', 'meta': {'lang': 'en'}},
+            {'author': 'Eliot', 'tag': 'c'},
+            {'author': 'Bernie', 'votes': 10, 'tag': 'a'},
+        ])
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_group(self):
+        result = self.db.test.aggregate([
+            {'$match': {'tag': 'a'}},
+            {'$group': {'_id': '$author', 'total': {'$sum': '$votes'}, 'count': {'$sum': 1}}},
+            {'$sort': {'total': -1}},
+        ])
+        self.assertEqual([
+            {'_id': 'Bernie', 'total': 10, 'count': 1},
+            {'_id': 'Mike', 'total': 3, 'count': 1},
+            {'_id': 'Eliot', 'total': 1, 'count': 1},
+        ], result)
+
+    def test_accumulators(self):
+        result = self.db.test.aggregate([
+            {'$group': {
+                '_id': None,
+                'avg': {'$avg': '$votes'},
+                'min': {'$min': '$votes'},
+                'max': {'$max': '$author'},
+                'tags': {'$addToSet': '$tag'},
+                'langs': {'$push': '$meta.lang'},
+            }},
+        ])
+        self.assertEqual(1, len(result))
+        doc = result[0]
+        self.assertIsNone(doc['_id'])
+        self.assertAlmostEqual(4.75, doc['avg'])
+        self.assertEqual(1, doc['min'])
+        self.assertEqual('Mike', doc['max'])
+        self.assertEqual(['a', 'b', 'c'], sorted(doc['tags']))
+        self.assertEqual(['en', 'en', 'fr'], sorted(doc['langs']))
+
+    def test_group_on_empty_input(self):
+        result = self.db.test.aggregate([
+            {'$match': {'author': 'Nobody'}},
+            {'$group': {'_id': None, 'count': {'$sum': 1}}},
+        ])
+        self.assertEqual([], result)
+
+    def test_compound_group_key_and_limit(self):
+        result = self.db.test.aggregate([
+            {'$group': {'_id': {'author': '$author', 'lang': '$meta.lang'}, 'n': {'$sum': 1}}},
+            {'$sort': {'_id.author': 1, '_id.lang': 1}},
+            {'$limit': 2},
+            {'$project': {'_id': 0, 'author': '$_id.author', 'n': 1}},
+        ])
+        self.assertEqual([{'author': 'Bernie', 'n': 1}, {'author': 'Eliot', 'n': 1}], result)
+
+    def test_documents_pipeline(self):
+        result = self.db.test.aggregate([
+            {'$match': {'author': 'Mike'}},
+            {'$sort': {'votes': -1}},
+            {'$limit': 1},
+            {'$project': {'votes': 1, 'meta.lang': 1, 'missing': 1}},
+        ])
+        self.assertEqual(1, len(result))
+        self.assertEqual(['_id', 'meta', 'votes'], sorted(result[0]))
+        self.assertEqual({'lang': 'fr'}, result[0]['meta'])
+
+    def test_exclusion_and_skip(self):
+        result = self.db.test.aggregate([
+            {'$sort': {'_id': 1}},
+            {'$skip': 3},
+            {'$project': {'meta': 0, 'tag': 0}},
+        ])
+        self.assertEqual([['_id', 'author'], ['_id', 'author', 'votes']], [sorted(doc) for doc in result])
+
+    def test_exclude_id_only(self):
+        result = self.db.test.aggregate([
+            {'$sort': {'_id': 1}},
+            {'$limit': 1},
+            {'$project': {'_id': 0}},
+        ])
+        expected = self.db.test.find().sort('_id').limit(1).next()
+        del expected['_id']
+        self.assertEqual([expected], list(result))
+
+    def test_match_after_sort_and_limit(self):
+        result = self.db.test.aggregate([
+            {'$sort': {'_id': 1}},
+            {'$limit': 2},
+            {'$match': {'tag': 'a'}},
+        ])
+        self.assertEqual(['Mike'], [doc['author'] for doc in result])
+
+    def test_sort_is_kept_by_later_stages(self):
+        from pymongres.aggregation import compile_pipeline
+        pipeline = [{'$sort': {'votes': -1}}, {'$match': {'author': {'$gt': 'A'}}}, {'$project': {'_id': 0, 'votes': 1}}]
+        sql, params = compile_pipeline('test', pipeline)
+        self.assertTrue(sql.endswith('ORDER BY pymongres_order'), sql)
+        result = self.db.test.aggregate(pipeline)
+        self.assertEqual([10, 5, 3, 1], [doc['votes'] for doc in result if doc])
+        result = self.db.test.aggregate([
+            {'$sort': {'votes': 1}},
+            {'$group': {'_id': '$tag', 'authors': {'$push': '$author'}}},
+            {'$sort': {'_id': 1}},
+        ])
+        self.assertEqual(['Eliot', 'Mike', 'Bernie'], result[0]['authors'])
+        result = self.db.test.aggregate([
+            {'$sort': {'votes': -1}},
+            {'$group': {'_id': '$tag', 'authors': {'$push': '$author'}}},
+            {'$sort': {'_id': 1}},
+        ])
+        self.assertEqual(['Bernie', 'Mike', 'Eliot'], result[0]['authors'])
+
+    def test_errors(self):
+        from pymongres.errors import OperationFailure
+        self.assertRaises(OperationFailure, self.db.test.aggregate, [{'$out': 'x'}])
+        self.assertRaises(OperationFailure, self.db.test.aggregate, [{'$group': {'n': {'$sum': 1}}}])
+        self.assertRaises(OperationFailure, self.db.test.aggregate, [
+            {'$group': {'_id': '$author'}}, {'$match': {'_id': 'Mike'}},
+        ])
+
+
+class TestDistinctAndEstimatedCount(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.insert([
+            {'author': 'Mike', 'votes': 3, 'meta': {'lang': 'en'}},
+            {'author': 'Mike', 'votes': 5, 'meta': {'lang': 'fr'}},
+            {'author': 'Eliot', 'votes': 3},
+            {'votes': 10},
+        ])
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_distinct(self):
+        self.assertEqual(['Eliot', 'Mike'], self.db.test.distinct('author'))
+        self.assertEqual([3, 5, 10], self.db.test.distinct('votes'))
+        self.assertEqual(['en', 'fr'], self.db.test.distinct('meta.lang'))
+        self.assertEqual(4, len(self.db.test.distinct('_id')))
+
+    def test_distinct_types(self):
+        self.db.test.insert([{'votes': '5'}, {'votes': None}])
+        self.assertEqual(['5', 3, 5, 10], self.db.test.distinct('votes'))
+
+    def test_distinct_with_spec(self):
+        self.assertEqual([3, 5], sorted(self.db.test.distinct('votes', {'author': 'Mike'})))
+        self.assertEqual(['Mike'], self.db.test.find({'votes': 5}).distinct('author'))
+
+    def test_estimated_document_count(self):
+        self.assertEqual(4, self.db.test.estimated_document_count())
+        self.db.test.insert({'i': i} for i in xrange(1000))
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE test")
+        self.assertEqual(1004, self.db.test.estimated_document_count())
+        # Scaled to the current table size between two ANALYZE
+        self.db.test.insert({'i': i} for i in xrange(1000))
+        estimate = self.db.test.estimated_document_count()
+        self.assertGreater(estimate, 1800)
+        self.assertLess(estimate, 2200)
+
+    def test_estimated_document_count_never_analyzed(self):
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT rolsuper FROM pg_roles WHERE rolname = current_user")
+                if not cursor.fetchone()[0]:
+                    self.skipTest("requires a superuser")
+                # Statistics of a table never analyzed before PostgreSQL 14
+                cursor.execute("UPDATE pg_class SET reltuples = 0, relpages = 0 WHERE oid = 'test'::regclass")
+        self.assertEqual(4, self.db.test.estimated_document_count())
+
+    def test_estimated_document_count_empty(self):
+        self.db.drop_collection("test")
+        self.assertEqual(0, self.db.test.estimated_document_count())
+
+
+class TestUpdate(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.ids = self.db.test.insert([
+            {'author': 'Mike', 'votes': 3, 'tags': ['a']},
+            {'author': 'Mike', 'votes': 5},
+            {'author': 'Eliot', 'votes': 1},
+        ])
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_update_one(self):
+        res = self.db.test.update_one({'author': 'Mike'}, {'$inc': {'votes': 1}})
+        self.assertEqual((1, 1), (res.matched_count, res.modified_count))
+        self.assertEqual([4, 5], sorted(doc['votes'] for doc in self.db.test.find({'author': 'Mike'})))
+
+    def test_update_many(self):
+        res = self.db.test.update_many({'author': 'Mike'}, {
+            '$set': {'meta.lang': 'en', 'checked': True},
+            '$unset': {'votes': ''},
+            '$push': {'tags': 'b'},
+        })
+        self.assertEqual((2, 2), (res.matched_count, res.modified_count))
+        first = self.db.test.find_one({'_id': self.ids[0]})
+        self.assertEqual(
+            {'_id': self.ids[0], 'author': 'Mike', 'tags': ['a', 'b'], 'meta': {'lang': 'en'}, 'checked': True},
+            first,
+        )
+        self.assertEqual(['b'], self.db.test.find_one({'_id': self.ids[1]})['tags'])
+        self.assertEqual(1, self.db.test.find_one({'author': 'Eliot'})['votes'])
+
+    def test_push_each_and_inc_float(self):
+        self.db.test.update_one({'_id': self.ids[0]}, {
+            '$push': {'tags': {'$each': ['b', 'c']}},
+            '$inc': {'votes': 0.5, 'stats.views': 2},
+        })
+        doc = self.db.test.find_one({'_id': self.ids[0]})
+        self.assertEqual(['a', 'b', 'c'], doc['tags'])
+        self.assertEqual(3.5, doc['votes'])
+        self.assertEqual({'views': 2}, doc['stats'])
+
+    def test_push_to_non_array(self):
+        from pymongres.errors import OperationFailure
+        self.db.test.update_one({'_id': self.ids[0]}, {'$set': {'s': 'str', 'o': {'x': 1}}})
+        with self.assertRaises(OperationFailure):
+            self.db.test.update_one({'_id': self.ids[0]}, {'$push': {'s': 1}})
+        with self.assertRaises(OperationFailure):
+            self.db.test.update_many({}, {'$push': {'o': {'$each': [2]}}})
+        doc = self.db.test.find_one({'_id': self.ids[0]})
+        self.assertEqual(('str', {'x': 1}), (doc['s'], doc['o']))
+        self.db.test.create_index('u', unique=True)
+        with self.assertRaises(OperationFailure):
+            self.db.test.update_one({'u': 'x'}, {'$push': {'u': 1}}, upsert=True)
+
+    def test_modified_count(self):
+        res = self.db.test.update_many({'author': 'Mike'}, {'$set': {'votes': 5}})
+        self.assertEqual((2, 1), (res.matched_count, res.modified_count))
+        res = self.db.test.update_many({'author': 'Nobody'}, {'$set': {'votes': 5}})
+        self.assertEqual((0, 0), (res.matched_count, res.modified_count))
+
+    def test_invalid_updates(self):
+        from pymongres.errors import OperationFailure
+        with self.assertRaises(ValueError):
+            self.db.test.update_one({}, {'votes': 1})
+        with self.assertRaises(OperationFailure):
+            self.db.test.update_one({}, {'$rename': {'votes': 'score'}})
+        with self.assertRaises(OperationFailure):
+            self.db.test.update_one({}, {'$set': {'_id': 1}})
+        with self.assertRaises(OperationFailure):
+            self.db.test.update_one({}, {'$set': {'meta': {}}, '$unset': {'meta.lang': ''}})
+
+
+class TestUpsert(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.create_index('email', unique=True)
+        self._id = self.db.test.insert({'email': 'mike@example.com', 'visits': 1})
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_replace_one(self):
+        res = self.db.test.replace_one({'email': 'mike@example.com'}, {'email': 'mike@example.com', 'name': 'Mike'})
+        self.assertEqual((1, 1, None), (res.matched_count, res.modified_count, res.upserted_id))
+        self.assertEqual(
+            {'_id': self._id, 'email': 'mike@example.com', 'name': 'Mike'},
+            self.db.test.find_one({'email': 'mike@example.com'}),
+        )
+        res = self.db.test.replace_one({'email': 'nobody@example.com'}, {'name': 'Nobody'})
+        self.assertEqual((0, 0), (res.matched_count, res.modified_count))
+        self.assertEqual(1, self.db.test.count())
+
+    def test_replace_one_upsert(self):
+        res = self.db.test.replace_one({'email': 'mike@example.com'}, {'name': 'Mike'}, upsert=True)
+        self.assertEqual((1, 1, None), (res.matched_count, res.modified_count, res.upserted_id))
+        self.assertEqual(
+            {'_id': self._id, 'email': 'mike@example.com', 'name': 'Mike'},
+            self.db.test.find_one({'email': 'mike@example.com'}),
+        )
+
+        res = self.db.test.replace_one({'email': 'mike@example.com'}, {'name': 'Mike'}, upsert=True)
+        self.assertEqual((1, 0, None), (res.matched_count, res.modified_count, res.upserted_id))
+
+        res = self.db.test.replace_one({'email': 'eliot@example.com'}, {'name': 'Eliot'}, upsert=True)
+        self.assertEqual((0, 0), (res.matched_count, res.modified_count))
+        self.assertEqual(
+            {'_id': res.upserted_id, 'email': 'eliot@example.com', 'name': 'Eliot'},
+            self.db.test.find_one({'email': 'eliot@example.com'}),
+        )
+        self.assertEqual(2, self.db.test.count())
+
+    def test_update_one_upsert(self):
+        update = {'$inc': {'visits': 1}, '$setOnInsert': {'first': True}}
+        res = self.db.test.update_one({'email': 'mike@example.com'}, update, upsert=True)
+        self.assertEqual((1, 1, None), (res.matched_count, res.modified_count, res.upserted_id))
+        self.assertEqual(
+            {'_id': self._id, 'email': 'mike@example.com', 'visits': 2},
+            self.db.test.find_one({'email': 'mike@example.com'}),
+        )
+
+        res = self.db.test.update_one({'email': 'eliot@example.com'}, update, upsert=True)
+        self.assertIsNotNone(res.upserted_id)
+        self.assertEqual(
+            {'_id': res.upserted_id, 'email': 'eliot@example.com', 'visits': 1, 'first': True},
+            self.db.test.find_one({'email': 'eliot@example.com'}),
+        )
+
+    def test_upsert_by_id(self):
+        _id = self._id + 5
+        res = self.db.test.update_one({'_id': _id}, {'$set': {'name': 'Eliot'}}, upsert=True)
+        self.assertEqual(_id, res.upserted_id)
+        self.assertEqual({'_id': _id, 'name': 'Eliot'}, self.db.test.find_one({'_id': _id}))
+        # The ids handed out by the sequence skip the upserted one
+        ids = self.db.test.insert([{'i': i} for i in xrange(6)])
+        self.assertTrue(all(new_id > _id for new_id in ids))
+
+    def test_upsert_requires_unique_index(self):
+        from pymongres.errors import OperationFailure
+        with self.assertRaises(OperationFailure):
+            self.db.test.update_one({'name': 'Mike'}, {'$set': {'visits': 1}}, upsert=True)
+        with self.assertRaises(OperationFailure):
+            self.db.test.update_one({'email': {'$gt': 'a'}}, {'$set': {'visits': 1}}, upsert=True)
+
+    def test_replacement_conflicts(self):
+        from pymongres.errors import OperationFailure
+        with self.assertRaises(ValueError):
+            self.db.test.replace_one({'email': 'mike@example.com'}, {'email': 'other@example.com'})
+        with self.assertRaises(OperationFailure):
+            self.db.test.replace_one({'email': 'mike@example.com'}, {'_id': self._id + 1})
+
+
+class TestBulkWrite(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.create_index('name', unique=True)
+        self.ids = self.db.test.insert([
+            {'name': 'a', 'n': 1},
+            {'name': 'b', 'n': 2},
+            {'name': 'c', 'n': 3},
+        ])
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_bulk_write(self):
+        from pymongres import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+        result = self.db.test.bulk_write([
+            InsertOne({'name': 'd', 'n': 4}),
+            InsertOne({'name': 'e', 'n': 5}),
+            UpdateOne({'name': 'a'}, {'$inc': {'n': 10}}),
+            UpdateMany({}, {'$set': {'seen': True}}),
+            ReplaceOne({'name': 'f'}, {'n': 6}, upsert=True),
+            DeleteMany({'name': 'b'}),
+            DeleteMany({'n': {'$gt': '4'}}),
+            DeleteOne({'name': 'a', 'seen': True}),
+        ])
+        self.assertEqual(2, result.inserted_count)
+        self.assertEqual([0, 1], sorted(result.inserted_ids))
+        self.assertEqual(6, result.matched_count)
+        self.assertEqual(6, result.modified_count)
+        self.assertEqual(1, result.upserted_count)
+        self.assertEqual([4], list(result.upserted_ids))
+        self.assertEqual(4, result.deleted_count)
+        self.assertEqual(['c', 'd'], sorted(doc['name'] for doc in self.db.test.find()))
+
+    def test_ordered_failure_rolls_back(self):
+        from pymongres import InsertOne, UpdateOne
+        from pymongres.errors import BulkWriteError
+        with self.assertRaises(BulkWriteError) as cm:
+            self.db.test.bulk_write([
+                UpdateOne({'name': 'a'}, {'$set': {'n': 0}}),
+                InsertOne({'name': 'd'}),
+                InsertOne({'name': 'a'}),
+                InsertOne({'name': 'e'}),
+            ])
+        self.assertEqual([2], [index for index, _ in cm.exception.errors])
+        self.assertEqual(3, self.db.test.count())
+        self.assertEqual(1, self.db.test.find_one({'name': 'a'})['n'])
+
+    def test_unordered_failures(self):
+        from pymongres import DeleteMany, InsertOne, UpdateOne
+        from pymongres.errors import BulkWriteError
+        with self.assertRaises(BulkWriteError) as cm:
+            self.db.test.bulk_write([
+                InsertOne({'name': 'd'}),
+                InsertOne({'name': 'a'}),
+                UpdateOne({'name': 'b'}, {'$inc': {'name': 1}}),
+                UpdateOne({'name': 'c'}, {'$set': {'n': 0}}),
+                DeleteMany({'name': {'$in': ['a']}}),
+                DeleteMany({'name': 'b'}),
+                'not an operation',
+            ], ordered=False)
+        self.assertEqual([1, 2, 4, 6], [index for index, _ in cm.exception.errors])
+        result = cm.exception.result
+        self.assertEqual((1, 1, 1, 1), (
+            result.inserted_count, result.matched_count, result.modified_count, result.deleted_count,
+        ))
+        self.assertEqual(['a', 'c', 'd'], sorted(doc['name'] for doc in self.db.test.find()))
+        self.assertEqual(0, self.db.test.find_one({'name': 'c'})['n'])
+
+
+class TestExplain(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.insert({'name': 'n%d' % i, 'i': i} for i in xrange(2000))
+        self.db.test.create_index('name')
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE test")
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_index_scan(self):
+        explain = self.db.test.find({'name': {'$eq': 'n42'}}).explain()
+        self.assertTrue(explain['index_scan'])
+        self.assertFalse(explain['seq_scan'])
+        self.assertEqual(['name_1'], explain['indexes'])
+        self.assertIsNone(explain['actual_rows'])
+
+    def test_seq_scan(self):
+        explain = self.db.test.find().explain()
+        self.assertTrue(explain['seq_scan'])
+        self.assertEqual([], explain['indexes'])
+        self.assertEqual(['Seq Scan'], explain['node_types'])
+
+    def test_analyze(self):
+        explain = self.db.test.find({'_id': {'$lt': 11}}).sort('_id').limit(5).explain(analyze=True)
+        self.assertEqual(['_id_'], explain['indexes'])
+        self.assertEqual(5, explain['actual_rows'])
+        self.assertGreater(explain['shared_hit_blocks'] + explain['shared_read_blocks'], 0)
+        self.assertIsNotNone(explain['execution_time'])
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.insert([{'a': 1}, {'a': 2}])
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+        self.client.close()
+
+    def _delete_directly(self):
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM test WHERE data->>'a' = '2'")
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(self.db.test.cache_stats())
+        self.assertEqual(2, self.db.test.count())
+
+    def test_hits_and_copies(self):
+        self.db.test.enable_cache()
+        doc = self.db.test.find_one({'a': 1})
+        doc['a'] = 3
+        self.assertEqual(1, self.db.test.find_one({'a': 1})['a'])
+        self.assertEqual(2, self.db.test.count())
+        self.assertEqual(2, self.db.test.find().count())
+        stats = self.db.test.cache_stats()
+        self.assertEqual((2, 2), (stats['hits'], stats['misses']))
+        # Values of different types are different keys
+        self.assertIsNone(self.db.test.find_one({'a': True}))
+
+    def test_invalidated_by_writes(self):
+        self.db.test.enable_cache()
+        self.assertEqual(2, self.db.test.count())
+        self.db.test.insert({'a': 3})
+        self.assertEqual(3, self.db.test.count())
+        self.db.test.update_one({'a': 3}, {'$set': {'b': 1}})
+        self.assertEqual(1, self.db.test.find_one({'a': 3})['b'])
+        self.db.test.remove({'a': 3})
+        self.assertIsNone(self.db.test.find_one({'a': 3}))
+        self.assertEqual(3, self.db.test.cache_stats()['invalidations'])
+
+        # Writes by others go unnoticed until the entry expires
+        self.assertEqual(2, self.db.test.count())
+        self._delete_directly()
+        self.assertEqual(2, self.db.test.count())
+
+    def test_ttl_and_size(self):
+        import time
+        self.db.test.enable_cache(max_size=1, ttl=0.05)
+        self.db.test.find_one({'a': 1})
+        self.db.test.find_one({'a': 2})
+        self.assertEqual(1, self.db.test.cache_stats()['evictions'])
+        time.sleep(0.1)
+        self.db.test.find_one({'a': 2})
+        stats = self.db.test.cache_stats()
+        self.assertEqual((0, 3, 1), (stats['hits'], stats['misses'], stats['expirations']))
+
+    def test_notify(self):
+        import time
+        self.db.test.enable_cache(notify=True)
+        self.assertEqual(2, self.db.test.count())
+        self._delete_directly()
+        for _ in range(50):
+            if self.db.test.count() == 1:
+                break
+            time.sleep(0.05)
+        self.assertEqual(1, self.db.test.count())
+        self.assertIn('pymongres_test.test', self.client.cache_stats())
+
+
+class TestJsonLines(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.drop_collection("test_copy")
+        self.documents = [
+            {'i': i, 'text': u'tab\there "quoted" \\ back\\slash\nnewline é'}
+            for i in xrange(25)
+        ]
+        self.ids = self.db.test.insert(self.documents)
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+        self.db.drop_collection("test_copy")
+
+    def test_round_trip(self):
+        import io
+        import json
+        buf = io.StringIO()
+        progress = []
+        self.assertEqual(25, self.db.test.export_jsonl(buf, progress=progress.append, progress_interval=10))
+        self.assertEqual([10, 20], progress)
+        lines = buf.getvalue().splitlines()
+        self.assertEqual(25, len(lines))
+        self.assertEqual(dict(self.documents[0], _id=self.ids[0]), json.loads(lines[0]))
+
+        buf.seek(0)
+        del progress[:]
+        self.assertEqual(25, self.db.test_copy.import_jsonl(buf, batch_size=10, progress=progress.append))
+        self.assertEqual([10, 20, 25], progress)
+        self.assertEqual(
+            list(self.db.test.find().sort('_id')),
+            list(self.db.test_copy.find().sort('_id')),
+        )
+        # The sequence continues after the imported ids
+        self.assertGreater(self.db.test_copy.insert({'new': True}), max(self.ids))
+
+    def test_export_spec_and_binary_files(self):
+        import io
+        buf = io.BytesIO()
+        self.assertEqual(2, self.db.test.export_jsonl(buf, {'_id': {'$lte': self.ids[1]}}))
+        buf = io.BytesIO(buf.getvalue() + b'\n{"x": 1}\n')
+        self.assertEqual(3, self.db.test_copy.import_jsonl(buf, batch_size=2, keep_ids=False))
+        self.assertEqual(1, self.db.test_copy.find_one({'x': 1})['x'])
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM test_copy WHERE data ? '_id'")
+                self.assertEqual((0,), cursor.fetchone())
+
+    def test_import_other_ids(self):
+        import io
+        lines = [u'{"_id": 7, "a": 1}', u'{"_id": "x", "a": 2}', u'{"_id": 2.5, "a": 3}',
+                 u'{"_id": 8.0, "a": 4}', u'{"_id": 3000000000, "a": 5}', u'{"a": 6}']
+        self.assertEqual(6, self.db.test_copy.import_jsonl(io.StringIO(u'\n'.join(lines))))
+        self.assertEqual(7, self.db.test_copy.find_one({'a': 1})['_id'])
+        self.assertEqual(8, self.db.test_copy.find_one({'a': 4})['_id'])
+        ids = [document['_id'] for document in self.db.test_copy.find()]
+        self.assertEqual(6, len(set(ids)))
+        self.assertNotIn('x', ids)
+
+    def test_import_with_and_without_ids(self):
+        import io
+        lines = u'{"_id": 1, "a": 1}\n{"b": 2}\n{"_id": 2, "a": 2}\n{"b": 3}\n{"_id": 5, "a": 5}\n'
+        self.assertEqual(5, self.db.test_copy.import_jsonl(io.StringIO(lines), batch_size=3))
+        documents = list(self.db.test_copy.find())
+        self.assertEqual([1, 2, 5], sorted(document['_id'] for document in documents if 'a' in document))
+        self.assertEqual(5, len(set(document['_id'] for document in documents)))
+
+    def test_invalid_line(self):
+        import io
+        import psycopg2
+        with self.assertRaises(psycopg2.DataError):
+            self.db.test_copy.import_jsonl(io.StringIO(u'{"a": 1}\nnot json\n'))
+        self.assertEqual(0, self.db.test_copy.count())
+
+
+def _double(document):
+    return document['_id'], document['i'] * 2
+
+
+def _missing_key(document):
+    return document['missing']
+
+
+def _is_raw(document):
+    from pymongres import RawDocument
+    return isinstance(document, RawDocument)
+
+
+class TestParallelScan(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.ids = self.db.test.insert({'i': i, 'even': i % 2 == 0} for i in xrange(250))
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_parallel_map_ordered(self):
+        results = list(self.db.test.find().parallel_map(_double, workers=2, chunk_size=30, max_in_flight=3))
+        self.assertEqual([(_id, i * 2) for i, _id in enumerate(self.ids)], results)
+
+    def test_parallel_iter_unordered(self):
+        documents = list(self.db.test.find({'even': True}, ['i']).parallel_iter(workers=3, ordered=False, chunk_size=20))
+        self.assertEqual(125, len(documents))
+        self.assertEqual(list(range(0, 250, 2)), sorted(document['i'] for document in documents))
+        self.assertEqual(set(['_id', 'i']), set(documents[0]))
+
+    def test_document_class(self):
+        from pymongres import RawDocument
+        documents = list(self.db.test.find(document_class=RawDocument).parallel_iter(workers=2, chunk_size=100))
+        self.assertTrue(all(isinstance(document, RawDocument) for document in documents))
+        self.assertFalse(documents[0].decoded)
+        self.assertEqual(list(range(250)), [document['i'] for document in documents])
+        results = list(self.db.test.find(document_class=RawDocument).parallel_map(_is_raw, workers=2))
+        self.assertEqual([True] * 250, results)
+
+    def test_empty_and_errors(self):
+        self.assertEqual([], list(self.db.test.find({'i': 'none'}).parallel_iter(workers=1)))
+        with self.assertRaises(ValueError):
+            self.db.test.find().sort('i').parallel_iter()
+        with self.assertRaises(KeyError):
+            list(self.db.test.find().parallel_map(_missing_key, workers=1))
+
+
+class TestRawDocument(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.ids = self.db.test.insert([
+            {'name': 'a', 'tags': ['x', 'y'], 'info': {'age': 30, 'city': 'Paris'}},
+            {'name': 'b', 'tags': [], 'info': {'age': 40}},
+        ])
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_find_one_lazy(self):
+        from pymongres import RawDocument
+        document = self.db.test.find_one({'name': 'a'}, document_class=RawDocument)
+        self.assertIsInstance(document, RawDocument)
+        self.assertEqual(self.ids[0], document['_id'])
+        self.assertFalse(document.decoded)
+        self.assertEqual({'name': 'a', 'tags': ['x', 'y'], 'info': {'age': 30, 'city': 'Paris'}},
+                         json.loads(document.raw))
+        self.assertEqual('Paris', document['info']['city'])
+        self.assertTrue(document.decoded)
+        self.assertEqual(set(['_id', 'name', 'tags', 'info']), set(document))
+        self.assertEqual(self.db.test.find_one({'name': 'a'}), document)
+
+    def test_to_dict(self):
+        from pymongres import RawDocument
+        document = self.db.test.find_one({'name': 'b'}, document_class=RawDocument)
+        copy = document.to_dict()
+        self.assertEqual({'_id': self.ids[1], 'name': 'b', 'tags': [], 'info': {'age': 40}}, copy)
+        copy['info']['age'] = 41
+        self.assertEqual(40, document['info']['age'])
+        self.assertEqual(40, document.to_dict()['info']['age'])
+
+    def test_find_with_fields(self):
+        from pymongres import RawDocument
+        documents = list(self.db.test.find(None, {'tags': 0}, document_class=RawDocument).sort('name'))
+        self.assertEqual([{'_id': self.ids[0], 'name': 'a', 'info': {'age': 30, 'city': 'Paris'}},
+                          {'_id': self.ids[1], 'name': 'b', 'info': {'age': 40}}], [dict(d) for d in documents])
+        documents = list(self.db.test.find(None, {'_id': 0, 'info.age': 1}, document_class=RawDocument).limit(1))
+        self.assertEqual([{'info': {'age': 30}}], [dict(d) for d in documents])
+        self.assertNotIn('_id', documents[0])
+        self.assertEqual({'info': {'age': 30}}, json.loads(documents[0].raw))
+
+    def test_invalid_document_class(self):
+        with self.assertRaises(TypeError):
+            self.db.test.find_one(document_class=list)
+
+
+class TestChangeStream(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient()
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.drop_collection("other")
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+        self.db.drop_collection("other")
+
+    def _changes(self, stream, n):
+        changes = [stream.try_next(timeout=5) for _ in xrange(n)]
+        self.assertNotIn(None, changes)
+        return changes
+
+    def test_insert_update_delete(self):
+        with self.db.test.watch() as stream:
+            self.assertIsNone(stream.try_next())
+            _id = self.db.test.insert({'name': 'a', 'n': 1})
+            self.db.other.insert({'name': 'a'})
+            self.db.test.update_one({'name': 'a'}, {'$inc': {'n': 1}})
+            self.db.test.remove({'name': 'a'})
+            insert, update, delete = self._changes(stream, 3)
+            self.assertIsNone(stream.try_next(timeout=0.1))
+
+        self.assertTrue(stream.closed)
+        self.assertEqual('insert', insert['operationType'])
+        self.assertEqual({'db': 'pymongres_test', 'coll': 'test'}, insert['ns'])
+        self.assertEqual({'_id': _id}, insert['documentKey'])
+        self.assertEqual({'_id': _id, 'name': 'a', 'n': 1}, insert['fullDocument'])
+        self.assertEqual('update', update['operationType'])
+        self.assertEqual({'_id': _id, 'name': 'a', 'n': 2}, update['fullDocument'])
+        self.assertEqual('delete', delete['operationType'])
+        self.assertEqual({'_id': _id}, delete['documentKey'])
+        self.assertIsNone(delete['fullDocument'])
+        self.assertTrue(insert['_id'] < update['_id'] < delete['_id'])
+        self.assertEqual(delete['_id'], stream.resume_token)
+        self.assertNotIn('pymongres_changes', self.db.collection_names())
+
+    def test_large_document(self):
+        with self.db.test.watch() as stream:
+            _id = self.db.test.insert({'text': 'x' * 10000})
+            change, = self._changes(stream, 1)
+        self.assertEqual({'_id': _id, 'text': 'x' * 10000}, change['fullDocument'])
+
+    def test_resume(self):
+        with self.db.test.watch() as stream:
+            self.db.test.insert([{'i': i} for i in xrange(3)])
+            first = self._changes(stream, 1)[0]
+            token = stream.resume_token
+        self.db.test.insert({'i': 3})
+
+        with self.db.test.watch(resume_after=token) as stream:
+            self.db.test.insert({'i': 4})
+            changes = self._changes(stream, 4)
+            self.assertIsNone(stream.try_next(timeout=0.1))
+        self.assertEqual([1, 2, 3, 4], [change['fullDocument']['i'] for change in changes])
+        self.assertEqual(first['_id'], token)
+
+        self.assertGreaterEqual(self.db.test.prune_changes(stream.resume_token), 5)
+        self.assertEqual(0, self.db.test.prune_changes(stream.resume_token))
+        with self.db.test.watch(resume_after=token) as stream:
+            self.assertIsNone(stream.try_next())
+
+    def test_commit_order(self):
+        import psycopg2
+        self.db.test.watch().close()
+        first, second = psycopg2.connect(database='pymongres_test'), psycopg2.connect(database='pymongres_test')
+        try:
+            with self.db.test.watch() as stream:
+                with first.cursor() as cursor:
+                    cursor.execute("INSERT INTO test (data) VALUES ('{\"i\": 1}')")
+                with second.cursor() as cursor:
+                    cursor.execute("INSERT INTO test (data) VALUES ('{\"i\": 2}')")
+                second.commit()
+                first.commit()
+                changes = self._changes(stream, 2)
+        finally:
+            first.close()
+            second.close()
+        self.assertEqual([2, 1], [change['fullDocument']['i'] for change in changes])
+        self.assertLess(changes[0]['_id'], changes[1]['_id'])
+
+        # Resuming after the first committed change replays the second one
+        with self.db.test.watch(resume_after=changes[0]['_id']) as stream:
+            self.assertEqual(changes[1], stream.try_next())
+            self.assertIsNone(stream.try_next())
+
+    def test_iteration_and_unwatch(self):
+        import threading
+        stream = self.db.test.watch(poll_interval=0.05)
+        changes = []
+        thread = threading.Thread(target=lambda: changes.extend(stream))
+        thread.start()
+        self.db.test.insert({'i': 1})
+        self.db.test.unwatch()
+        self.db.test.insert({'i': 2})
+        deadline = time.time() + 5
+        while not changes and time.time() < deadline:
+            time.sleep(0.01)
+        stream.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([1], [change['fullDocument']['i'] for change in changes])
+
+
+class TestDocumentLoader(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        from pymongres.monitoring import CommandListener
+
+        class Listener(CommandListener):
+            def __init__(self):
+                self.operations = []
+
+            def started(self, event):
+                self.operations.append(event.operation)
+
+        self.listener = Listener()
+        self.client = MongresClient(event_listeners=[self.listener])
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.ids = self.db.test.insert([{'i': i, 'name': 'n%d' % i} for i in xrange(5)])
+        del self.listener.operations[:]
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+
+    def test_batch_block(self):
+        ids = self.ids
+        with self.db.test.batch() as batch:
+            pending = [batch.load(_id) for _id in [ids[3], ids[0], 10 ** 6, ids[3]]]
+            self.assertFalse(pending[0].done())
+        self.assertIs(pending[0], pending[3])
+        self.assertEqual([3, 0, None, 3], [d.result() and d.result()['i'] for d in pending])
+        self.assertEqual({'_id': ids[0], 'i': 0, 'name': 'n0'}, pending[1].result())
+        self.assertEqual(['find_by_ids'], self.listener.operations)
+
+    def test_load_many(self):
+        from pymongres import RawDocument
+        batch = self.db.test.batch(fields=['name'], max_batch_size=2)
+        documents = batch.load_many(reversed(self.ids))
+        self.assertEqual(['n4', 'n3', 'n2', 'n1', 'n0'], [document['name'] for document in documents])
+        self.assertEqual(set(['_id', 'name']), set(documents[0]))
+        self.assertEqual(['find_by_ids'] * 3, self.listener.operations)
+
+        document = self.db.test.batch(document_class=RawDocument).find_one(self.ids[2])
+        self.assertIsInstance(document, RawDocument)
+        self.assertEqual(2, document['i'])
+        with self.assertRaises(TypeError):
+            batch.load('1')
+
+    def test_window(self):
+        import threading
+        batch = self.db.test.batch(window=0.5)
+        results = {}
+
+        def find(_id):
+            results[_id] = batch.find_one(_id)['i']
+
+        threads = [threading.Thread(target=find, args=(_id,)) for _id in self.ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(dict((_id, i) for i, _id in enumerate(self.ids)), results)
+        self.assertEqual(['find_by_ids'], self.listener.operations)
@@ -0,0 +1,83 @@
+# coding: utf-8
+
+# Copyright 2009-2012 10gen, Inc.
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from datetime import datetime
+import unittest
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class TestCodecs(unittest.TestCase):
+
+    document = {'a': 1, 'b': [u'é', None], 'date': datetime(2009, 11, 12, 11, 14, 0, 123)}
+
+    def _check_codec(self, codec):
+        decoded = codec.loads(codec.dumps(self.document))
+        self.assertEqual(dict(self.document, date='2009-11-12T11:14:00.000123'), decoded)
+
+    def test_stdlib(self):
+        from pymongres.json_adapters import JsonCodec
+        self._check_codec(JsonCodec())
+
+    @unittest.skipIf(orjson is None, "requires orjson")
+    def test_orjson(self):
+        from pymongres.json_adapters import OrjsonCodec, default_codec
+        self._check_codec(OrjsonCodec())
+        self.assertEqual('orjson', default_codec().name)
+
+
+class MarkedDict(dict):
+    pass
+
+
+class TestPluggableCodec(unittest.TestCase):
+
+    def setUp(self):
+        import json
+        from pymongres import MongresClient
+        from pymongres.json_adapters import JsonCodec
+
+        class MarkingCodec(JsonCodec):
+            def loads(self, s):
+                return json.loads(s, object_hook=MarkedDict)
+
+        self.client = MongresClient(json_codec=MarkingCodec())
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+        self.client.close()
+
+    def test_decoder_registered_on_connections(self):
+        self.db.test.insert([{'a': {'b': 1}, 'date': datetime(2009, 11, 12)}])
+        doc = self.db.test.find_one()
+        self.assertIsInstance(doc, MarkedDict)
+        self.assertIsInstance(doc['a'], MarkedDict)
+        self.assertIsInstance(next(self.db.test.find({}, ['a']))['a'], MarkedDict)
+        self.assertEqual(1, self.db.test.find({'date': datetime(2009, 11, 12)}).count())
+
+    def test_other_clients_are_not_affected(self):
+        from pymongres import MongresClient
+        self.db.test.insert({'a': 1})
+        doc = MongresClient().pymongres_test.test.find_one()
+        self.assertNotIsInstance(doc, MarkedDict)
@@ -0,0 +1,128 @@
+# coding: utf-8
+
+# Copyright 2009-2012 10gen, Inc.
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import unittest
+
+from pymongres.monitoring import CommandListener
+
+
+class RecordingListener(CommandListener):
+
+    def __init__(self):
+        self.events = []
+
+    def started(self, event):
+        self.events.append(('started', event))
+
+    def succeeded(self, event):
+        self.events.append(('succeeded', event))
+
+    def failed(self, event):
+        self.events.append(('failed', event))
+
+
+class TestMonitoring(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.listener = RecordingListener()
+        self.client = MongresClient(event_listeners=[self.listener])
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.collection = self.db.test
+        self.collection.insert([{'a': i, 'b': 'x' * 100} for i in range(10)])
+        del self.listener.events[:]
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+        self.client.close()
+
+    def test_find(self):
+        self.assertEqual(10, len(list(self.collection.find())))
+        (kind1, started), (kind2, succeeded) = self.listener.events
+        self.assertEqual(('started', 'succeeded'), (kind1, kind2))
+        self.assertEqual(started.operation_id, succeeded.operation_id)
+        self.assertEqual(('pymongres_test', 'test', 'find'), (succeeded.database, succeeded.collection, succeeded.operation))
+        self.assertTrue(succeeded.sql.startswith('SELECT'))
+        self.assertEqual(10, succeeded.rows)
+        self.assertGreater(succeeded.bytes_decoded, 1000)
+        self.assertGreaterEqual(succeeded.duration, succeeded.server_time + succeeded.acquire_time)
+
+    def test_insert_and_update(self):
+        self.collection.insert({'a': 10})
+        self.collection.update_many({}, {'$inc': {'a': 1}})
+        events = [event for kind, event in self.listener.events if kind == 'succeeded']
+        self.assertEqual(['insert', 'update_many'], [event.operation for event in events])
+        self.assertEqual([{'a': 10}], [event.params[0].adapted for event in events[:1]])
+
+    def test_failed(self):
+        from pymongres.errors import OperationFailure
+        with self.assertRaises(OperationFailure):
+            self.collection.drop_index('nope')
+        kind, event = self.listener.events[-1]
+        self.assertEqual('failed', kind)
+        self.assertEqual('drop_index', event.operation)
+        self.assertIsNotNone(event.failure)
+
+    def test_redact_params(self):
+        from pymongres import MongresClient
+        client = MongresClient(redact_params=True)
+        client.pymongres_test.collection_names()
+        client.add_listener(self.listener)
+        client.pymongres_test.test.find_one({'a': 1})
+        self.assertEqual([None, None], [event.params for _, event in self.listener.events])
+        client.remove_listener(self.listener)
+        client.pymongres_test.test.find_one({'a': 1})
+        self.assertEqual(2, len(self.listener.events))
+        client.close()
+
+    def test_database_operations(self):
+        self.db.drop_collection('other')
+        self.db.other.insert({'a': 1})
+        self.db.collection_names()
+        self.db.drop_collection('other')
+        events = [event for kind, event in self.listener.events if kind == 'succeeded']
+        self.assertEqual(
+            [('other', 'drop_collection'), ('other', 'create_collection'), ('other', 'insert'),
+             (None, 'list_collections'), ('other', 'drop_collection')],
+            [(event.collection, event.operation) for event in events],
+        )
+
+    def test_bytes_decoded(self):
+        self.collection.insert({'c': 1, 'b': u'\xe9' * 1000})
+        del self.listener.events[:]
+        self.collection.find_one({'c': 1})
+        kind, event = self.listener.events[-1]
+        self.assertGreater(event.bytes_decoded, 2000)
+
+    def test_no_listeners(self):
+        from pymongres import MongresClient
+        client = MongresClient()
+        self.assertEqual(10, len(list(client.pymongres_test.test.find())))
+        with client.pymongres_test.connection() as connection:
+            self.assertEqual((0, 0.0), (connection.bytes_decoded, connection.decode_time))
+        client.close()
+
+    def test_listener_errors_are_ignored(self):
+        class BrokenListener(CommandListener):
+            def started(self, event):
+                raise RuntimeError()
+
+        self.client.add_listener(BrokenListener())
+        self.assertEqual(10, self.collection.count())
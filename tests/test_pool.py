@@ -0,0 +1,154 @@
+# coding: utf-8
+
+# Copyright 2009-2012 10gen, Inc.
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import os
+import threading
+import unittest
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient(max_pool_size=2, wait_queue_timeout=0.1)
+        self.db = self.client.pymongres_test
+        self.pool = self.client._get_pool('pymongres_test')
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_connection_is_reused(self):
+        with self.db.connection() as first:
+            pass
+        with self.db.connection() as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(1, self.pool.stats()['connections_created'])
+
+    def test_stats(self):
+        with self.db.connection():
+            stats = self.client.pool_stats()['pymongres_test']
+            self.assertEqual(1, stats['in_use'])
+            self.assertEqual(0, stats['idle'])
+        stats = self.pool.stats()
+        self.assertEqual(0, stats['in_use'])
+        self.assertEqual(1, stats['idle'])
+        self.assertEqual(1, stats['checkouts'])
+
+    def test_wait_queue_timeout(self):
+        from pymongres.errors import PoolTimeout
+        with self.db.connection():
+            with self.db.connection():
+                with self.assertRaises(PoolTimeout):
+                    with self.db.connection():
+                        pass
+        stats = self.pool.stats()
+        self.assertEqual(1, stats['waits'])
+        self.assertGreaterEqual(stats['wait_time'], 0.1)
+
+    def test_waiter_gets_returned_connection(self):
+        from pymongres.pool import ConnectionPool
+        pool = ConnectionPool(max_size=1, wait_queue_timeout=5, database='pymongres_test')
+        connection = pool.checkout()
+        timer = threading.Timer(0.05, pool.checkin, [connection])
+        timer.start()
+        self.assertIs(connection, pool.checkout())
+        pool.checkin(connection)
+        pool.close()
+
+    def test_rollback_on_error(self):
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE TABLE IF NOT EXISTS pool_test (x int)")
+                cursor.execute("DELETE FROM pool_test")
+        try:
+            with self.db.connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("INSERT INTO pool_test VALUES (1)")
+                raise ValueError()
+        except ValueError:
+            pass
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM pool_test")
+                self.assertEqual((0,), cursor.fetchone())
+                cursor.execute("DROP TABLE pool_test")
+
+    def test_closed_connection_is_discarded(self):
+        with self.db.connection() as first:
+            pass
+        first.close()
+        with self.db.connection() as second:
+            self.assertFalse(second.closed)
+        self.assertIsNot(first, second)
+        self.assertEqual(1, self.pool.stats()['connections_discarded'])
+
+    def test_broken_connection_fails_health_check(self):
+        self.pool.health_check_interval = 0
+        victim = self.pool.checkout()
+        killer = self.pool.checkout()
+        with victim.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            pid, = cursor.fetchone()
+        with killer.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", (pid,))
+        self.pool.checkin(killer)
+        self.pool.checkin(victim)
+        with self.db.connection() as connection:
+            self.assertIsNot(victim, connection)
+        self.assertEqual(1, self.pool.stats()['connections_discarded'])
+
+    def test_max_idle_time(self):
+        from pymongres.pool import ConnectionPool
+        pool = ConnectionPool(max_idle_time=0, database='pymongres_test')
+        with pool.connection():
+            pass
+        self.assertEqual(0, pool.stats()['idle'])
+        pool.close()
+
+    def test_min_size(self):
+        from pymongres.pool import ConnectionPool
+        pool = ConnectionPool(min_size=2, max_idle_time=0, database='pymongres_test')
+        self.assertEqual(2, pool.stats()['idle'])
+        pool.close()
+
+    def test_closed_pool(self):
+        from pymongres.errors import PoolClosed
+        self.pool.close()
+        with self.assertRaises(PoolClosed):
+            self.pool.checkout()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "requires os.fork")
+    def test_fork(self):
+        with self.db.connection() as parent_connection:
+            pass
+        pid = os.fork()
+        if pid == 0:
+            try:
+                with self.db.connection() as child_connection:
+                    ok = child_connection is not parent_connection
+            except Exception:
+                ok = False
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        with self.db.connection() as connection:
+            self.assertIs(parent_connection, connection)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
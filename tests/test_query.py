@@ -0,0 +1,134 @@
+# coding: utf-8
+
+# Copyright 2009-2012 10gen, Inc.
+# Copyright 2013 Ronan Amicel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from datetime import datetime
+import unittest
+
+
+class TestCompiler(unittest.TestCase):
+
+    def test_same_shape_same_template(self):
+        from pymongres.query import compile_find
+        sql1, params1 = compile_find('test', {'a': 'x', 'b': {'$lt': 5}})
+        sql2, params2 = compile_find('test', {'b': {'$lt': 7}, 'a': 'y'})
+        self.assertIs(sql1, sql2)
+        self.assertEqual(5, params1[-1])
+        self.assertEqual(7, params2[-1])
+
+    def test_shape(self):
+        from pymongres.query import analyze, CONTAINS
+        shape, params = analyze({'_id': 3, 'a': 1, 'b': 'x', 'c': {'$gte': 2}})
+        self.assertEqual(
+            ((None, CONTAINS), ('_id', '$eq'), ('b', '$eq'), ('c', '$gte')),
+            shape,
+        )
+        self.assertEqual(['x', 2], params[2:])
+
+    def test_datetime_param(self):
+        from pymongres.query import compile_where
+        sql, params = compile_where({'date': {'$lt': datetime(2009, 11, 12, 12)}})
+        self.assertEqual(" WHERE data->>'date' < %s", sql)
+        self.assertEqual(['2009-11-12T12:00:00'], params)
+
+    def test_unsupported_operator(self):
+        from pymongres.query import compile_where
+        self.assertRaises(Exception, compile_where, {'a': {'$foo': 1}})
+
+    def test_percent_in_key(self):
+        from pymongres.query import compile_where, to_prepared
+        sql, params = compile_where({'a%b': {'$gt': 1}, 'c': {'$lt': 2}})
+        self.assertEqual(" WHERE data->>'a%%b' > %s AND data->>'c' < %s", sql)
+        self.assertEqual(" WHERE data->>'a%b' > $1 AND data->>'c' < $2", to_prepared(sql))
+
+
+class TestPreparedStatements(unittest.TestCase):
+
+    def setUp(self):
+        from pymongres import MongresClient
+        self.client = MongresClient(max_pool_size=1, max_prepared_statements=2)
+        self.db = self.client.pymongres_test
+        self.db.drop_collection("test")
+        self.db.test.insert([{'a': i, 'b': str(i), 'a%b': i} for i in range(5)])
+
+    def tearDown(self):
+        self.db.drop_collection("test")
+        self.client.close()
+
+    def _prepared_statements(self):
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT statement FROM pg_prepared_statements")
+                return [row[0] for row in cursor.fetchall()]
+
+    def test_statement_is_reused(self):
+        self.assertEqual(1, self.db.test.find_one({'b': '1'})['a'])
+        self.assertEqual(2, self.db.test.find_one({'b': '2'})['a'])
+        self.assertEqual(1, len(self._prepared_statements()))
+
+    def test_eviction(self):
+        self.db.test.find_one({'a': 1})
+        self.db.test.find_one({'b': '1'})
+        self.db.test.find({'a': 1}).count()
+        self.assertEqual(2, len(self._prepared_statements()))
+
+    def test_percent_in_key(self):
+        self.assertEqual(2, self.db.test.find({'a%b': {'$gt': '2'}}).count())
+        self.assertEqual(2, len(list(self.db.test.find({'a%b': {'$gt': '2'}}))))
+
+    def test_remove(self):
+        self.db.test.remove({'b': '1'})
+        self.db.test.remove({'b': '2'})
+        self.assertEqual(3, self.db.test.count())
+
+    def test_parameter_types(self):
+        import psycopg2
+        from pymongres.query import prepared_types
+        self.assertEqual(
+            ('integer', 'bigint', 'numeric', 'boolean', 'unknown', 'unknown', 'integer[]', 'text[]'),
+            prepared_types([1, 2 ** 40, 1.5, True, 'a', None, [1, 2], ['a']]),
+        )
+        # Comparing text to a number fails in prepared and unprepared queries alike
+        self.assertRaises(psycopg2.ProgrammingError, self.db.test.find({'a': {'$gt': 2}}).count)
+        self.assertRaises(psycopg2.ProgrammingError, list, self.db.test.find({'a': {'$gt': 2}}))
+        self.assertEqual(2, self.db.test.find({'b': {'$gt': '2'}}).count())
+
+    def test_migrate_to_jsonb(self):
+        self.db.drop_collection("test_json")
+        with self.db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE TABLE test_json (id serial PRIMARY KEY, data json)")
+                cursor.execute("""INSERT INTO test_json (data) VALUES ('{"a": 1}')""")
+        try:
+            self.assertEqual(1, self.db.test_json.find_one({'_id': 1})['a'])
+            self.assertEqual(['test_json'], self.db.migrate_to_jsonb())
+            # The statement prepared on the json column is not reused
+            self.assertEqual(1, self.db.test_json.find_one({'_id': 1})['a'])
+        finally:
+            self.db.drop_collection("test_json")
+
+    def test_disabled(self):
+        from pymongres import MongresClient
+        client = MongresClient(max_prepared_statements=0)
+        collection = client.pymongres_test.test
+        self.assertEqual(1, collection.find_one({'b': '1'})['a'])
+        with collection.database.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM pg_prepared_statements")
+                self.assertEqual((0,), cursor.fetchone())
+        client.close()